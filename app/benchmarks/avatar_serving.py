@@ -0,0 +1,99 @@
+"""
+Requests/sec of repeated avatar loads, plain FileResponse against the cached image response
+that lets clients revalidate with 304s and the same response served from the hot image cache
+    python -m benchmarks.avatar_serving --requests 5000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import FileResponse
+
+from utils.file_responses import image_response
+from functions.image_cache import ImageCache
+
+
+def build_app(directory: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/plain/{file_name}")
+    async def plain(file_name: str):
+        # How the endpoint served images before, blocking exists check and no validators
+        path = f"{directory}/{file_name}"
+
+        if not os.path.exists(path):
+            return {"message": "File does not exist"}
+
+        return FileResponse(path)
+
+    @app.get("/cached/{file_name}")
+    async def cached(request: Request, file_name: str):
+        return await image_response(f"{directory}/{file_name}", request.headers)
+
+    image_cache = ImageCache()
+
+    @app.get("/memory/{file_name}")
+    async def memory(request: Request, file_name: str):
+        return await image_response(f"{directory}/{file_name}", request.headers, image_cache=image_cache)
+
+    return app
+
+
+async def run(client: httpx.AsyncClient, url: str, total: int, concurrency: int, headers: dict = None) -> float:
+    remaining = total
+
+    async def worker():
+        nonlocal remaining
+
+        while remaining > 0:
+            remaining -= 1
+            response = await client.get(url, headers=headers)
+
+            if response.status_code not in (200, 304):
+                raise RuntimeError(f"Unexpected status {response.status_code}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    return total / (time.perf_counter() - start)
+
+
+async def main_async(args):
+    with tempfile.TemporaryDirectory() as directory:
+        # Avatar sized file
+        with open(f"{directory}/avatar.jpg", "wb") as file:
+            file.write(b"\xff\xd8\xff" + os.urandom(args.size))
+
+        transport = httpx.ASGITransport(app=build_app(directory))
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            etag = (await client.get("/cached/avatar.jpg")).headers["etag"]
+
+            results = {
+                "plain 200": await run(client, "/plain/avatar.jpg", args.requests, args.concurrency),
+                "cached 200": await run(client, "/cached/avatar.jpg", args.requests, args.concurrency),
+                "hot image cache 200": await run(client, "/memory/avatar.jpg", args.requests, args.concurrency),
+                "cached 304 revalidation": await run(client, "/cached/avatar.jpg", args.requests, args.concurrency,
+                                                     {"if-none-match": etag})
+            }
+
+    for name, requests_per_second in results.items():
+        print(f"{name:<26} {requests_per_second:>8.0f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Avatar serving benchmark")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--size", type=int, default=20000, help="avatar size in bytes")
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,442 @@
+"""
+Throughput and p50/p95/p99 latency of every route of the api at a fixed concurrency.
+Seeds an in-memory stand-in (mongomock) or a local MongoDB with data.create_data and drives the app in process:
+    python -m benchmarks.endpoints run --users 2000 --requests 500 --concurrency 32 --output before.json
+    python -m benchmarks.endpoints run --backend mongo --uri mongodb://localhost:27017 --users 100000 --output after.json
+    python -m benchmarks.endpoints compare before.json after.json --tolerance 0.1
+Compare exits with 1 when a route lost more throughput or gained more p95/p99 latency than the tolerance.
+GitHub is answered by a mock transport so the login runs the whole workflow against the database.
+/api/events streams forever and is measured by benchmarks.sse_load, /api/logout is not implemented
+"""
+import argparse
+import asyncio
+import base64
+import datetime as dt
+import io
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+import bcrypt
+import httpx
+from PIL import Image
+
+from data import create_data
+
+# Every seeded user gets a session with this id, hashed once
+SESSION_ID = "benchmark-session"
+
+# Logins of the auth route cycle through these GitHub accounts, the first round creates their profiles
+LOGIN_ACCOUNTS = 50
+
+# Order matters: uploads run before the image routes and delete_user runs last
+ROUTES = ["root", "login_redirect", "auth", "profile", "update_profile", "upload_picture", "upload_picture_file",
+          "image", "picture", "likes", "matches", "counts", "discover", "like", "dislike", "unmatch", "metrics",
+          "delete_user"]
+
+
+def seed(database, args) -> dict:
+    """
+    Loads users, likes and matches and gives every user a session
+    :param database: pymongo or mongomock database
+    :param args:
+    :return: usernames of the match pairs, for unmatch
+    """
+    settings = create_data.default_settings(users=args.users, seed=args.seed, workers=args.workers,
+                                            uri=args.uri, database=args.database, drop=True)
+
+    # mongomock lives in this process, the loader workers could not see it
+    if args.backend == "mongomock":
+        settings["workers"] = 1
+        create_data.create_data(settings, database)
+    else:
+        create_data.create_data(settings)
+
+    # Sessions of every user share one hash, bcrypt is too slow to hash one per user.
+    # Its cost is paid again on every authenticated request
+    hashed_session_id = bcrypt.hashpw(SESSION_ID.encode(), bcrypt.gensalt(args.bcrypt_rounds))
+    now = dt.datetime.now()
+    database["sessions"].drop()
+
+    for start in range(0, args.users, 1000):
+        database["sessions"].insert_many([{
+            "user_id": create_data.user_id(index),
+            "username": f"user{index}",
+            "hashed_session_id": hashed_session_id,
+            "created_at": now,
+            "expired_at": now + dt.timedelta(days=365),
+            "last_used": now,
+            "active": True
+        } for index in range(start, min(start + 1000, args.users))])
+
+    # Usernames are user{index} and the index is the end of the generated id
+    pairs = [(f"user{int.from_bytes(match['user_id'].binary[5:], 'big')}",
+              f"user{int.from_bytes(match['matched_user_id'].binary[5:], 'big')}")
+             for match in database["matches"].find({"active": True}, {"user_id": 1, "matched_user_id": 1})]
+
+    return {"pairs": pairs}
+
+
+def github_transport() -> httpx.MockTransport:
+    # The code is the GitHub login, it comes back as the access token and then as the user
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/login/oauth/access_token":
+            code = parse_qs(request.content.decode())["code"][0]
+            return httpx.Response(200, json={"access_token": code})
+
+        return httpx.Response(200, json={"login": request.headers["authorization"].split(" ", 1)[1]})
+
+    return httpx.MockTransport(handler)
+
+
+def sample_image() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (256, 256), (40, 120, 200)).save(buffer, "PNG")
+
+    return buffer.getvalue()
+
+
+class Scenarios:
+    """
+    Request of every route, the n-th request of a route is the same on every run
+    """
+
+    def __init__(self, users: int, seed: int, pairs: list, image: bytes):
+        self.users = users
+        self.seed = seed
+        self.pairs = pairs
+        self.image = image
+        self.image_base64 = base64.b64encode(image).decode()
+
+        # Uploads and image reads use the same few users so the images exist
+        self.uploaders = [f"user{index}" for index in range(min(users, 20))]
+        self.picture_files = []
+
+        # delete_user takes users from the end, the other routes stay below
+        self.deleted = 0
+
+    def generator(self, route: str, n: int) -> random.Random:
+        return random.Random(f"{self.seed}-{route}-{n}")
+
+    def actor(self, rng: random.Random) -> str:
+        return f"user{rng.randrange(self.users // 2)}"
+
+    @staticmethod
+    def headers(username: str) -> dict:
+        return {"username": username, "session_id": SESSION_ID}
+
+    def request(self, route: str, n: int) -> tuple:
+        """
+        :param route:
+        :param n:
+        :return: (method, url, keyword arguments of httpx)
+        """
+        rng = self.generator(route, n)
+        actor = self.actor(rng)
+        auth = {"headers": self.headers(actor)}
+
+        if route == "root":
+            return "GET", "/api/", {}
+        if route == "login_redirect":
+            return "GET", "/api/login/github", {}
+        if route == "auth":
+            return "GET", f"/init_login?code=benchmark_login{n % LOGIN_ACCOUNTS}", {}
+        if route == "profile":
+            return "GET", "/api/get_profile", auth
+        if route == "update_profile":
+            return "POST", "/api/update_profile", {**auth, "json": {"looking_for": f"A partner for project {n}"}}
+        if route == "upload_picture":
+            headers = self.headers(rng.choice(self.uploaders))
+            return "POST", "/api/upload_profile_picture", {"headers": headers, "json": {"image": self.image_base64}}
+        if route == "upload_picture_file":
+            headers = self.headers(rng.choice(self.uploaders))
+            return "POST", "/api/upload_profile_picture_file", {
+                "headers": headers, "files": {"file": ("avatar.png", self.image, "image/png")}}
+        if route == "image":
+            return "GET", f"/api/profile_image/{rng.choice(self.uploaders)}?size=128", {}
+        if route == "picture":
+            return "GET", f"/api/get_profile_picture/{rng.choice(self.picture_files)}", {}
+        if route == "likes":
+            return "GET", "/api/get_likes", auth
+        if route == "matches":
+            return "GET", "/api/get_matches", auth
+        if route == "counts":
+            return "GET", "/api/get_counts", auth
+        if route == "discover":
+            return "GET", "/api/get_discovers", auth
+        if route in ("like", "dislike"):
+            other = f"user{rng.randrange(self.users // 2)}"
+            return "PUT", f"/api/{route}_user/{other}", auth
+        if route == "unmatch":
+            username, matched_username = self.pairs[n % len(self.pairs)]
+            return "DELETE", f"/api/unmatch?matched_username={matched_username}", {"headers": self.headers(username)}
+        if route == "metrics":
+            return "GET", "/metrics", {}
+        if route == "delete_user":
+            self.deleted += 1
+            return "DELETE", "/api/delete_user", {"headers": self.headers(f"user{self.users - self.deleted}")}
+
+        raise ValueError(f"Unknown route {route}")
+
+    def requests(self, route: str, requested: int) -> int:
+        # Routes that use up their data get fewer requests
+        if route == "unmatch":
+            return min(requested, len(self.pairs))
+        if route == "delete_user":
+            return min(requested, self.users // 2)
+        if route == "picture" and not self.picture_files:
+            return 0
+
+        return requested
+
+
+def percentile(values: list, fraction: float) -> float:
+    # Nearest rank of sorted values
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+
+async def drive(client: httpx.AsyncClient, scenarios: Scenarios, route: str, total: int, concurrency: int,
+                offset: int = 0) -> dict:
+    """
+    Sends total requests of a route from concurrency workers
+    :param client:
+    :param scenarios:
+    :param route:
+    :param total:
+    :param concurrency:
+    :param offset: first request number, warm up requests are numbered after the measured ones
+    :return: result of the route
+    """
+    latencies = []
+    statuses = Counter()
+    next_request = 0
+
+    async def worker():
+        nonlocal next_request
+
+        while next_request < total:
+            method, url, kwargs = scenarios.request(route, offset + next_request)
+            next_request += 1
+
+            start = time.perf_counter()
+
+            try:
+                response = await client.request(method, url, **kwargs)
+                statuses[str(response.status_code)] += 1
+            except httpx.HTTPError:
+                statuses["error"] += 1
+
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    return {
+        "requests": total,
+        "seconds": elapsed,
+        "requests_per_second": total / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+        "errors": sum(count for code, count in statuses.items() if code == "error" or int(code) >= 500),
+        "statuses": dict(statuses)
+    }
+
+
+async def run_routes(app, scenarios: Scenarios, database, args) -> dict:
+    results = {}
+
+    async with app.router.lifespan_context(app):
+        # GitHub is mocked and images go to a temporary directory
+        await app.state.http_client.aclose()
+        app.state.http_client = httpx.AsyncClient(transport=github_transport())
+        app.state.image_storage.root = args.image_directory
+
+        transport = httpx.ASGITransport(app=app)
+        limits = httpx.Limits(max_connections=args.concurrency)
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", limits=limits,
+                                     timeout=60) as client:
+            for route in [route for route in ROUTES if route in args.routes]:
+                # Stored file names of the uploaded pictures
+                if route == "picture":
+                    scenarios.picture_files = [user["profile_picture"].rsplit("/", 1)[-1] async for user in
+                                               database["users"].find({"username": {"$in": scenarios.uploaders},
+                                                                       "profile_picture": {"$ne": ""}})]
+
+                total = scenarios.requests(route, args.requests)
+
+                if total == 0:
+                    print(f"{route:<20} skipped, nothing to request")
+                    continue
+
+                # Warm up caches and connections, except for routes that use up their data
+                if args.warmup and route not in ("unmatch", "delete_user"):
+                    await drive(client, scenarios, route, args.warmup, args.concurrency, offset=args.requests)
+
+                result = results[route] = await drive(client, scenarios, route, total, args.concurrency)
+
+                print(f"{route:<20} {result['requests_per_second']:>9.0f} req/s  p50 {result['p50_ms']:>7.2f} ms  "
+                      f"p95 {result['p95_ms']:>7.2f} ms  p99 {result['p99_ms']:>7.2f} ms  errors {result['errors']}")
+
+    return results
+
+
+async def run_async(args, database, seeded: dict) -> dict:
+    # Imported late so the app module does not connect on import of this benchmark
+    import main
+
+    if args.backend == "mongomock":
+        from mongomock_motor import AsyncMongoMockClient
+
+        client = AsyncMongoMockClient(mock_mongo_client=database.client)
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        client = AsyncIOMotorClient(args.uri)
+
+    try:
+        async_database = client[args.database]
+        app = main.create_app(async_database)
+        scenarios = Scenarios(args.users, args.seed, seeded["pairs"], sample_image())
+
+        return await run_routes(app, scenarios, async_database, args)
+    finally:
+        client.close()
+
+
+def run(args):
+    if args.backend == "mongomock":
+        import mongomock
+
+        database = mongomock.MongoClient()[args.database]
+    else:
+        import pymongo
+
+        database = pymongo.MongoClient(args.uri)[args.database]
+
+    args.image_directory = tempfile.mkdtemp(prefix="codespark-benchmark-")
+
+    try:
+        seeded = seed(database, args)
+        results = asyncio.run(run_async(args, database, seeded))
+    finally:
+        shutil.rmtree(args.image_directory, ignore_errors=True)
+
+        if args.backend == "mongo" and not args.keep:
+            database.client.drop_database(args.database)
+
+    report = {
+        "meta": {
+            "backend": args.backend,
+            "users": args.users,
+            "seed": args.seed,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "bcrypt_rounds": args.bcrypt_rounds,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "routes": results
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    return report
+
+
+def compare(args) -> int:
+    """
+    Prints the change of every route between two result files
+    :param args:
+    :return: 1 when a route regressed beyond the tolerance
+    """
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+
+    with open(args.candidate) as file:
+        candidate = json.load(file)
+
+    regressions = 0
+
+    for key in ("backend", "users", "concurrency", "bcrypt_rounds"):
+        if baseline["meta"].get(key) != candidate["meta"].get(key):
+            print(f"Warning: {key} differs, {baseline['meta'].get(key)} against {candidate['meta'].get(key)}")
+
+    for route in [route for route in ROUTES if route in baseline["routes"] or route in candidate["routes"]]:
+        old = baseline["routes"].get(route)
+        new = candidate["routes"].get(route)
+
+        if old is None or new is None:
+            print(f"{route:<20} only in {'candidate' if old is None else 'baseline'}")
+            continue
+
+        changes = {
+            "req/s": new["requests_per_second"] / old["requests_per_second"] - 1 if old["requests_per_second"] else 0,
+            "p95": new["p95_ms"] / old["p95_ms"] - 1 if old["p95_ms"] else 0,
+            "p99": new["p99_ms"] / old["p99_ms"] - 1 if old["p99_ms"] else 0
+        }
+
+        # Less throughput or more latency is worse
+        regressed = changes["req/s"] < -args.tolerance or changes["p95"] > args.tolerance or \
+            changes["p99"] > args.tolerance or new["errors"] > old["errors"]
+        regressions += regressed
+
+        print(f"{route:<20} " + "  ".join(f"{name} {change:>+7.1%}" for name, change in changes.items()) +
+              f"  errors {old['errors']} -> {new['errors']}" + ("  REGRESSION" if regressed else ""))
+
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Endpoint benchmark suite")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="seeds the database and measures every route")
+    run_parser.add_argument("--backend", choices=["mongomock", "mongo"], default="mongomock")
+    run_parser.add_argument("--uri", default="mongodb://localhost:27017")
+    run_parser.add_argument("--database", default="codespark_benchmark", help="dropped at the end with mongo")
+    run_parser.add_argument("--keep", action="store_true", help="keeps the mongo database")
+    run_parser.add_argument("--users", type=int, default=1000)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--workers", type=int, default=4, help="processes loading the data into mongo")
+    run_parser.add_argument("--bcrypt-rounds", type=int, default=12,
+                            help="cost of the seeded session hashes, 12 like production, lower to measure the rest")
+    run_parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    run_parser.add_argument("--warmup", type=int, default=50, help="requests per route before measuring")
+    run_parser.add_argument("--concurrency", type=int, default=32)
+    run_parser.add_argument("--routes", nargs="+", choices=ROUTES, default=ROUTES)
+    run_parser.add_argument("--output", default=None, help="JSON file of the results")
+
+    compare_parser = commands.add_parser("compare", help="compares two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--tolerance", type=float, default=0.1,
+                                help="allowed relative loss of throughput or gain of p95/p99 latency")
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        sys.exit(compare(args))
+
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Compares FastAPI's default encoding (jsonable_encoder + JSONResponse) with ORJSONResponse
+on a 100 card discover page and a likes listing
+    python -m benchmarks.json_encoding --cards 100 --rounds 2000
+"""
+import argparse
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from utils.responses import ORJSONResponse
+
+
+def make_card(i: int) -> dict:
+    return {
+        "username": f"user{i}",
+        "profile_picture": f"http://localhost:8000/api/get_profile_picture/user{i}_2023-10-01_12-00-00.jpg",
+        "natural_languages": "English, Spanish, French, German, ",
+        "background": "Python, Java, C++, C#, JavaScript, TypeScript, ",
+        "looking_for": "A partner to work on a project and learn a language",
+        "how_contribute": "I can help you with your project and teach you a language"
+    }
+
+
+def run(name: str, encode, payload, rounds: int):
+    # Warm up
+    for _ in range(10):
+        encode(payload)
+
+    start = time.perf_counter()
+
+    for _ in range(rounds):
+        body = encode(payload)
+
+    elapsed = time.perf_counter() - start
+
+    print(f"{name:<32} {rounds / elapsed:>10.0f} responses/s {elapsed / rounds * 1e6:>8.1f} us {len(body):>7} bytes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON response encoding benchmark")
+    parser.add_argument("--cards", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    discover = [make_card(i) for i in range(args.cards)]
+    likes = {"user_liked": discover[:args.cards // 2], "liked_user": discover[args.cards // 2:]}
+
+    for name, payload in [("discover", discover), ("likes", likes)]:
+        run(f"{name} jsonable_encoder+json", lambda content: JSONResponse(jsonable_encoder(content)).body,
+            payload, args.rounds)
+        run(f"{name} orjson", lambda content: ORJSONResponse(content).body, payload, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Bytes and server CPU of one discover page (100 cards) with every card field and with sparse fieldsets,
+sent as is, with gzip and with brotli when it is installed:
+    python -m benchmarks.list_payloads --cards 100 --iterations 500
+CPU is process time per page for rendering the JSON plus compressing it
+"""
+import argparse
+import gzip
+import random
+import time
+
+from utils.responses import ORJSONResponse
+from functions.profile_cards import ProfileCards
+from functions.user_management import LIKE_CARD_SCHEMA, select_fields
+from data.create_data import LANGUAGES, NATURAL_LANGUAGES, LOOKING_FOR, HOW_CONTRIBUTE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def make_cards(count: int, seed: int) -> list:
+    rng = random.Random(seed)
+
+    return [{
+        "username": f"user{i}",
+        "profile_picture": f"https://codespark.example/api/get_profile_picture/{rng.getrandbits(256):064x}.webp",
+        "natural_languages": ", ".join(NATURAL_LANGUAGES[:rng.randint(1, len(NATURAL_LANGUAGES))]),
+        "background": ", ".join(LANGUAGES[:rng.randint(1, len(LANGUAGES))]),
+        "looking_for": rng.choice(LOOKING_FOR),
+        "how_contribute": rng.choice(HOW_CONTRIBUTE)
+    } for i in range(count)]
+
+
+def encoders() -> dict:
+    encoders = {
+        "identity": lambda body: body,
+        "gzip-1": lambda body: gzip.compress(body, compresslevel=1, mtime=0),
+        "gzip-6": lambda body: gzip.compress(body, compresslevel=6, mtime=0),
+        "gzip-9": lambda body: gzip.compress(body, compresslevel=9, mtime=0)
+    }
+
+    if brotli is not None:
+        encoders["br-1"] = lambda body: brotli.compress(body, quality=1)
+        encoders["br-4"] = lambda body: brotli.compress(body, quality=4)
+        encoders["br-11"] = lambda body: brotli.compress(body, quality=11)
+
+    return encoders
+
+
+def measure(cards: list, schema: list, encode, iterations: int) -> tuple:
+    # Render and compress the page like the api does, CPU time only
+    start = time.process_time()
+
+    for _ in range(iterations):
+        body = encode(ORJSONResponse([ProfileCards.render(card, schema) for card in cards]).body)
+
+    return len(body), (time.process_time() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List payload size and CPU benchmark")
+    parser.add_argument("--cards", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fields", action="append", default=None,
+                        help="sparse fieldset to measure, can be repeated, e.g. username,profile_picture")
+    args = parser.parse_args()
+
+    cards = make_cards(args.cards, args.seed)
+    fieldsets = [None] + (args.fields or ["profile_picture", "profile_picture,background"])
+
+    if brotli is None:
+        print("brotli is not installed, only gzip is measured")
+
+    print(f"{'fields':<30} {'encoding':<9} {'bytes':>8} {'ratio':>6} {'cpu us':>8}")
+
+    for fields in fieldsets:
+        schema = select_fields(LIKE_CARD_SCHEMA, fields)
+        full_size = None
+
+        for name, encode in encoders().items():
+            size, cpu = measure(cards, schema, encode, args.iterations)
+            full_size = full_size or size
+
+            print(f"{fields or 'all':<30} {name:<9} {size:>8} {size / full_size:>6.2f} {cpu * 1000000:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Requests/sec of concurrent profile and listing reads, blocking pymongo calls inside coroutines
+(how the endpoints worked before) against UserManagement on Motor.
+Needs a running MongoDB, the data goes to a throwaway database that is dropped at the end:
+    python -m benchmarks.mongo_concurrency --uri mongodb://localhost:27017 --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import datetime as dt
+import random
+import statistics
+import time
+
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from utils import database
+from utils.cache import Caches
+from functions.user_management import UserManagement, LIKE_CARD_SCHEMA
+
+
+def seed(db, users: int, likes_per_user: int):
+    now = dt.datetime.now()
+
+    db["users"].insert_many([{
+        "username": f"user{i}", "email": f"user{i}@example.com", "discord_username": f"user{i}#0000",
+        "profile_picture": "", "natural_languages": "English", "background": "Python", "looking_for": "A project",
+        "how_contribute": "Code", "likes": [], "matches": [], "created_at": now, "updated_at": now, "last_login": now,
+        "revision": 0, "active": True
+    } for i in range(users)])
+
+    ids = [user["_id"] for user in db["users"].find({}, {"_id": 1})]
+    likes = []
+
+    for user_id in ids:
+        for liked_user_id in random.sample(ids, likes_per_user):
+            if liked_user_id != user_id:
+                likes.append({"active": True, "is_like": True, "user_id": user_id, "liked_user_id": liked_user_id,
+                              "created_at": now, "deleted_at": None})
+
+    result = db["likes"].insert_many(likes)
+
+    # Like ids on both users, same as the api keeps them
+    operations = []
+
+    for like, like_id in zip(likes, result.inserted_ids):
+        operations.append(pymongo.UpdateOne({"_id": like["user_id"]}, {"$push": {"likes": like_id}}))
+        operations.append(pymongo.UpdateOne({"_id": like["liked_user_id"]}, {"$push": {"likes": like_id}}))
+
+    db["users"].bulk_write(operations, ordered=False)
+
+
+def blocking_request(db, username: str):
+    # Profile, then the likes listing one card at a time, every call blocks the event loop
+    user = db["users"].find_one({"username": username, "active": True})
+    cards = []
+
+    for like in db["likes"].find({"_id": {"$in": user["likes"]}, "active": True, "is_like": True}):
+        other_id = like["liked_user_id"] if like["user_id"] == user["_id"] else like["user_id"]
+        other = db["users"].find_one({"_id": other_id, "active": True})
+
+        if other is not None:
+            cards.append({field: other[field] for field in LIKE_CARD_SCHEMA})
+
+    return user, cards
+
+
+async def async_request(user_management: UserManagement, username: str):
+    return await asyncio.gather(user_management.get_user_profile(username), user_management.get_likes(username))
+
+
+async def run(handler, usernames: list, requests: int, concurrency: int) -> dict:
+    latencies = []
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            await handler(random.choice(usernames))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    return {
+        "requests_per_second": requests / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000
+    }
+
+
+async def main_async(args, sync_db):
+    usernames = [f"user{i}" for i in range(args.users)]
+
+    async def blocking(username):
+        blocking_request(sync_db, username)
+
+    client = AsyncIOMotorClient(args.uri)
+
+    # Profiles and cards expire right away, every request goes to the database
+    db = client[args.database]
+    user_management = UserManagement(db, caches=Caches(url="", ttl=0))
+
+    async def concurrent(username):
+        await async_request(user_management, username)
+
+    results = {
+        "blocking pymongo": await run(blocking, usernames, args.requests, args.concurrency),
+        "motor + gather": await run(concurrent, usernames, args.requests, args.concurrency)
+    }
+
+    client.close()
+
+    for name, result in results.items():
+        print(f"{name:<18} {result['requests_per_second']:>8.0f} req/s  "
+              f"p50 {result['p50_ms']:>7.1f} ms  p95 {result['p95_ms']:>7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MongoDB concurrency benchmark")
+    parser.add_argument("--uri", default=None, help="defaults to MONGO_URI")
+    parser.add_argument("--database", default="codespark_benchmark")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--likes-per-user", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    args.uri = args.uri or database.get_database_uri()
+
+    sync_client = pymongo.MongoClient(args.uri)
+    sync_client.drop_database(args.database)
+
+    try:
+        seed(sync_client[args.database], args.users, args.likes_per_user)
+        asyncio.run(main_async(args, sync_client[args.database]))
+    finally:
+        sync_client.drop_database(args.database)
+        sync_client.close()
+
+
+if __name__ == '__main__':
+    main()
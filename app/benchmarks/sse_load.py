@@ -0,0 +1,132 @@
+"""
+Load test for the event streams
+
+In-process mode opens N idle streams on the event bus and measures the memory held per connection
+and the fan-out time of one event to every stream:
+    python -m benchmarks.sse_load --connections 10000
+
+HTTP mode opens N streams against a running server, pass the server pid to read its memory:
+    python -m benchmarks.sse_load --url http://localhost:8000/api/events --connections 2000 \
+        --username user0 --session-id ... --pid 1234
+"""
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+
+import httpx
+
+from functions.events import EventBus
+
+
+async def in_process(connections: int):
+    event_bus = EventBus(heartbeat=3600)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    # Open the streams and let them park on their first wait
+    tasks = []
+
+    async def consume(key, received: list):
+        async for chunk in event_bus.stream(key):
+            if chunk.startswith("event:"):
+                received.append(time.perf_counter())
+
+    received = []
+
+    for i in range(connections):
+        tasks.append(asyncio.create_task(consume(f"user{i}", received)))
+
+    await asyncio.sleep(0.5)
+
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Publish one event to every user and wait for all of them to arrive
+    start = time.perf_counter()
+
+    for i in range(connections):
+        event_bus.publish(f"user{i}", "like", {"username": "bench"})
+
+    while len(received) < connections:
+        await asyncio.sleep(0.001)
+
+    fan_out = time.perf_counter() - start
+    open_connections = event_bus.connection_count()
+
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    print(f"connections: {open_connections}")
+    print(f"memory per connection: {(after - before) / connections:.0f} bytes")
+    print(f"fan out of {connections} events: {fan_out * 1000:.1f} ms")
+
+
+def read_rss(pid: int) -> int:
+    # Resident memory of a process in bytes
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+
+async def over_http(url: str, connections: int, username: str, session_id: str, pid: int):
+    headers = {"username": username, "session_id": session_id}
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=0)
+
+    rss_before = read_rss(pid) if pid else 0
+    opened = 0
+
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        streams = []
+
+        async def open_stream():
+            nonlocal opened
+            request = client.build_request("GET", url, headers=headers)
+            response = await client.send(request, stream=True)
+
+            if response.status_code == 200:
+                opened += 1
+                streams.append(response)
+            else:
+                await response.aclose()
+
+        await asyncio.gather(*(open_stream() for _ in range(connections)))
+        await asyncio.sleep(1)
+
+        rss_after = read_rss(pid) if pid else 0
+
+        print(f"connections: {opened}")
+
+        if pid and opened:
+            print(f"server memory per connection: {(rss_after - rss_before) / opened:.0f} bytes")
+
+        for response in streams:
+            await response.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event stream load test")
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--username", default="user0")
+    parser.add_argument("--session-id", default="")
+    parser.add_argument("--pid", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.url is None:
+        asyncio.run(in_process(args.connections))
+    else:
+        asyncio.run(over_http(args.url, args.connections, args.username, args.session_id, args.pid))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Requests/sec of the api with 1, 2, 4 and 8 worker processes started through serve.py.
+Load comes from several client processes so the client is not the bottleneck:
+    python -m benchmarks.worker_scaling --workers 1 2 4 8 --requests 20000 --concurrency 64
+Other endpoints can be measured with --path and --header, e.g. --path /api/get_counts --header username=user0
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+
+def wait_until_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+
+    raise RuntimeError(f"Server did not start: {url}")
+
+
+async def load(url: str, headers: dict, requests: int, concurrency: int) -> int:
+    remaining = requests
+    errors = 0
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, headers=headers) as client:
+        async def worker():
+            nonlocal remaining, errors
+
+            while remaining > 0:
+                remaining -= 1
+                response = await client.get(url)
+
+                if response.status_code >= 400:
+                    errors += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    return errors
+
+
+def client_process(args: tuple) -> int:
+    return asyncio.run(load(*args))
+
+
+def measure(workers: int, args) -> tuple:
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    server = subprocess.Popen([sys.executable, "serve.py", "--workers", str(workers), "--host", "127.0.0.1",
+                               "--port", str(args.port), "--log-level", "warning"],
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    try:
+        wait_until_ready(base_url + "/api/")
+
+        headers = dict(header.split("=", 1) for header in args.header)
+        per_client = args.requests // args.clients
+        jobs = [(base_url + args.path, headers, per_client, args.concurrency // args.clients)] * args.clients
+
+        with multiprocessing.Pool(args.clients) as pool:
+            # Warm up every worker before measuring
+            pool.map(client_process, [(base_url + args.path, headers, 200, 4)] * args.clients)
+
+            start = time.perf_counter()
+            errors = sum(pool.map(client_process, jobs))
+            elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    return per_client * args.clients / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker scaling benchmark")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--path", default="/api/")
+    parser.add_argument("--header", action="append", default=[], help="name=value sent with every request")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--clients", type=int, default=4, help="load generating processes")
+    parser.add_argument("--port", type=int, default=8123)
+    args = parser.parse_args()
+
+    baseline = None
+
+    for workers in args.workers:
+        requests_per_second, errors = measure(workers, args)
+        baseline = baseline or requests_per_second
+
+        print(f"{workers:>2} workers {requests_per_second:>9.0f} req/s  {requests_per_second / baseline:>5.2f}x  "
+              f"errors {errors}")
+
+
+if __name__ == '__main__':
+    main()
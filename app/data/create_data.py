@@ -1,170 +1,352 @@
-"""Create synthetic data for testing purposes"""
-
+"""
+Create synthetic data for testing purposes.
+Seeded and deterministic, the same arguments always give the same documents whatever the number of workers:
+    python -m data.create_data --users 1000000 --workers 8 --seed 1 --drop
+Users are loaded first, then likes, dislikes and matches with power-law degrees, so a few users get
+most of the attention like in the real app. The likes and matches arrays of the users and the counters
+are kept consistent with the edges
+"""
+import argparse
+import datetime as dt
+import math
+import multiprocessing
+import os
 import random
+import struct
+import time
+from collections import defaultdict
+
 import pymongo
-from dotenv import load_dotenv
-import os
-import datetime as dt
 from bson.objectid import ObjectId
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+LANGUAGES = ["Python", "Java", "C++", "C#", "JavaScript", "TypeScript", "HTML", "CSS", "SQL", "PHP", "Ruby", "Rust"]
+NATURAL_LANGUAGES = ["English", "Spanish", "French", "German", "Chinese", "Japanese", "Korean", "Russian", "Arabic"]
+LOOKING_FOR = [
+    "A partner to work on a project",
+    "A partner to learn a language",
+    "A partner to teach a language",
+    "A partner to work on a project and learn a language",
+    "A partner to work on a project and teach a language",
+    "A partner to learn a language and teach a language",
+]
+HOW_CONTRIBUTE = [
+    "I can help you with your project",
+    "I can teach you a language",
+    "I can learn a language from you",
+    "I can help you with your project and teach you a language",
+]
+
+# Every date is relative to this so runs do not depend on the clock
+BASE_TIME = dt.datetime(2023, 6, 1)
+
+# First byte after the timestamp of the generated ObjectIds, keeps the ids of each collection apart
+USER_KIND = 1
+LIKE_KIND = 2
+MATCH_KIND = 3
+
+# Edges of one user are numbered below this, the rest of the id is the user index
+EDGE_BITS = 20
+
+# Multiplier of the popularity permutation, made coprime with the number of users
+PERMUTATION_PRIME = 2654435761
+
+# Settings and client of a worker process, set by init_worker
+config = None
+db = None
+
 
+def make_id(kind: int, number: int) -> ObjectId:
+    # 4 byte timestamp, kind and a 7 byte number, the same on every run
+    return ObjectId(struct.pack(">IB", int(BASE_TIME.timestamp()), kind) + number.to_bytes(7, "big"))
 
-def create_user(username):
-    languages = ["Python", "Java", "C++", "C#", "JavaScript", "TypeScript", "HTML", "CSS", "SQL", "PHP", "Ruby", "Rust"]
-    natural_languages = ["English", "Spanish", "French", "German", "Chinese", "Japanese", "Korean", "Russian", "Arabic"]
-    looking_for = [
-        "A partner to work on a project",
-        "A partner to learn a language",
-        "A partner to teach a language",
-        "A partner to work on a project and learn a language",
-        "A partner to work on a project and teach a language",
-        "A partner to learn a language and teach a language",
-    ]
-    how_contribute = [
-        "I can help you with your project",
-        "I can teach you a language",
-        "I can learn a language from you",
-        "I can help you with your project and teach you a language",
-    ]
-
-    # Make natural languages string by choosing random amount of languages
-    natural_languages_string = ""
-    for i in range(random.randint(1, len(natural_languages))):
-        natural_languages_string += natural_languages[i] + ", "
-
-    # Make languages string by choosing random amount of languages
-    languages_string = ""
-    for i in range(random.randint(1, len(languages))):
-        languages_string += languages[i] + ", "
-
-    col_users.insert_one({
+
+def user_id(index: int) -> ObjectId:
+    return make_id(USER_KIND, index)
+
+
+def edge_number(index: int, edge: int) -> int:
+    return (index << EDGE_BITS) | edge
+
+
+def user_random(name: str, index: int) -> random.Random:
+    # Every user has its own generator, so the result does not depend on the workers or the block size
+    return random.Random(f"{config['seed']}-{name}-{index}")
+
+
+def create_user(index: int) -> dict:
+    rng = user_random("user", index)
+    username = f"user{index}"
+
+    # Make natural languages and languages strings by choosing random amount of languages
+    natural_languages_string = ", ".join(NATURAL_LANGUAGES[:rng.randint(1, len(NATURAL_LANGUAGES))]) + ", "
+    languages_string = ", ".join(LANGUAGES[:rng.randint(1, len(LANGUAGES))]) + ", "
+
+    created_at = BASE_TIME - dt.timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+    last_login = BASE_TIME - dt.timedelta(seconds=rng.randint(0, 90 * 24 * 3600))
+
+    return {
+        "_id": user_id(index),
         "username": username,
         "email": f"{username}@gmail.com",
-        "discord_username": username + f"#{random.randint(1000, 9999)}",
+        "discord_username": username + f"#{rng.randint(1000, 9999)}",
         "profile_picture": "",
         "natural_languages": natural_languages_string,
         "background": languages_string,
-        "looking_for": looking_for[random.randint(0, len(looking_for) - 1)],
-        "how_contribute": how_contribute[random.randint(0, len(how_contribute) - 1)],
+        "looking_for": rng.choice(LOOKING_FOR),
+        "how_contribute": rng.choice(HOW_CONTRIBUTE),
         "likes": [],
         "matches": [],
-        "created_at": dt.datetime.now(),
-        "updated_at": dt.datetime.now(),
-        "last_login": dt.datetime.now(),
+        "created_at": created_at,
+        "updated_at": created_at,
+        "last_login": max(created_at, last_login),
         "active": True
-    })
+    }
 
 
-def like_user(user1, user2):
-    # Generate a unique custom _id
-    package_id = ObjectId()
+def out_degree(rng: random.Random) -> int:
+    """
+    Number of users a user swipes, Pareto distributed and cut at max_degree
+    :param rng:
+    :return:
+    """
+    alpha = config["degree_exponent"]
+    degree = config["min_degree"] * (1 - rng.random()) ** (-1 / (alpha - 1))
+
+    return min(int(degree), config["max_degree"])
+
+
+def popular_user(rng: random.Random) -> int:
+    """
+    User that receives a swipe, the user of rank r is picked with probability proportional to r^-s
+    :param rng:
+    :return: user index
+    """
+    users = config["users"]
+    exponent = config["popularity_exponent"]
+    u = rng.random()
+
+    # Inverse of the continuous power-law CDF on [1, users + 1)
+    if exponent == 1:
+        rank = (users + 1) ** u
+    else:
+        rank = (1 + u * ((users + 1) ** (1 - exponent) - 1)) ** (1 / (1 - exponent))
+
+    rank = min(int(rank), users) - 1
+
+    # Spread the popular ranks over the users instead of always the first indexes
+    return (rank * config["permutation"] + config["seed"]) % users
+
+
+def owns_pair(index: int, other: int) -> bool:
+    # Both users may pick each other, only one of them creates the pair so it is never created twice
+    low, high = min(index, other), max(index, other)
+    mixed = ((low * 0x9E3779B97F4A7C15 + high) * 0xBF58476D1CE4E5B9 >> 32) ^ config["seed"]
+
+    return (index == low) == (mixed & 1 == 0)
+
+
+def create_edges(index: int, changes: dict) -> tuple:
+    """
+    Likes, dislikes and matches of one user, like the api creates them
+    :param index: user index
+    :param changes: {user_id: {"likes": [...], "matches": [...], "likes_sent": 1, ...}}, updated in place
+    :return: (likes, matches)
+    """
+    rng = user_random("edges", index)
+    likes = []
+    matches = []
 
-    # Check if the custom _id is already in use (unlikely but possible)
-    while col_likes.find_one({"_id": package_id}):
-        package_id = ObjectId()  # Generate a new custom _id
+    # Half of the picks are owned by the other user, pick twice as many to keep the degree
+    targets = set()
 
-    # Get the user id of the user
-    user1 = col_users.find_one({"username": user1, "active": True})
-    user1_id = user1["_id"]
+    for _ in range(2 * out_degree(rng)):
+        other = popular_user(rng)
 
-    # Get the user id of the liked user
-    user2 = col_users.find_one({"username": user2, "active": True})
-    user2_id = user2["_id"]
+        if other != index and owns_pair(index, other):
+            targets.add(other)
 
-    package = {
-        "_id": package_id,
-        "active": True,
-        "user_id": user1_id,
-        "liked_user_id": user2_id,
-        "created_at": dt.datetime.now(),
-        "deleted_at": None
-    }
+    edge = 0
+    current_id = user_id(index)
 
-    col_likes.insert_one(package)
+    for other in sorted(targets):
+        other_id = user_id(other)
+        created_at = BASE_TIME - dt.timedelta(seconds=rng.randint(0, 30 * 24 * 3600))
+        roll = rng.random()
 
-    # Update the user's likes
-    col_users.update_one({"username": user1, "active": True}, {"$push": {"likes": package_id}})
+        if roll < config["match_ratio"]:
+            # Both users liked each other, the likes are deactivated and the match is created
+            like_ids = [make_id(LIKE_KIND, edge_number(index, edge)), make_id(LIKE_KIND, edge_number(index, edge + 1))]
+            match_id = make_id(MATCH_KIND, edge_number(index, edge))
+            edge += 2
 
-    # Update the liked user's likes
-    col_users.update_one({"username": user2, "active": True }, {"$push": {"likes": package_id}})
+            for like_id, (liker, liked) in zip(like_ids, [(other_id, current_id), (current_id, other_id)]):
+                likes.append({
+                    "_id": like_id,
+                    "active": False,
+                    "is_like": True,
+                    "user_id": liker,
+                    "liked_user_id": liked,
+                    "created_at": created_at,
+                    "deleted_at": created_at
+                })
 
+            matches.append({
+                "_id": match_id,
+                "active": True,
+                "user_id": current_id,
+                "matched_user_id": other_id,
+                "created_at": created_at,
+                "deleted_at": None
+            })
 
-def remove_all_likes():
-    col_likes.delete_many({})
-    for user in col_users.find({}):
-        col_users.update_one({"username": user["username"]}, {"$set": {"likes": []}})
+            for user in (current_id, other_id):
+                changes[user]["likes"] += like_ids
+                changes[user]["matches"].append(match_id)
+                changes[user]["matches_count"] += 1
+            continue
 
+        # Like or dislike that is still waiting
+        is_like = roll >= config["match_ratio"] + config["dislike_ratio"]
+        like_id = make_id(LIKE_KIND, edge_number(index, edge))
+        edge += 1
 
-def remove_all_matches():
-    col_matches.delete_many({})
-    for user in col_users.find({}):
-        col_users.update_one({"username": user["username"]}, {"$set": {"matches": []}})
+        likes.append({
+            "_id": like_id,
+            "active": True,
+            "is_like": is_like,
+            "user_id": current_id,
+            "liked_user_id": other_id,
+            "created_at": created_at,
+            "deleted_at": None
+        })
 
+        changes[current_id]["likes"].append(like_id)
+        changes[other_id]["likes"].append(like_id)
 
-def remove_all_users():
-    col_users.delete_many({})
+        if is_like:
+            changes[current_id]["likes_sent"] += 1
+            changes[other_id]["likes_received"] += 1
 
+    return likes, matches
 
-def match_user(username, matched_username):
-    # Generate a unique custom _id
-    package_id = ObjectId()
 
-    # Check if the custom _id is already in use (unlikely but possible)
-    while col_likes.find_one({"_id": package_id}):
-        package_id = ObjectId()  # Generate a new custom _id
+def insert_batches(collection, documents: list) -> int:
+    # Unordered so the server can spread the batch, ids are fixed so nothing is sent twice
+    for start in range(0, len(documents), config["batch_size"]):
+        collection.insert_many(documents[start:start + config["batch_size"]], ordered=False)
 
-    # Get the user id of the user
-    user = col_users.find_one({"username": username})
-    user_id = user["_id"]
+    return len(documents)
 
-    # Get the user id of the matched user
-    matched_user = col_users.find_one({"username": matched_username})
-    matched_user_id = matched_user["_id"]
 
-    package = {
-        "_id": package_id,
-        "active": True,
-        "user_id": user_id,
-        "matched_user_id": matched_user_id,
-        "created_at": dt.datetime.now(),
-        "deleted_at": None
-    }
+def connect():
+    return pymongo.MongoClient(config["uri"])[config["database"]]
+
+
+def init_worker(settings: dict):
+    global config, db
 
-    col_matches.insert_one(package)
+    config = settings
+    db = connect()
 
-    # Update the user's matches
-    col_users.update_one({"username": username}, {"$push": {"matches": package_id}})
 
-    # Update the matched user's matches
-    col_users.update_one({"username": matched_username}, {"$push": {"matches": package_id}})
+def load_users(block: int) -> int:
+    start = block * config["block_size"]
+    end = min(start + config["block_size"], config["users"])
 
+    return insert_batches(db["users"], [create_user(index) for index in range(start, end)])
 
-def create_random_likes(username="Al1babax"):
-    all_users = list(col_users.find({}))
 
-    # Generate 10 likes for the user
-    ten_usernames = [user["username"] for user in all_users[1:11]]
+def load_edges(block: int) -> int:
+    start = block * config["block_size"]
+    end = min(start + config["block_size"], config["users"])
 
-    # user likes 10 users
-    for liked_username in ten_usernames:
-        like_user(username, liked_username)
+    changes = defaultdict(lambda: defaultdict(int, likes=[], matches=[]))
+    likes = []
+    matches = []
 
-    # Generate next 10 likes for the user
-    ten_usernames = [user["username"] for user in all_users[11:21]]
+    for index in range(start, end):
+        user_likes, user_matches = create_edges(index, changes)
+        likes += user_likes
+        matches += user_matches
 
-    # 10 users like the user
-    for liked_username in ten_usernames:
-        like_user(liked_username, username)
+    inserted = insert_batches(db["likes"], likes) + insert_batches(db["matches"], matches)
 
+    # Push the new ids to both users and add to the counters, $inc adds up whatever block runs first
+    user_updates = []
+    counter_updates = []
 
-def create_random_matches(username="Al1babax"):
-    all_users = list(col_users.find({}))
+    for changed_id, change in changes.items():
+        user_updates.append(UpdateOne({"_id": changed_id}, {"$push": {"likes": {"$each": change["likes"]},
+                                                                      "matches": {"$each": change["matches"]}}}))
 
-    # Generate 10 matches for the user
-    ten_usernames = [user["username"] for user in all_users[30:40]]
+        increments = {"likes_sent": change["likes_sent"], "likes_received": change["likes_received"],
+                      "matches": change["matches_count"]}
+        increments = {field: value for field, value in increments.items() if value != 0}
 
-    # user matches 10 users
-    for matched_username in ten_usernames:
-        match_user(username, matched_username)
+        if increments:
+            counter_updates.append(UpdateOne({"_id": changed_id}, {"$inc": increments}, upsert=True))
+
+    for collection, operations in (("users", user_updates), ("counters", counter_updates)):
+        for batch_start in range(0, len(operations), config["batch_size"]):
+            db[collection].bulk_write(operations[batch_start:batch_start + config["batch_size"]], ordered=False)
+
+    return inserted
+
+
+def run_phase(name: str, function, blocks: int) -> int:
+    start = time.perf_counter()
+
+    if config["workers"] == 1:
+        documents = sum(map(function, range(blocks)))
+    else:
+        with multiprocessing.Pool(config["workers"], initializer=init_worker, initargs=(config,)) as pool:
+            documents = sum(pool.imap_unordered(function, range(blocks)))
+
+    elapsed = time.perf_counter() - start
+    print(f"{name:<6} {documents:>10} documents {elapsed:>8.1f} s {documents / elapsed if elapsed else 0:>10.0f} docs/s")
+
+    return documents
+
+
+def create_data(settings: dict, database=None) -> int:
+    """
+    Loads the users and then their edges, the edges need every user to exist
+    :param settings: parsed arguments as a dict, see default_settings
+    :param database: pymongo or mongomock database to load instead of connecting to the uri, only with one worker
+    :return: number of documents inserted
+    """
+    global config, db
+
+    if database is not None and settings["workers"] != 1:
+        raise ValueError("A given database can only be loaded with one worker")
+
+    config = settings
+    db = database if database is not None else connect()
+
+    # Multiplier of the popularity permutation has to be coprime with the number of users
+    permutation = PERMUTATION_PRIME % config["users"] or 1
+
+    while math.gcd(permutation, config["users"]) != 1:
+        permutation += 1
+
+    config["permutation"] = permutation
+
+    if config["drop"]:
+        for collection in ("users", "likes", "matches", "counters"):
+            db[collection].drop()
+
+    blocks = math.ceil(config["users"] / config["block_size"])
+    start = time.perf_counter()
+
+    documents = run_phase("users", load_users, blocks)
+    documents += run_phase("edges", load_edges, blocks)
+
+    elapsed = time.perf_counter() - start
+    print(f"{'total':<6} {documents:>10} documents {elapsed:>8.1f} s {documents / elapsed:>10.0f} docs/s")
+
+    return documents
 
 
 def get_database_uri():
@@ -172,22 +354,56 @@ def get_database_uri():
     return os.getenv("MONGO_URI")
 
 
-if __name__ == '__main__':
-    client = pymongo.MongoClient(get_database_uri())
-    db = client["codespark"]
-    col_users = db["users"]
-    col_likes = db["likes"]
-    col_matches = db["matches"]
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Creates synthetic users, likes and matches")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=1000, help="documents per insert_many")
+    parser.add_argument("--block-size", type=int, default=10000, help="users per worker task")
+    parser.add_argument("--min-degree", type=float, default=2, help="fewest users a user swipes")
+    parser.add_argument("--max-degree", type=int, default=1000, help="most users a user swipes")
+    parser.add_argument("--degree-exponent", type=float, default=2.5,
+                        help="power-law exponent of the swipes per user, above 1, smaller gives heavier users")
+    parser.add_argument("--popularity-exponent", type=float, default=0.8,
+                        help="power-law exponent of the swipes received, 0 picks users uniformly")
+    parser.add_argument("--match-ratio", type=float, default=0.15)
+    parser.add_argument("--dislike-ratio", type=float, default=0.3)
+    parser.add_argument("--database", default="codespark")
+    parser.add_argument("--uri", default=None, help="MONGO_URI by default")
+    parser.add_argument("--drop", action="store_true", help="drops users, likes, matches and counters first")
+
+    return parser
+
 
-    # remove_all_matches()
-    # remove_all_likes()
-    # remove_all_users()
-    # exit(0)
+def default_settings(**overrides) -> dict:
+    """
+    Settings of the command line defaults, for scripts that load data themselves
+    :param overrides: e.g. users=1000, workers=1
+    :return:
+    """
+    settings = vars(build_parser().parse_args([]))
+    settings.update(overrides)
 
-    # Generate 100 users
-    for i in range(100):
-        create_user(f"user{i}")
+    return settings
 
-    create_random_likes()
 
-    create_random_matches()
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.degree_exponent <= 1:
+        parser.error("--degree-exponent has to be above 1")
+
+    # A user creates at most two likes per pick and picks twice the degree
+    if 4 * args.max_degree >= 1 << EDGE_BITS:
+        parser.error(f"--max-degree has to be below {(1 << EDGE_BITS) // 4}")
+
+    settings = vars(args)
+    settings["uri"] = args.uri or get_database_uri()
+
+    create_data(settings)
+
+
+if __name__ == '__main__':
+    main()
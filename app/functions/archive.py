@@ -0,0 +1,227 @@
+"""
+Moves likes and matches that were deactivated long ago out of the hot collections into likes_archive and
+matches_archive, in batches. Every batch is copied, unlinked from the users and then deleted, each step can be
+repeated, so a run that stops half way is finished by the next one:
+    python -m functions.archive run --days 90
+    python -m functions.archive run --days 90 --every 3600
+    python -m functions.archive history <username>
+Active likes, dislikes and matches are never archived
+"""
+import argparse
+import asyncio
+import datetime as dt
+import sys
+import time
+from collections import defaultdict
+
+import pymongo
+from pymongo import ReplaceOne, UpdateOne
+
+from utils import database
+
+# Hot collection, its archive and the fields that point to the users who link the document
+ARCHIVES = {
+    "likes": ("likes_archive", ("user_id", "liked_user_id")),
+    "matches": ("matches_archive", ("user_id", "matched_user_id"))
+}
+
+
+def history_pipeline(collection: str, query: dict, archive_query: dict = None, sort: list = None) -> list:
+    """
+    Aggregation over the hot collection and its archive, for reads that need deactivated documents too
+    :param collection: likes or matches
+    :param query:
+    :param archive_query: query of the archive when the hot one can not use its indexes there, the query by default
+    :param sort: e.g. [("created_at", pymongo.DESCENDING)]
+    :return:
+    """
+    archive, _ = ARCHIVES[collection]
+
+    pipeline = [
+        {"$match": query},
+        {"$unionWith": {"coll": archive, "pipeline": [{"$match": archive_query if archive_query else query}]}},
+        # A batch that was copied but not deleted yet is in both, the hot document comes first
+        {"$group": {"_id": "$_id", "document": {"$first": "$$ROOT"}}},
+        {"$replaceRoot": {"newRoot": "$document"}}
+    ]
+
+    if sort:
+        pipeline.append({"$sort": dict(sort)})
+
+    return pipeline
+
+
+async def find_history(db, collection: str, query: dict, archive_query: dict = None, sort: list = None) -> list:
+    """
+    Documents of the query from the hot collection and its archive
+    :param db:
+    :param collection: likes or matches
+    :param query:
+    :param archive_query:
+    :param sort:
+    :return:
+    """
+    pipeline = history_pipeline(collection, query, archive_query, sort)
+
+    return await db[collection].aggregate(pipeline).to_list(length=None)
+
+
+class InteractionArchiver:
+
+    def __init__(self, db, older_than: dt.timedelta = dt.timedelta(days=90), batch_size: int = 500,
+                 max_per_second: float = 2000, dry_run: bool = False):
+        self.db = db
+
+        self.col_users = self.db["users"]
+
+        self.older_than = older_than
+        self.batch_size = batch_size
+        self.max_per_second = max_per_second
+        self.dry_run = dry_run
+
+    def archivable(self, cutoff: dt.datetime) -> dict:
+        # Uses the partial index of the inactive documents
+        return {"active": False, "deleted_at": {"$lt": cutoff}}
+
+    async def archive_batch(self, collection: str, documents: list, now: dt.datetime) -> int:
+        """
+        Copies the documents to the archive, removes their ids from the users and deletes them
+        :param collection:
+        :param documents:
+        :param now:
+        :return: number of deleted documents
+        """
+        archive, user_fields = ARCHIVES[collection]
+        ids = [document["_id"] for document in documents]
+
+        # Replace instead of insert, a document copied by a stopped run is copied again
+        await self.db[archive].bulk_write([ReplaceOne({"_id": document["_id"]}, {**document, "archived_at": now},
+                                                      upsert=True) for document in documents], ordered=False)
+
+        # Ids to remove per user, deleted users too
+        unlinked = defaultdict(list)
+
+        for document in documents:
+            for field in user_fields:
+                unlinked[document[field]].append(document["_id"])
+
+        await self.col_users.bulk_write([UpdateOne({"_id": user_id}, {"$pull": {collection: {"$in": user_ids}}})
+                                         for user_id, user_ids in unlinked.items()], ordered=False)
+
+        # Deleted last, until then the documents are still found where they were
+        result = await self.db[collection].delete_many({"_id": {"$in": ids}, "active": False})
+
+        return result.deleted_count
+
+    async def archive_collection(self, collection: str, cutoff: dt.datetime) -> dict:
+        """
+        Archives every document of the collection deactivated before the cutoff
+        :param collection:
+        :param cutoff:
+        :return: report of the collection
+        """
+        if self.dry_run:
+            return {"found": await self.db[collection].count_documents(self.archivable(cutoff)), "archived": 0}
+
+        now = dt.datetime.now()
+        found = 0
+        archived = 0
+
+        while True:
+            start = time.monotonic()
+
+            # Oldest first, archived documents leave the query so the next batch starts where this one ended
+            documents = await self.db[collection].find(self.archivable(cutoff)) \
+                .sort("deleted_at", pymongo.ASCENDING).limit(self.batch_size).to_list(length=None)
+
+            if not documents:
+                return {"found": found, "archived": archived}
+
+            found += len(documents)
+            archived += await self.archive_batch(collection, documents, now)
+
+            # Rate limit, the database is shared with the api
+            if self.max_per_second > 0:
+                await asyncio.sleep(max(len(documents) / self.max_per_second - (time.monotonic() - start), 0))
+
+    async def run(self) -> dict:
+        """
+        Archives the likes and the matches deactivated before older_than ago
+        :return: report per collection
+        """
+        cutoff = dt.datetime.now() - self.older_than
+
+        return {collection: await self.archive_collection(collection, cutoff) for collection in ARCHIVES}
+
+
+async def print_history(db, username: str):
+    user = await db["users"].find_one({"username": username, "active": True}, {"likes": 1, "matches": 1})
+
+    if user is None:
+        print(f"User {username} does not exist")
+        return 1
+
+    for collection, (_, user_fields) in ARCHIVES.items():
+        # The user links every document still in the hot collection, the archive is found by the user fields
+        query = {"_id": {"$in": user.get(collection, [])}}
+        archive_query = {"$or": [{field: user["_id"]} for field in user_fields]}
+
+        history = await find_history(db, collection, query, archive_query, [("created_at", pymongo.ASCENDING)])
+
+        for document in history:
+            state = "active" if document["active"] else f"deleted {document['deleted_at']}"
+            where = "archive" if "archived_at" in document else collection
+
+            print(f"{collection:<8} {document['_id']} {document['created_at']} {state:<35} {where}")
+
+    return 0
+
+
+async def run(args) -> int:
+    client = database.create_async_client()
+    db = client["codespark"]
+
+    try:
+        if args.command == "history":
+            return await print_history(db, args.username)
+
+        archiver = InteractionArchiver(db, older_than=dt.timedelta(days=args.days), batch_size=args.batch_size,
+                                       max_per_second=args.max_per_second, dry_run=args.dry_run)
+
+        while True:
+            try:
+                print(await archiver.run())
+            except pymongo.errors.PyMongoError as e:
+                # Nothing is lost, the next run picks up where this one stopped
+                print(f"Archiving failed: {e}")
+
+                if args.every is None:
+                    return 1
+
+            if args.every is None:
+                return 0
+
+            await asyncio.sleep(args.every)
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archives old inactive likes and matches")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="move old inactive likes and matches to the archive")
+    run_parser.add_argument("--days", type=float, default=90, help="archive what was deactivated before this")
+    run_parser.add_argument("--batch-size", type=int, default=500)
+    run_parser.add_argument("--max-per-second", type=float, default=2000)
+    run_parser.add_argument("--dry-run", action="store_true", help="only count what would be archived")
+    run_parser.add_argument("--every", type=float, default=None, help="keep running, seconds between runs")
+
+    history_parser = subparsers.add_parser("history", help="every like and match of a user, archived ones too")
+    history_parser.add_argument("username")
+
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Deactivates the likes, matches and sessions of deleted users in batches, after the delete request has returned.
+Deleted users are marked cascade_pending until their edges are done, so a crash only delays the cascade:
+    python -m functions.cascade
+finishes every pending cascade, the api does the same on start
+"""
+import asyncio
+import contextvars
+import datetime
+import os
+
+import pymongo
+from dotenv import load_dotenv
+
+
+class DeactivationCascade:
+
+    def __init__(self, db, batch_size: int = 500, background: bool = True):
+        self.db = db
+        self.batch_size = batch_size
+        self.background = background
+
+        self.col_users = self.db["users"]
+        self.col_likes = self.db["likes"]
+        self.col_matches = self.db["matches"]
+        self.col_sessions = self.db["sessions"]
+
+        # Running cascades, kept so they are not garbage collected and can be waited for on shutdown
+        self.tasks = set()
+
+    async def schedule(self, user_id):
+        """
+        Starts the cascade of a deleted user, in the background unless background is False
+        :param user_id:
+        :return:
+        """
+        if not self.background:
+            await self.run(user_id)
+            return
+
+        # Empty context, the queries of the cascade do not belong to the request that deleted the user
+        task = contextvars.Context().run(asyncio.create_task, self.run_logged(user_id))
+
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run_logged(self, user_id):
+        try:
+            await self.run(user_id)
+        except pymongo.errors.PyMongoError as e:
+            # The user stays pending and is picked up again on the next start
+            print(f"Cascade of user {user_id} failed: {e}")
+
+    async def run(self, user_id) -> dict:
+        """
+        Deactivates every active edge and session of the user, safe to run more than once
+        :param user_id:
+        :return: number of deactivated documents per collection
+        """
+        now = datetime.datetime.now()
+
+        # One field at a time so every query can use the partial indexes
+        report = {
+            "likes": await self.deactivate(self.col_likes, {"user_id": user_id}, now) +
+            await self.deactivate(self.col_likes, {"liked_user_id": user_id}, now),
+            "matches": await self.deactivate(self.col_matches, {"user_id": user_id}, now) +
+            await self.deactivate(self.col_matches, {"matched_user_id": user_id}, now),
+            "sessions": await self.deactivate(self.col_sessions, {"user_id": user_id}, now, "last_used")
+        }
+
+        await self.col_users.update_one({"_id": user_id}, {"$unset": {"cascade_pending": ""}})
+
+        return report
+
+    async def deactivate(self, collection, query: dict, now: datetime.datetime, time_field: str = "deleted_at") -> int:
+        """
+        Deactivates the active documents of the query, batch_size at a time
+        :param collection:
+        :param query:
+        :param now: time of the deletion
+        :param time_field: field set to the time of the deletion
+        :return: number of deactivated documents
+        """
+        deactivated = 0
+
+        while True:
+            batch = collection.find({**query, "active": True}, {"_id": 1}).limit(self.batch_size)
+            ids = [document["_id"] async for document in batch]
+
+            if not ids:
+                return deactivated
+
+            result = await collection.update_many({"_id": {"$in": ids}, "active": True},
+                                                  {"$set": {"active": False, time_field: now}})
+            deactivated += result.modified_count
+
+    async def resume(self) -> int:
+        """
+        Starts the cascades left pending by a crash or a restart
+        :return: number of started cascades
+        """
+        user_ids = [user["_id"] async for user in self.col_users.find({"cascade_pending": True}, {"_id": 1})]
+
+        for user_id in user_ids:
+            await self.schedule(user_id)
+
+        return len(user_ids)
+
+    async def drain(self, timeout: float = 10):
+        """
+        Waits for the running cascades, the ones that do not finish in time are resumed on the next start
+        :param timeout:
+        :return:
+        """
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=timeout)
+
+
+async def resume_pending():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv()
+    client = AsyncIOMotorClient(os.getenv("MONGO_URI"))
+
+    try:
+        started = await DeactivationCascade(client["codespark"], background=False).resume()
+        print(f"Finished {started} pending cascades")
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(resume_pending())
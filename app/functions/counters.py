@@ -0,0 +1,210 @@
+""" Per-user badge counters (likes you, your likes and matches) """
+import asyncio
+import os
+from collections import defaultdict
+
+import pymongo
+from pymongo import UpdateOne
+from dotenv import load_dotenv
+
+# Fields kept in every counter document
+COUNTER_FIELDS = ["likes_received", "likes_sent", "matches"]
+
+
+class Counters:
+
+    def __init__(self, db):
+        self.db = db
+
+        self.col_counters = self.db["counters"]
+        self.col_users = self.db["users"]
+        self.col_likes = self.db["likes"]
+        self.col_matches = self.db["matches"]
+
+    async def apply(self, changes: dict):
+        """
+        Applies counter changes atomically with $inc, one upserted document per user
+        :param changes: {user_id: {"likes_sent": 1, ...}}
+        :return:
+        """
+        # Build one $inc per user, skip users without any change
+        operations = []
+
+        for user_id, increments in changes.items():
+            increments = {field: value for field, value in increments.items() if value != 0}
+
+            if not increments:
+                continue
+
+            operations.append(UpdateOne({"_id": user_id}, {"$inc": increments}, upsert=True))
+
+        if not operations:
+            return
+
+        await self.col_counters.bulk_write(operations, ordered=False)
+
+    async def like(self, user_id, liked_user_id, delta: int = 1):
+        """
+        User likes another user, negative delta when the like is deactivated
+        :param user_id:
+        :param liked_user_id:
+        :param delta:
+        :return:
+        """
+        await self.apply({
+            user_id: {"likes_sent": delta},
+            liked_user_id: {"likes_received": delta}
+        })
+
+    async def match(self, user1_id, user2_id, delta: int = 1):
+        """
+        Users matched, negative delta when the match is deactivated
+        :param user1_id:
+        :param user2_id:
+        :return:
+        """
+        await self.apply({
+            user1_id: {"matches": delta},
+            user2_id: {"matches": delta}
+        })
+
+    async def delete_user(self, user_id):
+        """
+        Removes the counters of a deactivated user and takes their active likes and matches
+        out of the counters of the other users
+        :param user_id:
+        :return:
+        """
+        changes = defaultdict(lambda: defaultdict(int))
+
+        # Active likes given or received by the user and active matches of the user,
+        # one query per field so each can use the partial indexes
+        likes_sent, likes_received, matches, matched = await asyncio.gather(
+            self.col_likes.find({"user_id": user_id, "active": True, "is_like": True},
+                                {"user_id": 1, "liked_user_id": 1}).to_list(length=None),
+            self.col_likes.find({"liked_user_id": user_id, "active": True, "is_like": True},
+                                {"user_id": 1, "liked_user_id": 1}).to_list(length=None),
+            self.col_matches.find({"user_id": user_id, "active": True},
+                                  {"user_id": 1, "matched_user_id": 1}).to_list(length=None),
+            self.col_matches.find({"matched_user_id": user_id, "active": True},
+                                  {"user_id": 1, "matched_user_id": 1}).to_list(length=None)
+        )
+
+        # A like or match with the user on both sides is only counted once
+        likes = list({like["_id"]: like for like in likes_sent + likes_received}.values())
+        matches = list({match["_id"]: match for match in matches + matched}.values())
+
+        for like in likes:
+            if like["user_id"] == user_id:
+                changes[like["liked_user_id"]]["likes_received"] -= 1
+            else:
+                changes[like["user_id"]]["likes_sent"] -= 1
+
+        for match in matches:
+            other_id = match["matched_user_id"] if match["user_id"] == user_id else match["user_id"]
+            changes[other_id]["matches"] -= 1
+
+        # The user itself has no counters anymore
+        changes.pop(user_id, None)
+        await self.col_counters.delete_one({"_id": user_id})
+
+        await self.apply(changes)
+
+    async def get_counts(self, user_id) -> dict:
+        """
+        Gets the counters of one user, missing counters are zero
+        :param user_id:
+        :return:
+        """
+        counters = await self.col_counters.find_one({"_id": user_id}) or {}
+
+        return {field: max(counters.get(field, 0), 0) for field in COUNTER_FIELDS}
+
+    async def reconcile(self, batch_size: int = 1000) -> dict:
+        """
+        Recounts every counter from the likes and matches collections and repairs the ones that drifted.
+        Only edges between two active users are counted, same as the listings
+        :param batch_size:
+        :return: report of checked and repaired counters
+        """
+        # Ids of all active users
+        active_ids = set([user["_id"] async for user in self.col_users.find({"active": True}, {"_id": 1})])
+
+        expected = defaultdict(lambda: dict.fromkeys(COUNTER_FIELDS, 0))
+
+        # Count active likes
+        async for like in self.col_likes.find({"active": True, "is_like": True}, {"user_id": 1, "liked_user_id": 1}):
+            if like["user_id"] not in active_ids or like["liked_user_id"] not in active_ids:
+                continue
+
+            expected[like["user_id"]]["likes_sent"] += 1
+            expected[like["liked_user_id"]]["likes_received"] += 1
+
+        # Count active matches
+        async for match in self.col_matches.find({"active": True}, {"user_id": 1, "matched_user_id": 1}):
+            if match["user_id"] not in active_ids or match["matched_user_id"] not in active_ids:
+                continue
+
+            expected[match["user_id"]]["matches"] += 1
+            expected[match["matched_user_id"]]["matches"] += 1
+
+        checked = 0
+        repaired = 0
+        removed = 0
+        operations = []
+
+        # Compare stored counters with the expected ones
+        async for counters in self.col_counters.find({}):
+            checked += 1
+
+            # Counters of users that are not active anymore
+            if counters["_id"] not in active_ids:
+                operations.append(pymongo.DeleteOne({"_id": counters["_id"]}))
+                removed += 1
+                continue
+
+            target = expected.pop(counters["_id"], dict.fromkeys(COUNTER_FIELDS, 0))
+
+            if any(counters.get(field, 0) != target[field] for field in COUNTER_FIELDS):
+                operations.append(UpdateOne({"_id": counters["_id"]}, {"$set": target}))
+                repaired += 1
+
+            if len(operations) >= batch_size:
+                await self.col_counters.bulk_write(operations, ordered=False)
+                operations = []
+
+        # Users that have edges but no counter document yet
+        for user_id, target in expected.items():
+            operations.append(UpdateOne({"_id": user_id}, {"$set": target}, upsert=True))
+            repaired += 1
+
+            if len(operations) >= batch_size:
+                await self.col_counters.bulk_write(operations, ordered=False)
+                operations = []
+
+        if operations:
+            await self.col_counters.bulk_write(operations, ordered=False)
+
+        return {"checked": checked, "repaired": repaired, "removed": removed}
+
+
+async def reconcile():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv()
+    client = AsyncIOMotorClient(os.getenv("MONGO_URI"))
+    db = client["codespark"]
+
+    # Repair counters that drifted from the source collections
+    report = await Counters(db).reconcile()
+    print(report)
+
+    client.close()
+
+
+def main():
+    asyncio.run(reconcile())
+
+
+if __name__ == '__main__':
+    main()
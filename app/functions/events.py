@@ -0,0 +1,162 @@
+""" In-process event bus for live likes and matches, streamed to clients as server-sent events """
+import asyncio
+import json
+from collections import deque
+
+
+class Subscription:
+    """
+    One open event stream. Kept small on purpose, an idle connection is only this object
+    and the response generator waiting on the event
+    """
+    __slots__ = ("key", "buffer", "dropped", "waiter")
+
+    def __init__(self, key: str, max_buffer: int):
+        self.key = key
+        self.buffer = deque(maxlen=max_buffer)
+        self.dropped = 0
+        self.waiter = asyncio.Event()
+
+    def push(self, event: str, data: dict):
+        # When the buffer is full the oldest event falls out, the client is told to resync
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+
+        self.buffer.append((event, data))
+        self.waiter.set()
+
+    def drain(self) -> list:
+        events = list(self.buffer)
+        self.buffer.clear()
+        self.waiter.clear()
+
+        # Missed events, client has to refetch its lists
+        if self.dropped:
+            events.append(("resync", {"dropped": self.dropped}))
+            self.dropped = 0
+
+        return events
+
+
+class EventBus:
+
+    def __init__(self, max_buffer: int = 32, heartbeat: float = 15.0, max_connections_per_user: int = 5):
+        self.max_buffer = max_buffer
+        self.heartbeat = heartbeat
+        self.max_connections_per_user = max_connections_per_user
+
+        self.subscriptions = {}
+        self.loop = None
+
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, key) -> Subscription:
+        """
+        Opens a subscription for the user, None if the user has too many open streams
+        :param key: user id
+        :return:
+        """
+        key = str(key)
+
+        # Events are delivered on the loop that serves the streams
+        self.loop = asyncio.get_running_loop()
+
+        subscriptions = self.subscriptions.setdefault(key, set())
+
+        if len(subscriptions) >= self.max_connections_per_user:
+            return None
+
+        subscription = Subscription(key, self.max_buffer)
+        subscriptions.add(subscription)
+
+        return subscription
+
+    def is_full(self, key) -> bool:
+        # The user has as many open streams as allowed
+        return len(self.subscriptions.get(str(key), ())) >= self.max_connections_per_user
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscriptions.get(subscription.key)
+
+        if subscriptions is None:
+            return
+
+        subscriptions.discard(subscription)
+
+        if not subscriptions:
+            del self.subscriptions[subscription.key]
+
+    def is_subscribed(self, key) -> bool:
+        return str(key) in self.subscriptions
+
+    def connection_count(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+
+    def publish(self, key, event: str, data: dict):
+        """
+        Publishes an event to every open stream of the user. Safe to call from worker threads
+        :param key: user id
+        :param event: event name
+        :param data: json serializable payload
+        :return:
+        """
+        key = str(key)
+
+        # Nobody listening, nothing to do
+        if key not in self.subscriptions or self.loop is None:
+            return
+
+        self.published += 1
+
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self.loop:
+            self._deliver(key, event, data)
+        else:
+            self.loop.call_soon_threadsafe(self._deliver, key, event, data)
+
+    def _deliver(self, key: str, event: str, data: dict):
+        for subscription in self.subscriptions.get(key, ()):
+            subscription.push(event, data)
+            self.delivered += 1
+
+    async def stream(self, key):
+        """
+        Yields the server-sent events of the user, heartbeat comments keep idle proxies open.
+        The subscription is opened when the stream starts, so a response that is never sent holds nothing
+        :param key: user id
+        :return:
+        """
+        subscription = self.subscribe(key)
+
+        # Another stream of the user opened since the endpoint checked
+        if subscription is None:
+            yield f"event: error\ndata: {json.dumps({'message': 'Too many open event streams'})}\n\n"
+            return
+
+        try:
+            yield "retry: 5000\n\n"
+
+            while True:
+                try:
+                    await asyncio.wait_for(subscription.waiter.wait(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+
+                for event, data in subscription.drain():
+                    yield f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self) -> dict:
+        return {
+            "connections": self.connection_count(),
+            "users": len(self.subscriptions),
+            "published": self.published,
+            "delivered": self.delivered
+        }
@@ -0,0 +1,107 @@
+""" Byte budgeted LRU of hot image files in front of the file system """
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+
+class ImageCache:
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_entry_bytes: int = 1024 * 1024, use_mmap: bool = False):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.use_mmap = use_mmap
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path: str):
+        """
+        Gets a cached file
+        :param path:
+        :return: (data, stat result) or None, data is bytes or a read only memory map
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(path)
+            self.hits += 1
+
+            return entry
+
+    def contains(self, path: str) -> bool:
+        # Lookup without counting a hit or a miss, the read that follows counts
+        with self.lock:
+            return path in self.entries
+
+    def accepts(self, size: int) -> bool:
+        # Big originals are streamed from disk, only avatars and thumbnails are cached
+        return size <= self.max_entry_bytes
+
+    def load(self, path: str, stat_result: os.stat_result):
+        """
+        Reads the file and caches it. Blocking, run it in the threadpool
+        :param path:
+        :param stat_result:
+        :return: data of the file
+        """
+        with open(path, "rb") as file:
+            if self.use_mmap and stat_result.st_size > 0:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = file.read()
+
+        with self.lock:
+            if path in self.entries:
+                self._remove(path)
+
+            self.entries[path] = (data, stat_result)
+            self.bytes += stat_result.st_size
+
+            # Evict the least recently used files until the budget holds
+            while self.bytes > self.max_bytes and self.entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+        return data
+
+    def invalidate(self, name: str):
+        """
+        Drops every cached file whose name starts with the given name, a blob and all of its variants
+        :param name: file name or content hash
+        :return:
+        """
+        with self.lock:
+            for path in [path for path in self.entries if os.path.basename(path).startswith(name)]:
+                self._remove(path)
+
+    def clear(self):
+        with self.lock:
+            for path in list(self.entries):
+                self._remove(path)
+
+    def _remove(self, path: str):
+        # Memory maps are closed when the last response using them lets go
+        data, stat_result = self.entries.pop(path)
+        self.bytes -= stat_result.st_size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
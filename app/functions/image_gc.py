@@ -0,0 +1,172 @@
+""" Garbage collector for profile pictures that no active profile references anymore """
+import argparse
+import datetime as dt
+import os
+import time
+
+import pymongo
+from dotenv import load_dotenv
+
+from functions.image_storage import ImageStorage
+
+
+class ImageGarbageCollector:
+
+    def __init__(self, db, storage: ImageStorage = None, grace_period: dt.timedelta = dt.timedelta(days=1),
+                 batch_size: int = 500, max_per_second: float = 200, archive_directory: str = None,
+                 dry_run: bool = False):
+        self.db = db
+
+        self.col_users = self.db["users"]
+        self.storage = storage if storage is not None else ImageStorage()
+
+        self.grace_period = grace_period
+        self.batch_size = batch_size
+        self.max_per_second = max_per_second
+        self.archive_directory = archive_directory
+        self.dry_run = dry_run
+
+    def referenced_stems(self) -> set:
+        """
+        File names without extension of every picture an active profile points to
+        :return:
+        """
+        stems = set()
+
+        users = self.col_users.find({"active": True, "profile_picture": {"$nin": ["", None]}}, {"profile_picture": 1})
+
+        for user in users:
+            file_name = user["profile_picture"].rsplit("/", 1)[-1]
+            stems.add(file_name.rsplit(".", 1)[0])
+
+        return stems
+
+    @staticmethod
+    def is_referenced(file_name: str, stems: set) -> bool:
+        stem = file_name.rsplit(".", 1)[0]
+
+        if stem in stems:
+            return True
+
+        # Variants are named {stem}_{size}
+        base, _, size = stem.rpartition("_")
+
+        return size.isdigit() and base in stems
+
+    def find_candidates(self):
+        """
+        Files past the grace period, recently written or deduplicated files are never touched
+        :return: generator of (file name, path, size)
+        """
+        cutoff = time.time() - self.grace_period.total_seconds()
+
+        for file_name, path in self.storage.iter_files():
+            try:
+                stat_result = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            if stat_result.st_mtime > cutoff:
+                continue
+
+            yield file_name, path, stat_result.st_size
+
+    def collect(self, batch: list) -> tuple:
+        """
+        Deletes or archives one batch, references are read again right before so new uploads are safe
+        :param batch:
+        :return: (files removed, bytes reclaimed)
+        """
+        stems = self.referenced_stems()
+
+        removed = 0
+        reclaimed = 0
+
+        for file_name, path, size in batch:
+            # Unfinished uploads only have the temporary suffix
+            if not file_name.endswith(".part") and self.is_referenced(file_name, stems):
+                continue
+
+            removed += 1
+            reclaimed += size
+
+            if self.dry_run:
+                continue
+
+            try:
+                if self.archive_directory is not None:
+                    # Keep the shard layout in the archive
+                    relative_path = os.path.relpath(path, self.storage.root)
+                    os.renames(path, os.path.join(self.archive_directory, relative_path))
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                removed -= 1
+                reclaimed -= size
+
+        return removed, reclaimed
+
+    def run(self) -> dict:
+        """
+        Collects every orphaned file in batches, sleeps between batches to stay under max_per_second
+        :return: report
+        """
+        scanned = 0
+        removed = 0
+        reclaimed = 0
+
+        batch = []
+
+        for candidate in self.find_candidates():
+            scanned += 1
+            batch.append(candidate)
+
+            if len(batch) >= self.batch_size:
+                removed, reclaimed = self.run_batch(batch, removed, reclaimed)
+                batch = []
+
+        if batch:
+            removed, reclaimed = self.run_batch(batch, removed, reclaimed)
+
+        return {
+            "scanned": scanned,
+            "removed": removed,
+            "reclaimed_bytes": reclaimed,
+            "archived": self.archive_directory is not None,
+            "dry_run": self.dry_run
+        }
+
+    def run_batch(self, batch: list, removed: int, reclaimed: int) -> tuple:
+        start = time.monotonic()
+
+        batch_removed, batch_reclaimed = self.collect(batch)
+
+        # Rate limit, the disk is shared with the api
+        if not self.dry_run and self.max_per_second > 0:
+            time.sleep(max(batch_removed / self.max_per_second - (time.monotonic() - start), 0))
+
+        return removed + batch_removed, reclaimed + batch_reclaimed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Removes profile pictures no active profile references")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be removed")
+    parser.add_argument("--archive", default=None, help="move the files here instead of deleting them")
+    parser.add_argument("--grace-hours", type=float, default=24)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--max-per-second", type=float, default=200)
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = pymongo.MongoClient(os.getenv("MONGO_URI"))
+    db = client["codespark"]
+
+    collector = ImageGarbageCollector(db, grace_period=dt.timedelta(hours=args.grace_hours),
+                                      batch_size=args.batch_size, max_per_second=args.max_per_second,
+                                      archive_directory=args.archive, dry_run=args.dry_run)
+
+    print(collector.run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+""" Resized WebP and JPEG variants of the profile pictures, made in a process pool after upload """
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.uploads import write_atomic
+from functions.image_storage import ImageStorage
+
+# Square sizes of the variants in pixels
+VARIANT_SIZES = [64, 256, 512]
+
+# Variant formats by file extension and their encoder settings
+VARIANT_FORMATS = {
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpg": ("JPEG", {"quality": 85, "optimize": True, "progressive": True})
+}
+
+
+def variant_file_name(file_name: str, size: int, extension: str) -> str:
+    stem = file_name.rsplit(".", 1)[0]
+    return f"{stem}_{size}.{extension}"
+
+
+def generate_variants(file_name: str, storage: ImageStorage) -> list:
+    """
+    Makes every variant of one image. Runs in a worker process.
+    Metadata is not copied to the variants, EXIF orientation is applied before it is dropped
+    :param file_name:
+    :param storage:
+    :return: file names of the variants
+    """
+    from PIL import Image, ImageOps
+
+    created = []
+
+    with Image.open(storage.path(file_name)) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+
+        for size in VARIANT_SIZES:
+            # Square crop from the center, avatars are shown square
+            variant = ImageOps.fit(image, (size, size), Image.LANCZOS)
+
+            for extension, (image_format, options) in VARIANT_FORMATS.items():
+                buffer = io.BytesIO()
+                variant.save(buffer, image_format, **options)
+
+                name = variant_file_name(file_name, size, extension)
+                write_atomic(buffer.getvalue(), storage.path(name))
+                created.append(name)
+
+    return created
+
+
+class ImagePipeline:
+
+    def __init__(self, max_workers: int = 2, storage: ImageStorage = None):
+        self.max_workers = max_workers
+        self.storage = storage if storage is not None else ImageStorage()
+        self.executor = None
+
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        """
+        Starts the worker processes, in the app lifespan before the first request
+        :return:
+        """
+        # Spawned, a fork would copy the locks held by the threads of Motor and of the threadpool
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, file_name: str):
+        """
+        Queues the variants of an uploaded image, the upload does not wait for them
+        :param file_name:
+        :return: future of the variant file names
+        """
+        # Scripts without a lifespan start the workers on first use
+        self.start()
+
+        future = self.executor.submit(generate_variants, file_name, self.storage)
+        future.add_done_callback(self._done)
+
+        return future
+
+    def _done(self, future):
+        if future.exception() is not None:
+            self.failed += 1
+            print(f"Could not create image variants: {future.exception()}")
+        else:
+            self.completed += 1
+
+    def variant_file_path(self, file_name: str, size: int, accept_webp: bool) -> str:
+        """
+        Path the variant has once it is made, the file system is not touched
+        :param file_name:
+        :param size:
+        :param accept_webp:
+        :return:
+        """
+        # Pick the variant size, largest one for anything bigger
+        variant_size = next((variant for variant in VARIANT_SIZES if variant >= size), VARIANT_SIZES[-1])
+        extension = "webp" if accept_webp else "jpg"
+
+        return self.storage.path(variant_file_name(file_name, variant_size, extension))
+
+    def variant_path(self, file_name: str, size: int, accept_webp: bool):
+        """
+        Path of the smallest variant at least the requested size, None when it is not made yet
+        :param file_name:
+        :param size:
+        :param accept_webp:
+        :return:
+        """
+        path = self.variant_file_path(file_name, size, accept_webp)
+
+        if not os.path.exists(path):
+            return None
+
+        return path
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
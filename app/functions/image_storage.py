@@ -0,0 +1,91 @@
+""" Content addressed image storage, blobs are named by their sha256 and sharded into nested directories """
+import hashlib
+import os
+import re
+
+from utils.uploads import IMAGE_DIRECTORY, write_atomic
+
+# File names of blobs and their variants start with the hex digest
+BLOB_NAME = re.compile(r"^([0-9a-f]{64})(_\d+)?\.[a-z0-9]+$")
+
+
+class ImageStorage:
+
+    def __init__(self, root: str = IMAGE_DIRECTORY, depth: int = 2, width: int = 2):
+        self.root = root
+        self.depth = depth
+        self.width = width
+
+    def shard(self, digest: str) -> str:
+        # ab/cd for digest abcd..., keeps every directory small
+        parts = [digest[i * self.width:(i + 1) * self.width] for i in range(self.depth)]
+        return os.path.join(self.root, *parts)
+
+    def path(self, file_name: str) -> str:
+        """
+        Path of a stored file, blobs and variants are sharded and old flat files stay in the root
+        :param file_name:
+        :return:
+        """
+        match = BLOB_NAME.match(file_name)
+
+        if match is None:
+            return os.path.join(self.root, file_name)
+
+        return os.path.join(self.shard(match.group(1)), file_name)
+
+    def exists(self, file_name: str) -> bool:
+        return os.path.exists(self.path(file_name))
+
+    @staticmethod
+    def blob_name(digest: str, extension: str) -> str:
+        return f"{digest}.{extension}"
+
+    def put_bytes(self, data: bytes, extension: str):
+        """
+        Stores the image once, identical content is not written again
+        :param data:
+        :param extension:
+        :return: (file name, True when the blob is new)
+        """
+        file_name = self.blob_name(hashlib.sha256(data).hexdigest(), extension)
+        path = self.path(file_name)
+
+        # Same content already stored, touching it keeps the garbage collector's grace period
+        if os.path.exists(path):
+            os.utime(path)
+            return file_name, False
+
+        write_atomic(data, path)
+
+        return file_name, True
+
+    def put_file(self, temp_path: str, digest: str, extension: str):
+        """
+        Moves a fully written temporary file in place under its digest, dropped when the content is already stored
+        :param temp_path:
+        :param digest: sha256 computed while the file was written
+        :param extension:
+        :return: (file name, True when the blob is new)
+        """
+        file_name = self.blob_name(digest, extension)
+        path = self.path(file_name)
+
+        if os.path.exists(path):
+            os.remove(temp_path)
+            os.utime(path)
+            return file_name, False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+        return file_name, True
+
+    def iter_files(self):
+        """
+        Walks every stored file, flat and sharded
+        :return: generator of (file name, path)
+        """
+        for directory, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                yield file_name, os.path.join(directory, file_name)
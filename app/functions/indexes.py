@@ -0,0 +1,223 @@
+"""
+Indexes of every hot query and a checker that explains each query shape and fails on collection scans
+    python -m functions.indexes ensure
+    python -m functions.indexes check
+"""
+import argparse
+import asyncio
+import datetime
+import sys
+
+import pymongo
+from bson import ObjectId
+from pymongo import IndexModel
+
+from utils import database
+
+# Hot indexes only hold live documents, queries have to filter on active: True to use them
+LIVE = {"partialFilterExpression": {"active": True}}
+INACTIVE = {"partialFilterExpression": {"active": False}}
+
+# Indexes by collection, (name, keys, options). Names are part of the spec so changes are easy to spot
+INDEX_SPEC = {
+    "users": [
+        ("username_live", [("username", pymongo.ASCENDING)], LIVE),
+        # Discover filters active users and sorts by the last login
+        ("last_login_live", [("last_login", pymongo.DESCENDING)], LIVE),
+        # Deleted users whose likes and matches are not deactivated yet
+        ("cascade_pending", [("cascade_pending", pymongo.ASCENDING)],
+         {"partialFilterExpression": {"cascade_pending": True}})
+    ],
+    "sessions": [
+        # Logins remove every session of the user, inactive ones included
+        ("user_id", [("user_id", pymongo.ASCENDING)], {}),
+        ("username_live", [("username", pymongo.ASCENDING)], LIVE)
+    ],
+    "likes": [
+        ("user_id_liked_user_id_is_like_live", [("user_id", pymongo.ASCENDING), ("liked_user_id", pymongo.ASCENDING),
+                                                ("is_like", pymongo.ASCENDING)], LIVE),
+        # Likes a user received, for the counters and the cascade of a deleted user
+        ("liked_user_id_live", [("liked_user_id", pymongo.ASCENDING)], LIVE),
+        # Inactive likes waiting for the archiver, the archiver keeps it small
+        ("deleted_at_inactive", [("deleted_at", pymongo.ASCENDING)], INACTIVE)
+    ],
+    "matches": [
+        ("user_id_matched_user_id_live", [("user_id", pymongo.ASCENDING), ("matched_user_id", pymongo.ASCENDING)],
+         LIVE),
+        ("matched_user_id_live", [("matched_user_id", pymongo.ASCENDING)], LIVE),
+        ("deleted_at_inactive", [("deleted_at", pymongo.ASCENDING)], INACTIVE)
+    ],
+    # History of a user, read rarely so one index per user field
+    "likes_archive": [
+        ("user_id", [("user_id", pymongo.ASCENDING)], {}),
+        ("liked_user_id", [("liked_user_id", pymongo.ASCENDING)], {})
+    ],
+    "matches_archive": [
+        ("user_id", [("user_id", pymongo.ASCENDING)], {}),
+        ("matched_user_id", [("matched_user_id", pymongo.ASCENDING)], {})
+    ],
+    "rate_limits": [
+        # Shared rate limit buckets that have not been used for an hour are full again and can go
+        ("updated_at_ttl", [("updated_at", pymongo.ASCENDING)], {"expireAfterSeconds": 3600})
+    ]
+}
+
+# Indexes replaced by the ones above, dropped once their replacement exists
+RETIRED_INDEXES = {
+    "users": ["username_active", "active_last_login"],
+    "sessions": ["user_id_active", "username_active"],
+    "likes": ["user_id_liked_user_id_active_is_like", "liked_user_id_active"],
+    "matches": ["user_id_matched_user_id_active", "matched_user_id_active"]
+}
+
+
+def query_shapes() -> list:
+    """
+    Every filter UserManagement, Counters and OauthWorkflow send, with placeholder values
+    :return: list of (name, collection, filter, sort)
+    """
+    user_id = ObjectId()
+    other_id = ObjectId()
+    ids = [ObjectId(), ObjectId()]
+
+    return [
+        # Users
+        ("user by username", "users", {"username": "user", "active": True}, None),
+        ("users by ids", "users", {"_id": {"$in": ids}, "active": True}, None),
+        ("user by id", "users", {"_id": user_id, "active": True}, None),
+        ("discover", "users", {"_id": {"$nin": ids}, "active": True}, [("last_login", pymongo.DESCENDING)]),
+
+        # Sessions
+        ("session by user", "sessions", {"user_id": user_id, "active": True}, None),
+        ("session by username", "sessions", {"username": "user", "active": True}, None),
+        ("sessions of user", "sessions", {"user_id": user_id}, None),
+
+        # Likes
+        ("like between users", "likes",
+         {"user_id": user_id, "liked_user_id": other_id, "active": True, "is_like": True}, None),
+        ("likes by ids", "likes", {"_id": {"$in": ids}, "active": True, "is_like": True}, None),
+        ("likes sent by user", "likes", {"user_id": user_id, "active": True, "is_like": True}, None),
+        ("likes received by user", "likes", {"liked_user_id": user_id, "active": True, "is_like": True}, None),
+
+        # Matches
+        ("match between users", "matches", {"user_id": user_id, "matched_user_id": other_id, "active": True}, None),
+        ("matches by ids", "matches", {"_id": {"$in": ids}, "active": True}, None),
+        ("matches of user", "matches", {"user_id": user_id, "active": True}, None),
+        ("matches with user", "matches", {"matched_user_id": user_id, "active": True}, None),
+
+        # Cascade of deleted users
+        ("likes by user to deactivate", "likes", {"user_id": user_id, "active": True}, None),
+        ("likes to user to deactivate", "likes", {"liked_user_id": user_id, "active": True}, None),
+        ("pending cascades", "users", {"cascade_pending": True}, None),
+
+        # Archiver
+        ("likes to archive", "likes", {"active": False, "deleted_at": {"$lt": datetime.datetime.now()}},
+         [("deleted_at", pymongo.ASCENDING)]),
+        ("matches to archive", "matches", {"active": False, "deleted_at": {"$lt": datetime.datetime.now()}},
+         [("deleted_at", pymongo.ASCENDING)]),
+
+        # History of a user, the hot documents by the ids the user links and the archived ones by the user fields
+        ("history likes by ids", "likes", {"_id": {"$in": ids}}, None),
+        ("history matches by ids", "matches", {"_id": {"$in": ids}}, None),
+        ("archived likes of user", "likes_archive", {"$or": [{"user_id": user_id}, {"liked_user_id": user_id}]},
+         None),
+        ("archived matches of user", "matches_archive",
+         {"$or": [{"user_id": user_id}, {"matched_user_id": user_id}]}, None),
+
+        # Counters
+        ("counters of user", "counters", {"_id": user_id}, None)
+    ]
+
+
+async def ensure_indexes(db) -> list:
+    """
+    Creates the indexes of the spec that are missing and then drops the retired ones,
+    safe to run on every start and from several workers
+    :param db:
+    :return: names of the created indexes and of the dropped ones with a leading -
+    """
+    changed = []
+
+    for collection, indexes in INDEX_SPEC.items():
+        existing = await db[collection].index_information()
+        missing = [IndexModel(keys, name=name, **options) for name, keys, options in indexes if name not in existing]
+
+        if missing:
+            changed += await db[collection].create_indexes(missing)
+
+        for name in RETIRED_INDEXES.get(collection, []):
+            if name not in existing:
+                continue
+
+            # Another worker may have dropped it first
+            try:
+                await db[collection].drop_index(name)
+                changed.append(f"-{name}")
+            except pymongo.errors.OperationFailure:
+                pass
+
+    return changed
+
+
+def plan_stages(plan: dict) -> list:
+    # Every stage of the plan tree, depth first
+    stages = [plan.get("stage")]
+
+    for child in plan.get("inputStages", []) + [plan[key] for key in ("inputStage", "queryPlan") if key in plan]:
+        stages += plan_stages(child)
+
+    return stages
+
+
+async def check_query_plans(db) -> list:
+    """
+    Explains every query shape
+    :param db:
+    :return: list of (name, collection, stages, True when the plan scans the collection)
+    """
+    results = []
+
+    for name, collection, query_filter, sort in query_shapes():
+        command = {"find": collection, "filter": query_filter}
+
+        if sort is not None:
+            command["sort"] = dict(sort)
+
+        explain = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+
+        results.append((name, collection, stages, "COLLSCAN" in stages))
+
+    return results
+
+
+async def run(command: str) -> int:
+    client = database.create_async_client()
+    db = client["codespark"]
+
+    try:
+        if command == "ensure":
+            print(f"Changed indexes: {await ensure_indexes(db) or 'none'}")
+            return 0
+
+        failed = 0
+
+        for name, collection, stages, scans in await check_query_plans(db):
+            failed += scans
+            print(f"{'COLLSCAN' if scans else 'ok':<9} {collection}: {name} {' > '.join(filter(None, stages))}")
+
+        return 1 if failed else 0
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Creates the indexes and checks the query plans")
+    parser.add_argument("command", choices=["ensure", "check"])
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(run(args.command)))
+
+
+if __name__ == '__main__':
+    main()
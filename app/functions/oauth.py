@@ -1,10 +1,14 @@
 """ Currently only for github """
+import asyncio
 import httpx
 import os
 from dotenv import load_dotenv
 from uuid import uuid4
 import datetime as dt
 import bcrypt
+from starlette.concurrency import run_in_threadpool
+
+from utils.cache import Caches
 
 # TODO: not saving session data atm, make separate colleciton to save them
 # TODO: If user changes github account and has codespark account. Solve how user can access their old account!
@@ -13,8 +17,12 @@ import bcrypt
 
 class OauthWorkflow:
 
-    def __init__(self, db):
+    def __init__(self, db, http_client: httpx.AsyncClient = None, caches: Caches = None):
         self.db = db
+        self.http_client = http_client
+
+        # Verified sessions are cached by username, every session change deletes the entry in every worker
+        self.caches = caches if caches is not None else Caches()
 
         self.client_id = self.get_client_id()
         self.client_secret = self.get_client_secret()
@@ -26,6 +34,7 @@ class OauthWorkflow:
         self.session_id = None
         self.hashed_session_id = None
         self.username = None
+        self.user_id = None
 
         self.has_profile = False
 
@@ -34,6 +43,14 @@ class OauthWorkflow:
         url = f"https://github.com/login/oauth/authorize?client_id={self.client_id}&redirect_uri={self.redirect_uri}&scope={scopes}"
         return url
 
+    async def send(self, method: str, url: str, **kwargs) -> httpx.Response:
+        # Shared client of the app keeps the connections to github open between logins
+        if self.http_client is not None:
+            return await self.http_client.request(method, url, **kwargs)
+
+        async with httpx.AsyncClient() as client:
+            return await client.request(method, url, **kwargs)
+
     async def get_access_token(self, code: str):
         url = f"https://github.com/login/oauth/access_token"
 
@@ -47,13 +64,12 @@ class OauthWorkflow:
             "Accept": "application/json"
         }
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, data=payload, headers=headers)
+        response = await self.send("POST", url, data=payload, headers=headers)
 
-            if response.status_code != 200:
-                return None
+        if response.status_code != 200:
+            return None
 
-            response_json = response.json()
+        response_json = response.json()
 
         return response_json["access_token"]
 
@@ -73,41 +89,47 @@ class OauthWorkflow:
             "Authorization": f"Bearer {self.access_token}"
         }
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(uri, headers=headers)
+        response = await self.send("GET", uri, headers=headers)
 
-            if response.status_code != 200:
-                return None
+        if response.status_code != 200:
+            return None
 
-            response_json = response.json()
+        response_json = response.json()
 
         self.username = response_json["login"]
 
         return response_json
 
-    def generate_new_unique_session_id(self):
+    async def generate_new_unique_session_id(self):
         # Create session id
         session_id = f"{self.generate_id()}-{self.username}"
 
-        # Hash the session id
-        hashed_session_id = bcrypt.hashpw(session_id.encode(), bcrypt.gensalt())
+        # Hash the session id, bcrypt is slow on purpose so it runs off the event loop
+        hashed_session_id = await run_in_threadpool(bcrypt.hashpw, session_id.encode(), bcrypt.gensalt())
 
         # Store the session id and hashed session id
         self.hashed_session_id = hashed_session_id
         self.session_id = session_id
 
-    def is_session_id_taken(self, hashed_session_id: bytes) -> bool:
-        return self.col_session.find_one({"hashed_session_id": hashed_session_id}) is not None
+    async def is_session_id_taken(self, hashed_session_id: bytes) -> bool:
+        return await self.col_session.find_one({"hashed_session_id": hashed_session_id}, {"_id": 1}) is not None
+
+    async def get_user_id(self):
+        # Looked up once per login
+        if self.user_id is None:
+            user = await self.col_users.find_one({"username": self.username, "active": True}, {"_id": 1})
+            self.user_id = user["_id"]
 
-    def has_session(self) -> bool:
+        return self.user_id
+
+    async def has_session(self) -> bool:
         if self.username is None:
             return False
 
         # Get user id
-        user = self.col_users.find_one({"username": self.username, "active": True})
-        user_id = user["_id"]
+        user_id = await self.get_user_id()
 
-        session = self.col_session.find_one({"user_id": user_id, "active": True})
+        session = await self.col_session.find_one({"user_id": user_id, "active": True})
 
         if session is None:
             return False
@@ -115,13 +137,14 @@ class OauthWorkflow:
         # CHeck that session has not expired
         if session["expired_at"] < dt.datetime.now():
             # Change the active to false
-            self.col_session.update_one({"_id": session["_id"]},
-                                        {"$set": {"active": False, "last_used": dt.datetime.now()}})
+            await self.col_session.update_one({"_id": session["_id"]},
+                                              {"$set": {"active": False, "last_used": dt.datetime.now()}})
+            await self.caches.sessions.delete(self.username)
             return False
 
         return True
 
-    def has_user_profile(self) -> bool:
+    async def has_user_profile(self) -> bool:
         """
         Checks if user has profile, if not create one
         Also checks if the user profile is complete
@@ -130,12 +153,14 @@ class OauthWorkflow:
         if self.username is None or self.username == "":
             return False
 
-        user_profile = self.col_users.find_one({"username": self.username, "active": True})
+        user_profile = await self.col_users.find_one({"username": self.username, "active": True})
 
         if user_profile is None:
-            self.create_user_profile()
+            await self.create_user_profile()
             return True
 
+        self.user_id = user_profile["_id"]
+
         fields = ["email", "discord_username", "natural_languages", "background", "looking_for", "how_contribute"]
 
         # Check if fields are none or empty
@@ -147,13 +172,13 @@ class OauthWorkflow:
         self.has_profile = True
         return True
 
-    def create_user_profile(self):
+    async def create_user_profile(self):
         if self.username is None:
             return None
 
         current_time = dt.datetime.now()
 
-        self.col_users.insert_one({
+        result = await self.col_users.insert_one({
             "username": self.username,
             "email": "",
             "discord_username": "",
@@ -170,9 +195,11 @@ class OauthWorkflow:
             "active": True
         })
 
+        self.user_id = result.inserted_id
+
         return True
 
-    def create_session(self):
+    async def create_session(self):
         if self.username is None or self.session_id is None or self.hashed_session_id is None:
             return None
 
@@ -180,10 +207,9 @@ class OauthWorkflow:
         expire_time = creation_time + dt.timedelta(days=1)
 
         # Find user id
-        user = self.col_users.find_one({"username": self.username, "active": True})
-        user_id = user["_id"]
+        user_id = await self.get_user_id()
 
-        self.col_session.insert_one({
+        await self.col_session.insert_one({
             "user_id": user_id,
             "username": self.username,
             "hashed_session_id": self.hashed_session_id,
@@ -193,21 +219,22 @@ class OauthWorkflow:
             "active": True
         })
 
-        # Update the last login time
-        self.col_users.update_one({"_id": user_id}, {"$set": {"last_login": creation_time}})
+        # Update the last login time, the old session may still be cached
+        await asyncio.gather(self.col_users.update_one({"_id": user_id}, {"$set": {"last_login": creation_time}}),
+                             self.caches.sessions.delete(self.username))
 
         return True
 
-    def remove_session(self):
+    async def remove_session(self):
         if self.username is None:
             return None
 
         # Find user id
-        user = self.col_users.find_one({"username": self.username, "active": True})
-        user_id = user["_id"]
+        user_id = await self.get_user_id()
 
         # Find all sessions for the user and delete them
-        self.col_session.delete_many({"user_id": user_id})
+        await self.col_session.delete_many({"user_id": user_id})
+        await self.caches.sessions.delete(self.username)
 
         return True
 
@@ -225,20 +252,20 @@ class OauthWorkflow:
             return None
 
         # Check if the user has a profile, if not create one
-        success = self.has_user_profile()
+        success = await self.has_user_profile()
 
         if not success:
             return None
 
-        # Generate an uuid for the user
-        self.generate_new_unique_session_id()
+        # Generate an uuid for the user while checking if user has a session
+        _, has_session = await asyncio.gather(self.generate_new_unique_session_id(), self.has_session())
 
-        # Check if user has a session, if so remove it
-        if self.has_session():
+        # If user has a session remove it
+        if has_session:
             # Remove the old session
-            self.remove_session()
+            await self.remove_session()
 
-        success = self.create_session()
+        success = await self.create_session()
 
         if not success:
             return None
@@ -0,0 +1,62 @@
+""" Profile cards shared by the likes, matches and discover listings """
+from utils.cache import LocalCache
+
+# Every field a listing can show, each listing picks its own subset
+CARD_FIELDS = ["username", "email", "discord_username", "profile_picture", "natural_languages", "background",
+               "looking_for", "how_contribute"]
+
+
+class ProfileCards:
+
+    def __init__(self, db, cache=None):
+        self.db = db
+
+        self.col_users = self.db["users"]
+
+        # LocalCache, NoCache or SharedCache of utils.cache
+        self.cache = cache if cache is not None else LocalCache("profile_cards", max_entries=10000, ttl=60)
+
+    async def get_many(self, user_ids, fields: list = None) -> dict:
+        """
+        Gets the cards of active users, one $in query for the ones not in the cache.
+        With fields only those are read from the database, cached cards missing one of them count as misses
+        :param user_ids:
+        :param fields: fields the caller needs, every card field by default
+        :return: {user_id: card}, inactive or missing users are left out
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        fields = fields or CARD_FIELDS
+
+        cached = await self.cache.get_many(user_ids)
+        cards = {user_id: card for user_id, card in cached.items() if all(field in card for field in fields)}
+        misses = [user_id for user_id in user_ids if user_id not in cards]
+
+        if not misses:
+            return cards
+
+        # Fetch only the missing cards and only the fields asked for
+        projection = {field: 1 for field in fields}
+        fetched = {}
+
+        async for user in self.col_users.find({"_id": {"$in": misses}, "active": True}, projection):
+            # Keep the fields a cached partial card already had
+            fetched[user["_id"]] = {**cached.get(user["_id"], {}), **{field: user.get(field) for field in fields}}
+
+        await self.cache.set_many(fetched)
+        cards.update(fetched)
+
+        return cards
+
+    async def get(self, user_id, fields: list = None) -> dict:
+        return (await self.get_many([user_id], fields)).get(user_id)
+
+    async def invalidate(self, user_id):
+        await self.cache.delete(user_id)
+
+    @staticmethod
+    def render(card: dict, schema: list) -> dict:
+        # Copy of the card with the listing's fields only
+        return {field: card[field] for field in schema}
+
+    def stats(self) -> dict:
+        return self.cache.stats()
@@ -1,3 +1,7 @@
+import asyncio
+import hashlib
+import hmac
+import inspect
 import bcrypt
 import datetime as dt
 from fastapi import Header, HTTPException, status, Request
@@ -7,27 +11,78 @@ import datetime
 from bson import ObjectId
 import os
 from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
 
 from utils import database
+from utils.cache import Caches
+from utils.etag import version_etag
+from utils.uploads import check_image
+from functions.counters import Counters
+from functions.events import EventBus
+from functions.profile_cards import ProfileCards
+from functions.image_pipeline import ImagePipeline
+from functions.image_storage import ImageStorage
+from functions.image_cache import ImageCache
+from functions.cascade import DeactivationCascade
 
 
 # TODO: handle profile pictures
 # TODO: handle discovers into sessions, simple sorting algorithm based on time
 
+# Profile fields the user can edit and their max length
+EDITABLE_FIELDS = {
+    "email": 320,
+    "discord_username": 64,
+    "natural_languages": 1000,
+    "background": 1000,
+    "looking_for": 1000,
+    "how_contribute": 1000
+}
+
+# Fields of the cards in the matches listing and in the likes and discover listings
+MATCH_CARD_SCHEMA = ["username", "email", "discord_username", "profile_picture", "natural_languages", "background",
+                     "looking_for", "how_contribute"]
+LIKE_CARD_SCHEMA = ["username", "profile_picture", "natural_languages", "background", "looking_for", "how_contribute"]
+
+# Fields of the own profile
+PROFILE_SCHEMA = ["username", "email", "discord_username", "profile_picture", "natural_languages", "background",
+                  "looking_for", "how_contribute"]
+
+
+def select_fields(schema: list, fields: str = None) -> list:
+    """
+    Fields of a listing the client asked for with fields=a,b, the username is always included
+    :param schema: every field of the listing
+    :param fields: comma separated field names, None for the whole schema
+    :return: fields in schema order
+    """
+    if not fields:
+        return schema
+
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = requested - set(schema)
+
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    return [field for field in schema if field == "username" or field in requested]
 
-def verify_session_id(request: Request = None):
+
+async def verify_session_id(request: Request = None):
     """
     Verifies that the session id is valid ROUTE PROTECTOR
     :param request:
     :return:
     """
-    client = pymongo.MongoClient(database.get_database_uri())
-    db = client["codespark"]
-
     # Check if the request is None
     if request is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No request provided")
 
+    # Database and caches of the worker, opened in the app lifespan
+    db = request.app.state.db
+    caches = request.app.state.caches
+
     # Get the username and session id
     username = request.headers.get("username")
     session_id = request.headers.get("session_id")
@@ -44,12 +99,26 @@ def verify_session_id(request: Request = None):
     col_users = db["users"]
     col_sessions = db["sessions"]
 
-    user = col_users.find_one({"username": username, "active": True})
-    user_id = user["_id"]
-    session = col_sessions.find_one({"user_id": user_id, "active": True})
+    # Cached sessions belong to an active user, they are deleted in every worker when the user or the
+    # session changes. Without a shared cache the session is read on every request
+    session = await caches.sessions.get(username)
 
     if session is None:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid session id")
+        # Sessions store the username too, both lookups run at the same time
+        user, session = await asyncio.gather(
+            col_users.find_one({"username": username, "active": True}, {"_id": 1}),
+            col_sessions.find_one({"username": username, "active": True},
+                                  {"user_id": 1, "hashed_session_id": 1, "expired_at": 1, "active": 1})
+        )
+
+        if user is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User does not exist")
+
+        if session is None or session["user_id"] != user["_id"]:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid session id")
+
+        # Right after the read, a logout since then holds the key and the set is refused
+        await caches.sessions.set(username, session)
 
     # Make sure session is active
     if not session["active"]:
@@ -59,17 +128,32 @@ def verify_session_id(request: Request = None):
     if session["expired_at"] < datetime.datetime.now():
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Session id expired")
 
-    # Use bcrypt to compare the session id
-    if not bcrypt.checkpw(session_id.encode(), session["hashed_session_id"]):
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid session id")
+    # Session ids are random, a sha256 of the one bcrypt accepted lets the next requests skip bcrypt.
+    # It is kept with the bcrypt hash it was checked against, a new login of the session changes the hash
+    digest = hashlib.sha256(session_id.encode()).hexdigest()
+    verified = await caches.session_digests.get(str(session["_id"]))
+
+    if verified is None or verified["hashed_session_id"] != session["hashed_session_id"] or \
+            not hmac.compare_digest(verified["digest"], digest):
+        # Use bcrypt to compare the session id, slow on purpose so off the event loop
+        if not await run_in_threadpool(bcrypt.checkpw, session_id.encode(), session["hashed_session_id"]):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid session id")
+
+        await caches.session_digests.set(str(session["_id"]), {"hashed_session_id": session["hashed_session_id"],
+                                                               "digest": digest})
 
     # Update the session
-    col_sessions.update_one({"_id": session["_id"]}, {"$set": {"last_used": datetime.datetime.now()}})
+    await col_sessions.update_one({"_id": session["_id"]}, {"$set": {"last_used": datetime.datetime.now()}})
 
 
 class UserManagement:
+    """
+    Users, likes and matches on an async database (Motor), every method that touches the database is a coroutine
+    """
 
-    def __init__(self, db):
+    def __init__(self, db, event_bus: EventBus = None, profile_cards: ProfileCards = None,
+                 image_pipeline: ImagePipeline = None, image_storage: ImageStorage = None,
+                 image_cache: ImageCache = None, cascade: DeactivationCascade = None, caches: Caches = None):
         self.db = db
 
         self.col_users = self.db["users"]
@@ -77,51 +161,70 @@ class UserManagement:
         self.col_likes = self.db["likes"]
         self.col_matches = self.db["matches"]
 
-    def update_user_profile(self, username: str, data: dict) -> bool:
+        self.counters = Counters(self.db)
+        self.event_bus = event_bus if event_bus is not None else EventBus()
+        self.caches = caches if caches is not None else Caches()
+        self.profile_cards = profile_cards if profile_cards is not None else \
+            ProfileCards(self.db, self.caches.profile_cards)
+        self.image_storage = image_storage if image_storage is not None else ImageStorage()
+        self.image_pipeline = image_pipeline if image_pipeline is not None else ImagePipeline(storage=self.image_storage)
+        self.image_cache = image_cache if image_cache is not None else ImageCache()
+        self.cascade = cascade if cascade is not None else DeactivationCascade(self.db)
+
+    async def update_user_profile(self, username: str, data: dict) -> list:
         """
-        Updates the user profile
+        Updates only the editable fields that changed, in one write without reading the profile first
         :param username:
         :param data:
-        :return:
+        :return: list of changed fields
         """
 
         # Check if the data is None
         if data is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No data provided")
 
-        # Find the user
-        user_data = self.col_users.find_one({"username": username, "active": True})
-
-        # Check if the user is None
-        if user_data is None:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
+        # Validate the editable fields, other fields never update through here
+        changes = {}
 
-        # Loop over all the fields in the data
-        for field in user_data:
-            # Skip fields that never update
-            if field in ["username", "_id", "created_at", "updated_at", "active", "last_login", "likes", "matches"]:
+        for field, value in data.items():
+            if field not in EDITABLE_FIELDS:
                 continue
 
-            # Skip profile_picture too
-            if field == "profile_picture":
-                continue
+            if not isinstance(value, str):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"{field} must be a string")
 
-            # Check if the field is in the data
-            if field in data:
-                # Update the field
-                user_data[field] = data[field]
+            if len(value) > EDITABLE_FIELDS[field]:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"{field} is too long")
 
-        # New update time
-        user_data["updated_at"] = datetime.datetime.now()
+            changes[field] = value
 
-        # Update the user
-        self.col_users.update_one({"_id": user_data["_id"]}, {"$set": user_data})
+        # Nothing to update
+        if not changes:
+            return []
 
-        return True
+        # Only match the user when at least one field differs, returns the old values of the fields
+        before = await self.col_users.find_one_and_update(
+            {"username": username, "active": True, "$or": [{field: {"$ne": value}} for field, value in changes.items()]},
+            {"$set": {**changes, "updated_at": datetime.datetime.now()}, "$inc": {"revision": 1}},
+            projection={field: 1 for field in changes},
+            return_document=pymongo.ReturnDocument.BEFORE
+        )
+
+        # Either nothing changed or the user does not exist
+        if before is None:
+            if await self.col_users.count_documents({"username": username, "active": True}, limit=1) == 0:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
+
+            return []
+
+        # Profile and card changed, in every worker
+        await asyncio.gather(self.caches.profiles.delete(username), self.profile_cards.invalidate(before["_id"]))
 
-    def upload_profile_picture(self, username: str, image: bytes) -> bool:
+        return [field for field, value in changes.items() if before.get(field) != value]
+
+    async def upload_profile_picture(self, username: str, image: bytes) -> bool:
         """
-        Gets the user profile image as uncoded string and turns it into jpg and saves to a file
+        Gets the user profile image as bytes, checks its type and stores it by its content hash
         :param username:
         :param image:
         :return:
@@ -130,51 +233,98 @@ class UserManagement:
         if image is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No image provided")
 
-        # Generate random file name
-        file_name = f"{username}_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.jpg"
+        # Check the size and the real type of the image
+        content_type, extension = check_image(image)
+
+        # Save the file, identical images are stored once. Hashing and writing run in the threadpool
+        try:
+            file_name, is_new = await run_in_threadpool(self.image_storage.put_bytes, image, extension)
+        except Exception as e:
+            print(e)
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Could not save image")
 
-        # test save file
-        self.jpg_bytes_to_file(image, file_name)
+        return await self.set_profile_picture(username, file_name, is_new)
 
-        # Find the user
-        user_data = self.col_users.find_one({"username": username, "active": True})
+    async def store_uploaded_picture(self, username: str, temp_path: str, digest: str, extension: str) -> bool:
+        """
+        Moves an image streamed to a temporary file in place and sets it as the profile picture
+        :param username:
+        :param temp_path:
+        :param digest: sha256 of the file
+        :param extension:
+        :return:
+        """
+        # Rename is atomic, the file appears complete or not at all
+        file_name, is_new = await run_in_threadpool(self.image_storage.put_file, temp_path, digest, extension)
+
+        return await self.set_profile_picture(username, file_name, is_new)
+
+    async def set_profile_picture(self, username: str, file_name: str, is_new: bool = True) -> bool:
+        """
+        Points the user profile to a stored image
+        Images are shared between users with the same picture, unused ones are left for the garbage collector
+        :param username:
+        :param file_name:
+        :param is_new: False when the image was stored before and has its variants already
+        :return:
+        """
+        # Image url link, the content hash in the name makes the url versioned
+        prefix = "http://84.250.88.117:8000/api/get_profile_picture/"
+        image_url = prefix + file_name
+
+        # Update the user, new revision for the profile ETag
+        user_data = await self.col_users.find_one_and_update(
+            {"username": username, "active": True},
+            {"$set": {"profile_picture": image_url, "profile_picture_hash": file_name.split(".")[0],
+                      "updated_at": datetime.datetime.now()},
+             "$inc": {"revision": 1}},
+            projection={"_id": 1, "profile_picture": 1}
+        )
 
         # Check if the user is None
         if user_data is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
 
-        # Image url link
-        prefix = "http://84.250.88.117:8000/api/get_profile_picture/"
-        image_url = prefix + file_name
+        # Profile and card show the picture
+        await asyncio.gather(self.caches.profiles.delete(username), self.profile_cards.invalidate(user_data["_id"]))
+
+        # Old picture and its variants are not hot anymore
+        old_file_name = (user_data.get("profile_picture") or "").rsplit("/", 1)[-1]
 
-        # Update the user
-        self.col_users.update_one({"_id": user_data["_id"]}, {"$set": {"profile_picture": image_url}})
+        if old_file_name and old_file_name != file_name:
+            self.image_cache.invalidate(old_file_name.rsplit(".", 1)[0])
+
+        # Make the resized variants in the background
+        if is_new:
+            self.image_pipeline.submit(file_name)
 
         return True
 
-    def jpg_bytes_to_file(self, image: bytes, file_name: str):
+    def cached_picture_path(self, file_name: str, size: int = None, accept_webp: bool = False) -> str:
         """
-        Takes the image as bytes and saves it to a file
-        :param image:
+        Path of the picture or its variant when the image cache has it, without touching the file system
         :param file_name:
-        :param username:
-        :return:
+        :param size:
+        :param accept_webp:
+        :return: None when it has to be looked up on disk
         """
+        if file_name is None:
+            return None
 
-        # Create a new file
-        try:
-            with open(f"image_storage/{file_name}", "wb") as file:
-                # Write the image to the file
-                file.write(image)
-        except Exception as e:
-            print(e)
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Could not save image")
+        # A missing variant may have been made since, only a cached one is certain
+        if size is not None:
+            path = self.image_pipeline.variant_file_path(file_name, size, accept_webp)
+        else:
+            path = self.image_storage.path(file_name)
+
+        return path if self.image_cache.contains(path) else None
 
-    def get_profile_picture_path(self, file_name):
+    def get_profile_picture_path(self, file_name, size: int = None, accept_webp: bool = False):
         """
-        Gets the profile picture path
-        :param username:
+        Gets the profile picture path, a resized variant when size is given and the variant is ready
         :param file_name:
+        :param size:
+        :param accept_webp:
         :return:
         """
 
@@ -182,14 +332,41 @@ class UserManagement:
         if file_name is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No file name provided")
 
+        # Use the variant if it has been made already
+        if size is not None:
+            variant_path = self.image_pipeline.variant_path(file_name, size, accept_webp)
+
+            if variant_path is not None:
+                return variant_path
+
         # Make sure file exists
-        if not os.path.exists(f"image_storage/{file_name}"):
+        path = self.image_storage.path(file_name)
+
+        if not os.path.exists(path):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File does not exist")
 
         # Return the file path
-        return f"image_storage/{file_name}"
+        return path
 
-    def get_user_profile(self, username: str) -> dict:
+    async def get_profile_picture_file(self, username: str) -> str:
+        """
+        Gets the file name of the users current profile picture
+        :param username:
+        :return:
+        """
+        user_data = await self.col_users.find_one({"username": username, "active": True}, {"profile_picture": 1})
+
+        # Check if the user is None
+        if user_data is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
+
+        # Check if the user has a picture
+        if not user_data.get("profile_picture"):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User has no profile picture")
+
+        return user_data["profile_picture"].rsplit("/", 1)[-1]
+
+    async def get_user_profile(self, username: str) -> dict:
         """
         Gets the user profile
         :param username:
@@ -201,22 +378,57 @@ class UserManagement:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No username provided")
 
         # Find the user
-        user_data = self.col_users.find_one({"username": username, "active": True})
+        user_data = await self.get_profile_document(username)
+
+        # Create the user data
+        user_data = {field: user_data[field] for field in PROFILE_SCHEMA}
+
+        return user_data
+
+    async def get_profile_document(self, username: str) -> dict:
+        """
+        Gets the profile fields, revision and updated_at of an active user through the profile cache
+        :param username:
+        :return:
+        """
+        user_data = await self.caches.profiles.get(username)
+
+        if user_data is not None:
+            return user_data
+
+        projection = {field: 1 for field in PROFILE_SCHEMA + ["revision", "updated_at"]}
+        user_data = await self.col_users.find_one({"username": username, "active": True}, projection)
 
         # Check if the user is None
         if user_data is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
 
-        # Fields to to deliver
-        schema = ["username", "email", "discord_username", "profile_picture", "natural_languages", "background",
-                  "looking_for", "how_contribute"]
-
-        # Create the user data
-        user_data = {field: user_data[field] for field in schema}
+        await self.caches.profiles.set(username, user_data)
 
         return user_data
 
-    def get_matches_view(self, username: str, match_username: str) -> dict:
+    async def get_profile_etag(self, username: str) -> str:
+        """
+        Gets the ETag of the user profile, from the cached profile or a projected read of the revision only
+        :param username:
+        :return:
+        """
+
+        # A cached profile has its version
+        user_data = await self.caches.profiles.get(username)
+
+        if user_data is None:
+            # Find the user version, the profile is only read when it changed
+            user_data = await self.col_users.find_one({"username": username, "active": True},
+                                                      {"revision": 1, "updated_at": 1})
+
+        # Check if the user is None
+        if user_data is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
+
+        return version_etag(user_data["_id"], user_data.get("revision"), user_data.get("updated_at"))
+
+    async def get_matches_view(self, username: str, match_username: str) -> dict:
         """
         Gets the user profile
         :param username:
@@ -228,11 +440,11 @@ class UserManagement:
         if username is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No username provided")
 
-        # Find the user
-        user_data = self.col_users.find_one({"username": username})
-
-        # Find the match user
-        matched_user = self.col_users.find_one({"username": match_username})
+        # Find the user and the match user
+        user_data, matched_user = await asyncio.gather(
+            self.col_users.find_one({"username": username, "active": True}),
+            self.col_users.find_one({"username": match_username, "active": True})
+        )
 
         # Check if the user is None
         if user_data is None:
@@ -246,9 +458,10 @@ class UserManagement:
 
         return user_data
 
-    def delete_user(self, username: str):
+    async def delete_user(self, username: str):
         """
-        Deletes the user account aka puts the active status to false and session status to false
+        Deletes the user account aka puts the active status to false and session status to false.
+        Likes and matches of the user are deactivated by the cascade after the request
         :param username:
         :return:
         """
@@ -258,23 +471,35 @@ class UserManagement:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No username provided")
 
         # Find the user
-        user_data = self.col_users.find_one({"username": username, "active": True})
+        user_data = await self.col_users.find_one({"username": username, "active": True}, {"_id": 1})
 
         # Check if the user is None
         if user_data is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
 
-        # Update the user
-        self.col_users.update_one({"username": username},
-                                  {"$set": {"active": False, "updated_at": datetime.datetime.now()}})
+        user_id = user_data["_id"]
+
+        # Update the user and the sessions, the user stays pending until the cascade is done
+        await asyncio.gather(
+            self.col_users.update_one({"_id": user_id}, {"$set": {"active": False, "cascade_pending": True,
+                                                                  "updated_at": datetime.datetime.now()}}),
+            self.col_sessions.update_many({"user_id": user_id, "active": True},
+                                          {"$set": {"active": False, "last_used": datetime.datetime.now()}})
+        )
 
-        # Update the session
-        self.col_sessions.update_one({"username": username},
-                                     {"$set": {"active": False, "last_used": datetime.datetime.now()}})
+        # Take the user out of the counters and the listings, the counters need the edges still active
+        await self.counters.delete_user(user_id)
+
+        # Session, profile and card of the user are gone in every worker
+        await asyncio.gather(self.caches.sessions.delete(username), self.caches.profiles.delete(username),
+                             self.profile_cards.invalidate(user_id))
+
+        # Deactivate the likes and matches of the user in batches
+        await self.cascade.schedule(user_id)
 
         return True
 
-    def like(self, user1, user2) -> bool:
+    async def like(self, user1, user2) -> bool:
         """
         User 1 likes user 2
         0. Make sure users are not the same
@@ -290,8 +515,10 @@ class UserManagement:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cannot like yourself")
 
         # Get users
-        user1_data = self.col_users.find_one({"username": user1, "active": True})
-        user2_data = self.col_users.find_one({"username": user2, "active": True})
+        user1_data, user2_data = await asyncio.gather(
+            self.col_users.find_one({"username": user1, "active": True}, {"_id": 1}),
+            self.col_users.find_one({"username": user2, "active": True}, {"_id": 1})
+        )
 
         # Check that the users are not None
         if user1_data is None or user2_data is None:
@@ -301,47 +528,42 @@ class UserManagement:
         user1_id = user1_data["_id"]
         user2_id = user2_data["_id"]
 
-        # Check if user 1 has liked user 2 before
-        query = self.col_likes.find_one(
-            {"user_id": user1_id, "liked_user_id": user2_id, "active": True, "is_like": True})
+        # Check if user 1 has liked user 2 before and if user 2 has liked user 1 before
+        query1, query2 = await asyncio.gather(
+            self.col_likes.find_one({"user_id": user1_id, "liked_user_id": user2_id, "active": True, "is_like": True},
+                                    {"_id": 1}),
+            self.col_likes.find_one({"user_id": user2_id, "liked_user_id": user1_id, "active": True, "is_like": True},
+                                    {"_id": 1})
+        )
 
-        if query is not None:
+        if query1 is not None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User has already liked this user")
 
-        # Check if user 2 has liked user 1 before
-        query = self.col_likes.find_one(
-            {"user_id": user2_id, "liked_user_id": user1_id, "active": True, "is_like": True})
-
-        # If this query is not None, then create a match
-        if query is not None:
+        # If user 2 has liked user 1, then create a match
+        if query2 is not None:
             # Create like
-            self.like_user(user1, user2)
+            await self.like_user(user1_id, user2_id)
             # Create match
-            self.create_match(user1_id, user2_id)
+            await self.create_match(user1_id, user2_id)
             return True
 
         # Final case, user 1 has not liked user 2 before and user 2 has not liked user 1 before
         # Create like object
-        self.like_user(user1, user2)
+        await self.like_user(user1_id, user2_id)
+
+        # Let user 2 know about the new like
+        self.event_bus.publish(user2_id, "like", {"username": user1})
 
         return True
 
-    def like_user(self, user1, user2):
+    async def like_user(self, user1_id: ObjectId, user2_id: ObjectId):
         # Generate a unique custom _id
         package_id = ObjectId()
 
         # Check if the custom _id is already in use (unlikely but possible)
-        while self.col_likes.find_one({"_id": package_id}):
+        while await self.col_likes.find_one({"_id": package_id}, {"_id": 1}):
             package_id = ObjectId()  # Generate a new custom _id
 
-        # Get the user id of the user
-        user1 = self.col_users.find_one({"username": user1, "active": True})
-        user1_id = user1["_id"]
-
-        # Get the user id of the liked user
-        user2 = self.col_users.find_one({"username": user2, "active": True})
-        user2_id = user2["_id"]
-
         package = {
             "_id": package_id,
             "active": True,
@@ -352,15 +574,16 @@ class UserManagement:
             "deleted_at": None
         }
 
-        self.col_likes.insert_one(package)
-
-        # Update the user's likes
-        self.col_users.update_one({"_id": user1_id, "active": True}, {"$push": {"likes": package_id}})
+        await self.col_likes.insert_one(package)
 
-        # Update the liked user's likes
-        self.col_users.update_one({"_id": user2_id, "active": True}, {"$push": {"likes": package_id}})
+        # Update the user's and the liked user's likes and the counters
+        await asyncio.gather(
+            self.col_users.update_one({"_id": user1_id, "active": True}, {"$push": {"likes": package_id}}),
+            self.col_users.update_one({"_id": user2_id, "active": True}, {"$push": {"likes": package_id}}),
+            self.counters.like(user1_id, user2_id)
+        )
 
-    def create_match(self, user1_id, user2_id):
+    async def create_match(self, user1_id, user2_id):
         """
         1. Make sure both users like each other
         2. Deactivate like objects in like collection (like ids can stay under user profile to link users to deactivated likes)
@@ -374,14 +597,16 @@ class UserManagement:
         package_id = ObjectId()
 
         # Check if the custom _id is already in use (unlikely but possible)
-        while self.col_matches.find_one({"_id": package_id}):
+        while await self.col_matches.find_one({"_id": package_id}, {"_id": 1}):
             package_id = ObjectId()  # Generate a new custom _id
 
         # Check that both users have liked each other
-        query1 = self.col_likes.find_one(
-            {"user_id": user2_id, "liked_user_id": user1_id, "active": True, "is_like": True})
-        query2 = self.col_likes.find_one(
-            {"user_id": user1_id, "liked_user_id": user2_id, "active": True, "is_like": True})
+        query1, query2 = await asyncio.gather(
+            self.col_likes.find_one({"user_id": user2_id, "liked_user_id": user1_id, "active": True, "is_like": True},
+                                    {"_id": 1}),
+            self.col_likes.find_one({"user_id": user1_id, "liked_user_id": user2_id, "active": True, "is_like": True},
+                                    {"_id": 1})
+        )
 
         if query1 is None or query2 is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Users do not have a match")
@@ -390,14 +615,17 @@ class UserManagement:
         dt_object = datetime.datetime.now()
 
         # Deactivate like objects in like collection
-        self.col_likes.update_one({"user_id": user1_id, "liked_user_id": user2_id, "active": True, "is_like": True},
-                                  {"$set": {"active": False, "deleted_at": dt_object}})
-
-        self.col_likes.update_one({"user_id": user2_id, "liked_user_id": user1_id, "active": True, "is_like": True},
-                                  {"$set": {"active": False, "deleted_at": dt_object}})
+        await asyncio.gather(
+            self.col_likes.update_one(
+                {"user_id": user1_id, "liked_user_id": user2_id, "active": True, "is_like": True},
+                {"$set": {"active": False, "deleted_at": dt_object}}),
+            self.col_likes.update_one(
+                {"user_id": user2_id, "liked_user_id": user1_id, "active": True, "is_like": True},
+                {"$set": {"active": False, "deleted_at": dt_object}})
+        )
 
         # Create match object in match collection
-        self.col_matches.insert_one({
+        await self.col_matches.insert_one({
             "_id": package_id,
             "active": True,
             "user_id": user1_id,
@@ -406,11 +634,20 @@ class UserManagement:
             "deleted_at": None
         })
 
-        # Add match id to both users
-        self.col_users.update_one({"_id": user1_id, "active": True}, {"$push": {"matches": package_id}})
-        self.col_users.update_one({"_id": user2_id, "active": True}, {"$push": {"matches": package_id}})
+        # Add match id to both users, both likes turned into one match
+        await asyncio.gather(
+            self.col_users.update_one({"_id": user1_id, "active": True}, {"$push": {"matches": package_id}}),
+            self.col_users.update_one({"_id": user2_id, "active": True}, {"$push": {"matches": package_id}}),
+            self.counters.apply({
+                user1_id: {"likes_sent": -1, "likes_received": -1, "matches": 1},
+                user2_id: {"likes_sent": -1, "likes_received": -1, "matches": 1}
+            })
+        )
 
-    def dislike(self, user1, user2) -> bool:
+        # Let both users know about the match
+        await self.publish_pair_event("match", user1_id, user2_id)
+
+    async def dislike(self, user1, user2) -> bool:
         """
         0. Check if users have a match --> deactivate match
         1. Check if user 1 has liked user 2 before --> Delete like object and remove like id from both users
@@ -419,47 +656,36 @@ class UserManagement:
         :return:
         """
         # Get users
-        user1 = self.col_users.find_one({"username": user1, "active": True})
-        user2 = self.col_users.find_one({"username": user2, "active": True})
-
-        # Get user ids
-        user1_id = user1["_id"]
-        user2_id = user2["_id"]
+        user1, user2 = await asyncio.gather(
+            self.col_users.find_one({"username": user1, "active": True}, {"_id": 1}),
+            self.col_users.find_one({"username": user2, "active": True}, {"_id": 1})
+        )
 
         # Check if the users are None
         if user1 is None or user2 is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
 
+        # Get user ids
+        user1_id = user1["_id"]
+        user2_id = user2["_id"]
+
         # Check if users have a match
-        query1 = self.col_matches.find_one({"user1_id": user1_id, "user2_id": user2_id, "active": True})
-        query2 = self.col_matches.find_one({"user1_id": user2_id, "user2_id": user1_id, "active": True})
+        query1, query2 = await asyncio.gather(
+            self.col_matches.find_one({"user_id": user1_id, "matched_user_id": user2_id, "active": True}, {"_id": 1}),
+            self.col_matches.find_one({"user_id": user2_id, "matched_user_id": user1_id, "active": True}, {"_id": 1})
+        )
 
         if query1 is not None or query2 is not None:
-            self.delete_match(user1_id, user2_id)
-
-        # Check if user 1 has liked user 2 before
-        query = self.col_likes.find_one(
-            {"user_id": user1_id, "liked_user_id": user2_id, "active": True, "is_like": True})
+            await self.delete_match(user1_id, user2_id)
 
-        if query is not None:
-            # Deactivate like object in like collection
-            self.col_likes.update_one({"user_id": user1_id, "liked_user_id": user2_id, "active": True, "is_like": True},
-                                      {"$set": {"active": False, "deleted_at": datetime.datetime.now()}})
-
-        # Check if user 2 has liked user 1 before
-        query = self.col_likes.find_one(
-            {"user_id": user2_id, "liked_user_id": user1_id, "active": True, "is_like": True})
-
-        if query is not None:
-            # Deactivate like object in like collection
-            self.col_likes.update_one({"user_id": user2_id, "liked_user_id": user1_id, "active": True, "is_like": True},
-                                      {"$set": {"active": False, "deleted_at": datetime.datetime.now()}})
+        # Deactivate the likes of both directions, the update only matches an active like
+        await asyncio.gather(self.deactivate_like(user1_id, user2_id), self.deactivate_like(user2_id, user1_id))
 
         # Create unique id
         package_id = ObjectId()
 
         # Check if the custom _id is already in use (unlikely but possible)
-        while self.col_likes.find_one({"_id": package_id}):
+        while await self.col_likes.find_one({"_id": package_id}, {"_id": 1}):
             package_id = ObjectId()
 
         # Create dislike package
@@ -474,15 +700,32 @@ class UserManagement:
         }
 
         # Insert dislike package
-        self.col_likes.insert_one(package)
+        await self.col_likes.insert_one(package)
 
         # Update the user's likes
-        self.col_users.update_one({"_id": user1_id, "active": True}, {"$push": {"likes": package_id}})
-        self.col_users.update_one({"_id": user2_id, "active": True}, {"$push": {"likes": package_id}})
+        await asyncio.gather(
+            self.col_users.update_one({"_id": user1_id, "active": True}, {"$push": {"likes": package_id}}),
+            self.col_users.update_one({"_id": user2_id, "active": True}, {"$push": {"likes": package_id}})
+        )
 
         return True
 
-    def delete_match(self, user1_id, user2_id):
+    async def deactivate_like(self, user_id, liked_user_id):
+        """
+        Deactivates the active like of user to liked user if there is one and takes it out of the counters
+        :param user_id:
+        :param liked_user_id:
+        :return:
+        """
+        # Deactivate like object in like collection
+        result = await self.col_likes.update_one(
+            {"user_id": user_id, "liked_user_id": liked_user_id, "active": True, "is_like": True},
+            {"$set": {"active": False, "deleted_at": datetime.datetime.now()}})
+
+        if result.modified_count:
+            await self.counters.like(user_id, liked_user_id, -1)
+
+    async def delete_match(self, user1_id, user2_id):
         """
         1. Make sure the match exists
         2. Deactivate match object in match collection
@@ -491,8 +734,10 @@ class UserManagement:
         :return:
         """
         # Check if match exists
-        query1 = self.col_matches.find_one({"user_id": user1_id, "matched_user_id": user2_id, "active": True})
-        query2 = self.col_matches.find_one({"user_id": user2_id, "matched_user_id": user1_id, "active": True})
+        query1, query2 = await asyncio.gather(
+            self.col_matches.find_one({"user_id": user1_id, "matched_user_id": user2_id, "active": True}, {"_id": 1}),
+            self.col_matches.find_one({"user_id": user2_id, "matched_user_id": user1_id, "active": True}, {"_id": 1})
+        )
 
         # If both queries are None, then there is no match
         if query1 is None and query2 is None:
@@ -501,15 +746,45 @@ class UserManagement:
         # Deactivate match object in match collection
         if query1 is not None:
             # Deactivate match object in match collection
-            self.col_matches.update_one({"_id": query1["_id"], "active": True},
-                                        {"$set": {"active": False, "deleted_at": datetime.datetime.now()}})
+            result = await self.col_matches.update_one(
+                {"_id": query1["_id"], "active": True},
+                {"$set": {"active": False, "deleted_at": datetime.datetime.now()}})
+
+            if result.modified_count:
+                await self.counters.match(user1_id, user2_id, -1)
 
         if query2 is not None:
             # Deactivate match object in match collection
-            self.col_matches.update_one({"_id": query2["_id"], "active": True},
-                                        {"$set": {"active": False, "deleted_at": datetime.datetime.now()}})
+            result = await self.col_matches.update_one(
+                {"_id": query2["_id"], "active": True},
+                {"$set": {"active": False, "deleted_at": datetime.datetime.now()}})
+
+            if result.modified_count:
+                await self.counters.match(user1_id, user2_id, -1)
+
+        # Let both users know about the unmatch
+        await self.publish_pair_event("unmatch", user1_id, user2_id)
+
+    async def publish_pair_event(self, event: str, user1_id: ObjectId, user2_id: ObjectId):
+        """
+        Publishes the event to both users with the other user's username
+        Usernames are only looked up when one of the users has an open stream
+        :param event:
+        :param user1_id:
+        :param user2_id:
+        :return:
+        """
+        if not self.event_bus.is_subscribed(user1_id) and not self.event_bus.is_subscribed(user2_id):
+            return
+
+        # Get both usernames in one query
+        users = self.col_users.find({"_id": {"$in": [user1_id, user2_id]}}, {"username": 1})
+        usernames = {user["_id"]: user["username"] async for user in users}
 
-    def unmatched(self, user1, user2) -> bool:
+        self.event_bus.publish(user1_id, event, {"username": usernames.get(user2_id)})
+        self.event_bus.publish(user2_id, event, {"username": usernames.get(user1_id)})
+
+    async def unmatched(self, user1, user2) -> bool:
         """
         Unmatch users
         :param user1:
@@ -517,31 +792,36 @@ class UserManagement:
         :return:
         """
         # Get users
-        user1 = self.col_users.find_one({"username": user1, "active": True})
-        user2 = self.col_users.find_one({"username": user2, "active": True})
-
-        # Get user ids
-        user1_id = user1["_id"]
-        user2_id = user2["_id"]
+        user1, user2 = await asyncio.gather(
+            self.col_users.find_one({"username": user1, "active": True}, {"_id": 1}),
+            self.col_users.find_one({"username": user2, "active": True}, {"_id": 1})
+        )
 
         # Check if the users are None
         if user1 is None or user2 is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
 
+        # Get user ids
+        user1_id = user1["_id"]
+        user2_id = user2["_id"]
+
         # delete match
-        self.delete_match(user1_id, user2_id)
+        await self.delete_match(user1_id, user2_id)
 
         return True
 
-    def get_matches(self, username: str) -> list:
+    async def get_matches(self, username: str, fields: str = None) -> list:
         """
-        1. Get all matches by id
-        2. Get user info for each match
+        1. Get all active matches by id in one query
+        2. Get the cards of the matched users in one batch
         :param username:
+        :param fields: comma separated card fields, all by default
         :return:
         """
+        schema = select_fields(MATCH_CARD_SCHEMA, fields)
+
         # Get user
-        user = self.col_users.find_one({"username": username, "active": True})
+        user = await self.col_users.find_one({"username": username, "active": True}, {"matches": 1})
 
         if user is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
@@ -549,22 +829,29 @@ class UserManagement:
         # Get user id
         user_id = user["_id"]
 
-        # Get all matches by id
-        matches = user["matches"]
+        # Get all active matches by id
+        matches = self.col_matches.find({"_id": {"$in": user["matches"]}, "active": True},
+                                        {"user_id": 1, "matched_user_id": 1})
+        matches = {match["_id"]: match async for match in matches}
 
-        # Get user info for each match
-        matches_info = []
+        # Matched user of every match, in the order the matches were made
+        matched_user_ids = []
 
-        for match_id in matches:
-            matched_user_info = self.get_user_info_matches(user_id, match_id)
+        for match_id in user["matches"]:
+            match = matches.get(match_id)
 
-            # Check that the matched user is not empty
-            if matched_user_info != {}:
-                matches_info.append(matched_user_info)
+            if match is None:
+                continue
+
+            matched_user_ids.append(match["user_id"] if match["user_id"] != user_id else match["matched_user_id"])
 
-        return matches_info
+        # Get user info for each match, inactive users are left out
+        cards = await self.profile_cards.get_many(matched_user_ids, schema)
 
-    def get_user_info_matches(self, user_id: ObjectId, match_id: ObjectId) -> dict:
+        return [ProfileCards.render(cards[matched_user_id], schema)
+                for matched_user_id in matched_user_ids if matched_user_id in cards]
+
+    async def get_user_info_matches(self, user_id: ObjectId, match_id: ObjectId) -> dict:
         """
         Use user_id to know which one is the user and which one is the match
         Get basic information about the matched user
@@ -573,7 +860,7 @@ class UserManagement:
         :return:
         """
         # Get match
-        match = self.col_matches.find_one({"_id": match_id, "active": True})
+        match = await self.col_matches.find_one({"_id": match_id, "active": True})
 
         # Check if the match is None
         if match is None:
@@ -582,57 +869,24 @@ class UserManagement:
         # Get user2 id from the match
         user2_id = match["user_id"] if match["user_id"] != user_id else match["matched_user_id"]
 
-        # Get user2
-        user2 = self.col_users.find_one({"_id": user2_id, "active": True})
+        # Get user2 card
+        card = await self.profile_cards.get(user2_id)
 
         # Make sure the user2 is not None, if so then skip
-        if user2 is None:
+        if card is None:
             return {}
 
-        # Schema to deliver of user 2
-        schema = ["username", "email", "discord_username", "profile_picture", "natural_languages", "background",
-                  "looking_for", "how_contribute"]
-
-        user2_info = {field: user2[field] for field in schema}
-
-        return user2_info
+        return ProfileCards.render(card, MATCH_CARD_SCHEMA)
 
-    def get_likes(self, user) -> dict:
+    async def get_likes(self, user, fields: str = None) -> dict:
         """
         1. Get all likes by id
         2. Get user info for each like
         :param user:
+        :param fields: comma separated card fields, all by default
         :return:
         """
-        # Get user
-        user = self.col_users.find_one({"username": user, "active": True})
-
-        if user is None:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
-
-        # Get user id
-        user_id = user["_id"]
-
-        # Get all likes by id
-        likes = user["likes"]
-
-        # List of all users that the user has liked
-        user_liked = []
-
-        # List of all users that have liked the user
-        liked_user = []
-
-        # Get users that the user has liked
-        for like_id in likes:
-            user_info, user_liked_flag, liked_user_flag = self.get_user_info_likes(user_id, like_id)
-
-            # Check that the liked user is not empty, then append
-            if user_info != {} and user_liked_flag is True:
-                user_liked.append(user_info)
-
-            # Check that the liked user is not empty, then append
-            if user_info != {} and liked_user_flag is True:
-                liked_user.append(user_info)
+        user_liked, liked_user = await self.get_like_cards(user, True, fields)
 
         # Combine the two lists into dict
         likes_info = {
@@ -642,15 +896,36 @@ class UserManagement:
 
         return likes_info
 
-    def get_dislikes(self, user) -> dict:
+    async def get_dislikes(self, user) -> dict:
         """
-        1. Get all likes by id
-        2. Get user info for each like
+        1. Get all dislikes by id
+        2. Get user info for each dislike
         :param user:
         :return:
         """
+        user_disliked, disliked_user = await self.get_like_cards(user, False)
+
+        # Combine the two lists into dict
+        dislikes_info = {
+            "user_disliked": user_disliked,
+            "disliked_user": disliked_user
+        }
+
+        return dislikes_info
+
+    async def get_like_cards(self, username: str, is_like: bool = True, fields: str = None):
+        """
+        Gets the cards of users the user has liked and users that have liked the user,
+        one query for the likes and one batch for the cards
+        :param username:
+        :param is_like: False for dislikes
+        :param fields: comma separated card fields, all by default
+        :return: (cards of users the user liked, cards of users that liked the user)
+        """
+        schema = select_fields(LIKE_CARD_SCHEMA, fields)
+
         # Get user
-        user = self.col_users.find_one({"username": user, "active": True})
+        user = await self.col_users.find_one({"username": username, "active": True}, {"likes": 1})
 
         if user is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
@@ -658,36 +933,48 @@ class UserManagement:
         # Get user id
         user_id = user["_id"]
 
-        # Get all likes by id
-        likes = user["likes"]
+        # Get all active likes by id
+        likes = self.col_likes.find({"_id": {"$in": user["likes"]}, "active": True, "is_like": is_like},
+                                    {"user_id": 1, "liked_user_id": 1})
+        likes = {like["_id"]: like async for like in likes}
+
+        # Other user of every like and whether the user was the one who liked, in the order of the likes
+        edges = []
+
+        for like_id in user["likes"]:
+            like = likes.get(like_id)
+
+            if like is None:
+                continue
+
+            if like["user_id"] == user_id:
+                edges.append((like["liked_user_id"], True))
+            else:
+                edges.append((like["user_id"], False))
+
+        # Get user info for each like, inactive users are left out
+        cards = await self.profile_cards.get_many([other_id for other_id, _ in edges], schema)
 
         # List of all users that the user has liked
-        user_disliked = []
+        user_liked = []
 
         # List of all users that have liked the user
-        disliked_user = []
-
-        # Get users that the user has liked
-        for like_id in likes:
-            user_info, user_disliked_flag, disliked_user_flag = self.get_user_info_likes(user_id, like_id, False)
+        liked_user = []
 
-            # Check that the liked user is not empty, then append
-            if user_info != {} and user_disliked_flag is True:
-                user_disliked.append(user_info)
+        for other_id, user_liked_flag in edges:
+            if other_id not in cards:
+                continue
 
-            # Check that the liked user is not empty, then append
-            if user_info != {} and disliked_user_flag is True:
-                disliked_user.append(user_info)
+            card = ProfileCards.render(cards[other_id], schema)
 
-        # Combine the two lists into dict
-        dislikes_info = {
-            "user_disliked": user_disliked,
-            "disliked_user": disliked_user
-        }
+            if user_liked_flag:
+                user_liked.append(card)
+            else:
+                liked_user.append(card)
 
-        return dislikes_info
+        return user_liked, liked_user
 
-    def get_user_info_likes(self, user_id: ObjectId, like_id: ObjectId, is_like: bool = True):
+    async def get_user_info_likes(self, user_id: ObjectId, like_id: ObjectId, is_like: bool = True):
         """
         Use user_id to know which one is the user and which one is the liked user
         Get basic information about the liked user
@@ -701,7 +988,7 @@ class UserManagement:
         liked_user_flag = False
 
         # Get like, Also make sure the like is active
-        like = self.col_likes.find_one({"_id": like_id, "active": True, "is_like": is_like})
+        like = await self.col_likes.find_one({"_id": like_id, "active": True, "is_like": is_like})
 
         # Make sure the like is not None
         if like is None:
@@ -716,29 +1003,48 @@ class UserManagement:
         # Get liked user id from the like
         liked_user_id = like["liked_user_id"] if user_liked_flag else like["user_id"]
 
-        # Get liked user
-        liked_user = self.col_users.find_one({"_id": liked_user_id, "active": True})
+        # Get liked user card
+        card = await self.profile_cards.get(liked_user_id)
 
         # Make sure the liked user is not None, if so then skip
-        if liked_user is None:
+        if card is None:
             return {}, user_liked_flag, liked_user_flag
 
-        # Schema to deliver of liked user
-        schema = ["username", "profile_picture", "natural_languages", "background",
-                  "looking_for", "how_contribute"]
+        return ProfileCards.render(card, LIKE_CARD_SCHEMA), user_liked_flag, liked_user_flag
+
+    async def get_user_id(self, username: str) -> ObjectId:
+        """
+        Gets the id of an active user
+        :param username:
+        :return:
+        """
+        user = await self.col_users.find_one({"username": username, "active": True}, {"_id": 1})
+
+        if user is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
 
-        liked_user_info = {field: liked_user[field] for field in schema}
+        return user["_id"]
 
-        return liked_user_info, user_liked_flag, liked_user_flag
+    async def get_counts(self, username: str) -> dict:
+        """
+        Gets the badge counters of the user without loading any profiles
+        :param username:
+        :return:
+        """
+        return await self.counters.get_counts(await self.get_user_id(username))
 
-    def get_discover_users(self, username: str) -> list:
+    async def get_discover_users(self, username: str, fields: str = None) -> list:
         """
         Gets up to 100 users that the user has not liked or disliked or matched
-        Then sort them by last_login
+        sorted by last_login
+        :param username:
+        :param fields: comma separated card fields, all by default
         :return:
         """
+        schema = select_fields(LIKE_CARD_SCHEMA, fields)
+
         # Get user
-        user = self.col_users.find_one({"username": username, "active": True})
+        user = await self.col_users.find_one({"username": username, "active": True}, {"likes": 1, "matches": 1})
 
         if user is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User does not exist")
@@ -746,122 +1052,110 @@ class UserManagement:
         # Get user id
         user_id = user["_id"]
 
-        # Get all likes by id
-        likes = user["likes"]
+        # List of all user ids to exclude, start with the user itself
+        exclude = {user_id}
 
-        # Get all matches by id
-        matches = user["matches"]
+        # Active likes and dislikes of both directions and active matches, both at the same time
+        likes, matches = await asyncio.gather(
+            self.find_all(self.col_likes, user["likes"], {"user_id": 1, "liked_user_id": 1}),
+            self.find_all(self.col_matches, user["matches"], {"user_id": 1, "matched_user_id": 1})
+        )
 
-        # Get all users
-        users = self.col_users.find({"active": True})
+        # Add the other user of every active like and dislike
+        for like in likes:
+            exclude.add(like["user_id"])
+            exclude.add(like["liked_user_id"])
 
-        # List of all users that the user has liked
-        user_liked = self.get_likes(username)["user_liked"]
+        # Add the other user of every active match
+        for match in matches:
+            exclude.add(match["user_id"])
+            exclude.add(match["matched_user_id"])
 
-        # List of all users that have liked the user
-        liked_user = self.get_likes(username)["liked_user"]
+        # Get up to 100 users that the user has not liked or disliked or matched, newest login first
+        users = self.col_users.find({"_id": {"$nin": list(exclude)}, "active": True}, {"_id": 1}) \
+            .sort("last_login", pymongo.DESCENDING).limit(100)
+        user_ids = [user["_id"] async for user in users]
 
-        # List of all users that the user has matched
-        user_matched = self.get_matches(username)
+        # Create the user data
+        cards = await self.profile_cards.get_many(user_ids, schema)
 
-        # List of all users that the user has disliked
-        user_disliked = self.get_dislikes(username)["user_disliked"]
+        return [ProfileCards.render(cards[discover_id], schema)
+                for discover_id in user_ids if discover_id in cards]
 
-        # List of all users that have disliked the user
-        disliked_user = self.get_dislikes(username)["disliked_user"]
+    @staticmethod
+    async def find_all(collection, ids: list, projection: dict) -> list:
+        # Active documents by id, no query for an empty list
+        if not ids:
+            return []
 
-        # Check if the user has liked or matched or disliked anyone
-        if len(likes) == 0 and len(matches) == 0:
-            users = list(users)[:100]
-            # Sort users by last_login
-            users = sorted(users, key=lambda x: x["last_login"], reverse=True)
-            return users
+        return await collection.find({"_id": {"$in": ids}, "active": True}, projection).to_list(length=None)
 
-        # List of all usernames to exclude, start with the user's username
-        exclude = [username]
 
-        # Add all users that the user has liked to exclude
-        for user in user_liked:
-            exclude.append(user["username"])
+class SyncUserManagement:
+    """
+    Blocking UserManagement for scripts, every coroutine method runs to completion on a private event loop
+    """
 
-        # Add all users that have liked the user to exclude
-        for user in liked_user:
-            exclude.append(user["username"])
+    def __init__(self, client=None, database_name: str = "codespark", **kwargs):
+        self.loop = asyncio.new_event_loop()
 
-        # Add all users that the user has matched to exclude
-        for user in user_matched:
-            exclude.append(user["username"])
+        # Motor client bound to the private loop
+        if client is None:
+            client = database.create_async_client(io_loop=self.loop)
 
-        # Add all users that the user has disliked to exclude
-        for user in user_disliked:
-            exclude.append(user["username"])
+        self.client = client
 
-        # Add all users that have disliked the user to exclude
-        for user in disliked_user:
-            exclude.append(user["username"])
+        # Nothing runs the private loop between calls, so cascades finish inside delete_user
+        db = self.client[database_name]
+        kwargs.setdefault("cascade", DeactivationCascade(db, background=False))
 
-        # Get all users that the user has not liked or disliked or matched
-        users = self.col_users.find({"username": {"$nin": exclude}, "active": True})
+        self.user_management = UserManagement(db, **kwargs)
 
-        # Check that users is not none
-        if users is None:
-            return []
+    def __getattr__(self, name):
+        attribute = getattr(self.user_management, name)
 
-        users = list(users)
+        if not inspect.iscoroutinefunction(attribute):
+            return attribute
 
-        # Check if the user has liked or matched or disliked anyone
-        if users == 0:
-            return []
+        def call(*args, **kwargs):
+            return self.run(attribute(*args, **kwargs))
 
-        # Get up to 100 users
-        users_list = users[:100]
+        return call
 
-        # Sort users by last_login datetime
-        users_list = sorted(users_list, key=lambda x: x["last_login"], reverse=True)
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
 
-        # Schema to deliver of user_list
-        schema = ["username", "profile_picture", "natural_languages", "background",
-                  "looking_for", "how_contribute"]
+    def close(self):
+        self.client.close()
+        self.loop.close()
 
-        # Create the user data
-        users_list = [{field: user[field] for field in schema} for user in users_list]
-
-        return users_list
 
-
-def reset_database(user_management: UserManagement):
+async def reset_database(user_management: UserManagement):
     """
     1. Empty likes collection
     2. Empty matches collections
     3. Empty sessions collections
-    4. Loop through every user and empty their likes and matches
+    4. Empty the likes and matches of every user
     :return:
     """
-    # Empty likes collection
-    user_management.col_likes.delete_many({})
-
-    # Empty matches collections
-    user_management.col_matches.delete_many({})
+    # Empty likes, matches and sessions collections
+    await asyncio.gather(
+        user_management.col_likes.delete_many({}),
+        user_management.col_matches.delete_many({}),
+        user_management.col_sessions.delete_many({})
+    )
 
-    # Empty sessions collections
-    user_management.col_sessions.delete_many({})
-
-    # Loop through every user and empty their likes and matches
-    for user in user_management.col_users.find({}):
-        user_management.col_users.update_one({"_id": user["_id"]}, {"$set": {"likes": [], "matches": []}})
+    # Empty the likes and matches of every user in one write
+    await user_management.col_users.update_many({}, {"$set": {"likes": [], "matches": []}})
 
 
 def main():
     load_dotenv()
-    mongo_uri = os.getenv("MONGO_URI")
-
-    client = pymongo.MongoClient(mongo_uri)
-    db = client["codespark"]
 
-    user_management = UserManagement(db)
+    user_management = SyncUserManagement()
 
     # Reset database
-    reset_database(user_management)
+    user_management.run(reset_database(user_management.user_management))
 
     # Test get user profile
     # print(user_management.get_user_profile("Al1babax"))
@@ -877,6 +1171,8 @@ def main():
     # user_management.like("user0", "Al1babax")
     user_management.like("user5", "Al1babax")
 
+    user_management.close()
+
     # Test unmatched
     # user_management.unmatched("Al1babax", "user0")
     # user_management.unmatched("user0", "Al1babax")
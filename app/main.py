@@ -1,10 +1,13 @@
-from typing import Optional
+from typing import Optional, List
+from contextlib import asynccontextmanager
+import asyncio
 import hmac
+import httpx
 import uvicorn
-from fastapi import FastAPI, Response, status, HTTPException, Cookie, Form, UploadFile, File, Request, Depends, Body, \
-    Header
+from fastapi import FastAPI, APIRouter, Response, status, HTTPException, Cookie, Form, UploadFile, File, Request, \
+    Depends, Body, Header, Query
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.security import HTTPBasicCredentials, OAuth2AuthorizationCodeBearer
 from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
@@ -15,43 +18,121 @@ import requests
 import base64
 from configparser import ConfigParser
 import json
+import os
 from starlette.responses import HTMLResponse
 from starlette import status
+from starlette.concurrency import run_in_threadpool
 
 # TODO: Create functions to revoke access token and delete session
-# TODO: Change all monogdb functions to use motor instead for async
 
 # Custom utils
 import utils.database as database
 from functions.oauth import OauthWorkflow
 from utils.basic import BasicUtils
+from utils.etag import compute_etag, etag_matches
+from utils.responses import ORJSONResponse
+from utils.schemas import Profile, Likes, MatchCard, LikeCard, Counts
+from utils.uploads import MAX_IMAGE_BYTES, UploadSizeLimitMiddleware, stream_upload
+from utils.file_responses import image_response, IMMUTABLE_CACHE, SHORT_CACHE
+from utils.metrics import Metrics, CommandMetrics, PoolMetrics, metrics_middleware, stats_collector, CONTENT_TYPE
+from utils.query_budget import QueryBudget, QueryListener, query_budget_middleware
+from utils.profiling import RequestProfiler, ProfilingMiddleware
+from utils.rate_limit import RateLimiter, check_rate_limit
+from utils.compression import CompressionMiddleware
+from utils.cache import Caches
 
 # Custom functions
 from functions.user_management import verify_session_id, UserManagement
+from functions.events import EventBus
+from functions.image_pipeline import ImagePipeline
+from functions.image_storage import ImageStorage
+from functions.image_cache import ImageCache
+from functions.indexes import ensure_indexes
+from functions.cascade import DeactivationCascade
 
-app = FastAPI()
+# Routes, added to every app made by create_app
+router = APIRouter()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
 dev_server_address = "http://localhost:3000"
 prod_server_address = "https://codespark-v2.vercel.app/"
 
 
-@app.get("/api/", tags=["testing"])
+def get_user_management(request: Request) -> UserManagement:
+    return request.app.state.user_management
+
+
+def get_event_bus(request: Request) -> EventBus:
+    return request.app.state.event_bus
+
+
+def get_image_cache(request: Request) -> ImageCache:
+    return request.app.state.image_cache
+
+
+def not_modified(etag: str) -> Response:
+    # Client copy is still current
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+
+def revalidated_json(content, if_none_match: str = None, etag: str = None) -> Response:
+    """
+    Renders the content once with orjson, the ETag is the hash of the body unless given
+    :param content:
+    :param if_none_match:
+    :param etag:
+    :return:
+    """
+    if etag is not None and etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    response = ORJSONResponse(content)
+
+    if etag is None:
+        etag = compute_etag(response.body)
+
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+
+    return response
+
+
+@router.get("/api/", tags=["testing"])
 async def root():
     return {"message": "Hello World"}
 
 
-@app.get("/api/login/github", tags=["login"])
-async def github_login(response: Response):
+@router.get("/api/stats/caches", tags=["internal"])
+async def cache_stats(user_management: UserManagement = Depends(get_user_management),
+                      image_cache: ImageCache = Depends(get_image_cache)):
+    """
+    Hit ratio and memory footprint of the caches, shared ones report their near cache in this worker
+    :param user_management:
+    :param image_cache:
+    :return:
+    """
+    return {**user_management.caches.stats(), "images": image_cache.stats()}
+
+
+@router.get("/metrics", tags=["internal"], include_in_schema=False)
+async def metrics(request: Request):
+    """
+    Prometheus metrics of every worker
+    :param request:
+    :return:
+    """
+    body = await run_in_threadpool(request.app.state.metrics.render)
+
+    return Response(content=body, media_type=CONTENT_TYPE)
+
+
+@router.get("/api/login/github", tags=["login"])
+async def github_login(response: Response, request: Request):
     # Create an oauth workflow
-    oauth_workflow = OauthWorkflow(db)
+    oauth_workflow = OauthWorkflow(request.app.state.db, request.app.state.http_client, request.app.state.caches)
 
     # Construct the login url
     uri = oauth_workflow.construct_login_url()
@@ -65,10 +146,10 @@ async def github_login(response: Response):
     return {"url": uri}
 
 
-@app.get("/api/oauth/github/session_id", tags=["login"])
-async def github_login_redirect(code: str, response: Response):
+@router.get("/api/oauth/github/session_id", tags=["login"])
+async def github_login_redirect(code: str, response: Response, request: Request):
     # Create an oauth workflow
-    oauth_workflow = OauthWorkflow(db)
+    oauth_workflow = OauthWorkflow(request.app.state.db, request.app.state.http_client, request.app.state.caches)
 
     # Run workflow
     package = await oauth_workflow.run(code)
@@ -83,12 +164,12 @@ async def github_login_redirect(code: str, response: Response):
     return package
 
 
-@app.get("/init_login", tags=["login"])
-async def init_login(code: str, response: Response):
+@router.get("/init_login", tags=["login"])
+async def init_login(code: str, response: Response, request: Request):
     # Process the authentication code as needed and send back to client with a session id and username
 
     # Create an oauth workflow
-    oauth_workflow = OauthWorkflow(db)
+    oauth_workflow = OauthWorkflow(request.app.state.db, request.app.state.http_client, request.app.state.caches)
 
     # Run workflow
     package = await oauth_workflow.run(code)
@@ -123,8 +204,9 @@ async def init_login(code: str, response: Response):
     return HTMLResponse(content=html_content, status_code=status.HTTP_200_OK)
 
 
-@app.post("/api/update_profile", tags=["profile"], dependencies=[Depends(verify_session_id)])
-async def update_profile(response: Response, body: dict = Body(...), username: str = Header(None)):
+@router.post("/api/update_profile", tags=["profile"], dependencies=[Depends(verify_session_id)])
+async def update_profile(response: Response, body: dict = Body(...), username: str = Header(None),
+                         user_management: UserManagement = Depends(get_user_management)):
     # Check if the body is None
     if body is None:
         response.status_code = status.HTTP_400_BAD_REQUEST
@@ -136,25 +218,28 @@ async def update_profile(response: Response, body: dict = Body(...), username: s
         return {"message": "No username provided"}
 
     # Update the user profile
-    success = user_management.update_user_profile(username, body)
+    changed = await user_management.update_user_profile(username, body)
 
     # Check if the update was successful
-    if not success:
+    if changed is None:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return {"message": "Internal server error"}
 
-    # Return the response
+    # Return the response with the fields that changed
     response.status_code = status.HTTP_200_OK
-    return {"message": "Profile updated"}
+    return {"message": "Profile updated", "changed": changed}
 
 
-@app.post("/api/upload_profile_picture", tags=["profile"], dependencies=[Depends(verify_session_id)])
-async def upload_profile_picture(response: Response, body: dict = Body(...), username: str = Header(None)):
+@router.post("/api/upload_profile_picture", tags=["profile"], dependencies=[Depends(verify_session_id)])
+async def upload_profile_picture(response: Response, body: dict = Body(...), username: str = Header(None),
+                                 user_management: UserManagement = Depends(get_user_management)):
     """
     Profile picture is encoded as a base64 string in body["image"]
+    Kept for old clients, new clients use the multipart upload
     :param response:
     :param body:
     :param username:
+    :param user_management:
     :return:
     """
     # Check if the body is None
@@ -168,15 +253,25 @@ async def upload_profile_picture(response: Response, body: dict = Body(...), use
         return {"message": "No username provided"}
 
     # Check if the image is None
-    if body["image"] is None:
+    if body.get("image") is None:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"message": "No image provided"}
 
-    # Decode the image
-    image = base64.b64decode(body["image"])
+    # Check that the image is a base64 string
+    if not isinstance(body["image"], str):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message": "Image must be a base64 string"}
+
+    # Check the decoded size before decoding
+    if len(body["image"]) * 3 // 4 > MAX_IMAGE_BYTES:
+        response.status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        return {"message": "Image is too large"}
+
+    # Decode the image off the event loop
+    image = await run_in_threadpool(base64.b64decode, body["image"])
 
     # Upload the image
-    success = user_management.upload_profile_picture(username, image)
+    success = await user_management.upload_profile_picture(username, image)
 
     # Check if the upload was successful
     if not success:
@@ -188,13 +283,53 @@ async def upload_profile_picture(response: Response, body: dict = Body(...), use
     return {"message": "Profile picture uploaded"}
 
 
-@app.get("/api/get_profile_picture/{file_name}", tags=["profile"])
-async def get_profile_picture(response: Response, file_name: str):
+@router.post("/api/upload_profile_picture_file", tags=["profile"], dependencies=[Depends(verify_session_id)])
+async def upload_profile_picture_file(response: Response, file: UploadFile = File(...), username: str = Header(None),
+                                      user_management: UserManagement = Depends(get_user_management)):
     """
-    Gets the users profile picture
+    Profile picture as a multipart file, streamed to disk in chunks
     :param response:
-    :param file_name:
+    :param file:
     :param username:
+    :param user_management:
+    :return:
+    """
+    # Check if the username is None
+    if username is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message": "No username provided"}
+
+    # Stream the image to a temporary file next to the stored ones, checks size and type on the way
+    temp_path, size, content_type, extension, digest = await stream_upload(file, user_management.image_storage.root)
+
+    # Move the file in place under its content hash and update the profile
+    success = await user_management.store_uploaded_picture(username, temp_path, digest, extension)
+
+    # Check if the upload was successful
+    if not success:
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return {"message": "Internal server error"}
+
+    # Return the response
+    response.status_code = status.HTTP_200_OK
+    return {"message": "Profile picture uploaded"}
+
+
+@router.get("/api/get_profile_picture/{file_name}", tags=["profile"])
+async def get_profile_picture(request: Request, response: Response, file_name: str,
+                              size: int = Query(None, ge=1, le=2048), accept: str = Header(None),
+                              user_management: UserManagement = Depends(get_user_management),
+                              image_cache: ImageCache = Depends(get_image_cache)):
+    """
+    Gets the users profile picture, size picks a resized variant for lists and grids
+    Served with long lived caching, validators and byte ranges
+    :param request:
+    :param response:
+    :param file_name:
+    :param size: wanted width and height in pixels
+    :param accept: WebP variant is served when the client accepts it
+    :param user_management:
+    :param image_cache:
     :return:
     """
     # Check if the file_name is None
@@ -202,25 +337,69 @@ async def get_profile_picture(response: Response, file_name: str):
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"message": "No file_name provided"}
 
-    # Get the profile picture
-    profile_picture_path = user_management.get_profile_picture_path(file_name)
+    # Get the profile picture, hot files are found in the image cache without checking the disk
+    accept_webp = accept is not None and "image/webp" in accept
+    profile_picture_path = user_management.cached_picture_path(file_name, size, accept_webp) or \
+        await run_in_threadpool(user_management.get_profile_picture_path, file_name, size, accept_webp)
 
     # Check if the profile picture is None
     if profile_picture_path is None:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return {"message": "Internal server error"}
 
+    # File names are versioned, except an original served until the variant is ready
+    is_fallback = size is not None and os.path.basename(profile_picture_path) == file_name
+    cache_control = SHORT_CACHE if is_fallback else IMMUTABLE_CACHE
+
     # Return the profile picture
-    response.status_code = status.HTTP_200_OK
-    return FileResponse(profile_picture_path)
+    image = await image_response(profile_picture_path, request.headers, cache_control, image_cache)
+
+    # Variants depend on the Accept header
+    if size is not None:
+        image.headers["Vary"] = "Accept"
+
+    return image
+
+
+@router.get("/api/profile_image/{username}", tags=["profile"])
+async def profile_image(request: Request, username: str, size: int = Query(None, ge=1, le=2048),
+                        accept: str = Header(None), user_management: UserManagement = Depends(get_user_management),
+                        image_cache: ImageCache = Depends(get_image_cache)):
+    """
+    Current profile picture of a user by username, the url stays the same when the picture changes
+    :param request:
+    :param username:
+    :param size: wanted width and height in pixels
+    :param accept: WebP variant is served when the client accepts it
+    :param user_management:
+    :param image_cache:
+    :return:
+    """
+    # Find the users current picture
+    file_name = await user_management.get_profile_picture_file(username)
+
+    # Get the picture or its variant, from the image cache when it is hot
+    accept_webp = accept is not None and "image/webp" in accept
+    profile_picture_path = user_management.cached_picture_path(file_name, size, accept_webp) or \
+        await run_in_threadpool(user_management.get_profile_picture_path, file_name, size, accept_webp)
+
+    # Picture behind this url can change, clients revalidate with the ETag
+    image = await image_response(profile_picture_path, request.headers, SHORT_CACHE, image_cache)
+    image.headers["Vary"] = "Accept"
 
+    return image
 
-@app.get("/api/get_profile", tags=["profile"], dependencies=[Depends(verify_session_id)])
-async def get_profile(response: Response, username: str = Header(None)):
+
+@router.get("/api/get_profile", tags=["profile"], dependencies=[Depends(verify_session_id)],
+         responses={200: {"model": Profile}})
+async def get_profile(response: Response, username: str = Header(None), if_none_match: str = Header(None),
+                      user_management: UserManagement = Depends(get_user_management)):
     """
-    Gets the users full profile
+    Gets the users full profile, 304 when the client already has the current revision
     :param response:
     :param username:
+    :param if_none_match:
+    :param user_management:
     :return:
     """
     # TODO: Make sure only the owner can access their own profile, this should be the case already
@@ -230,8 +409,14 @@ async def get_profile(response: Response, username: str = Header(None)):
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"message": "No username provided"}
 
+    # Cheap version check before loading the profile
+    etag = await user_management.get_profile_etag(username)
+
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
     # Get the user profile
-    profile = user_management.get_user_profile(username)
+    profile = await user_management.get_user_profile(username)
 
     # Check if the profile is None
     if profile is None:
@@ -239,16 +424,21 @@ async def get_profile(response: Response, username: str = Header(None)):
         return {"message": "Internal server error"}
 
     # Return the profile
-    response.status_code = status.HTTP_200_OK
-    return profile
+    return revalidated_json(profile, etag=etag)
 
 
-@app.get("/api/get_likes", tags=["likes"], dependencies=[Depends(verify_session_id)])
-async def get_likes(response: Response, username: str = Header(None)):
+@router.get("/api/get_likes", tags=["likes"], dependencies=[Depends(verify_session_id)],
+         responses={200: {"model": Likes}})
+async def get_likes(response: Response, username: str = Header(None), if_none_match: str = Header(None),
+                    fields: str = Query(None, description="comma separated card fields, e.g. username,profile_picture"),
+                    user_management: UserManagement = Depends(get_user_management)):
     """
     Gets the users likes
     :param response:
     :param username:
+    :param if_none_match:
+    :param fields:
+    :param user_management:
     :return:
     """
     # Check if the username is None
@@ -257,24 +447,29 @@ async def get_likes(response: Response, username: str = Header(None)):
         return {"message": "No username provided"}
 
     # Get the users likes
-    likes = user_management.get_likes(username)
+    likes = await user_management.get_likes(username, fields)
 
     # Check if the likes is None
     if likes is None:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return {"message": "Internal server error"}
 
-    # Return the likes
-    response.status_code = status.HTTP_200_OK
-    return likes
+    # Return the likes, the client can revalidate the list with its ETag
+    return revalidated_json(likes, if_none_match)
 
 
-@app.get("/api/get_matches", tags=["matches"], dependencies=[Depends(verify_session_id)])
-async def get_matches(response: Response, username: str = Header(None)):
+@router.get("/api/get_matches", tags=["matches"], dependencies=[Depends(verify_session_id)],
+         responses={200: {"model": List[MatchCard]}})
+async def get_matches(response: Response, username: str = Header(None), if_none_match: str = Header(None),
+                      fields: str = Query(None, description="comma separated card fields, e.g. username,email"),
+                      user_management: UserManagement = Depends(get_user_management)):
     """
     Gets the users matches
     :param response:
     :param username:
+    :param if_none_match:
+    :param fields:
+    :param user_management:
     :return:
     """
     # Check if the username is None
@@ -283,24 +478,57 @@ async def get_matches(response: Response, username: str = Header(None)):
         return {"message": "No username provided"}
 
     # Get the users matches
-    matches = user_management.get_matches(username)
+    matches = await user_management.get_matches(username, fields)
 
     # Check if the matches is None
     if matches is None:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return {"message": "Internal server error"}
 
-    # Return the matches
-    response.status_code = status.HTTP_200_OK
-    return matches
+    # Return the matches, the client can revalidate the list with its ETag
+    return revalidated_json(matches, if_none_match)
 
 
-@app.get("/api/get_discovers", tags=["discovers"], dependencies=[Depends(verify_session_id)])
-async def get_discovers(response: Response, username: str = Header(None)):
+@router.get("/api/get_counts", tags=["counts"], dependencies=[Depends(verify_session_id)],
+         responses={200: {"model": Counts}})
+async def get_counts(response: Response, username: str = Header(None),
+                     user_management: UserManagement = Depends(get_user_management)):
+    """
+    Gets the users likes, likes you and matches counters for badges
+    :param response:
+    :param username:
+    :param user_management:
+    :return:
+    """
+    # Check if the username is None
+    if username is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message": "No username provided"}
+
+    # Get the users counters
+    counts = await user_management.get_counts(username)
+
+    # Check if the counts is None
+    if counts is None:
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return {"message": "Internal server error"}
+
+    # Return the counts
+    return ORJSONResponse(counts)
+
+
+@router.get("/api/get_discovers", tags=["discovers"], dependencies=[Depends(verify_session_id)],
+         responses={200: {"model": List[LikeCard]}})
+async def get_discovers(response: Response, username: str = Header(None), if_none_match: str = Header(None),
+                        fields: str = Query(None, description="comma separated card fields, e.g. username,background"),
+                        user_management: UserManagement = Depends(get_user_management)):
     """
     Gets the users discovers
     :param response:
     :param username:
+    :param if_none_match:
+    :param fields:
+    :param user_management:
     :return:
     """
     # Check if the username is None
@@ -309,24 +537,58 @@ async def get_discovers(response: Response, username: str = Header(None)):
         return {"message": "No username provided"}
 
     # Get the users discovers
-    discovers = user_management.get_discover_users(username)
+    discovers = await user_management.get_discover_users(username, fields)
 
     # Check if the discovers is None
     if discovers is None:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return {"message": "Internal server error"}
 
-    # Return the discovers
-    response.status_code = status.HTTP_200_OK
-    return discovers
+    # Return the discovers, the client can revalidate the list with its ETag
+    return revalidated_json(discovers, if_none_match)
 
 
-@app.delete("/api/delete_user", tags=["user"], dependencies=[Depends(verify_session_id)])
-async def delete_user(response: Response, username: str = Header(None)):
+@router.get("/api/events", tags=["events"], dependencies=[Depends(verify_session_id)])
+async def events(response: Response, username: str = Header(None),
+                 user_management: UserManagement = Depends(get_user_management),
+                 event_bus: EventBus = Depends(get_event_bus)):
+    """
+    Server-sent events stream of new likes, matches and unmatches of the user
+    :param response:
+    :param username:
+    :param user_management:
+    :param event_bus:
+    :return:
+    """
+    # Check if the username is None
+    if username is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message": "No username provided"}
+
+    user_id = await user_management.get_user_id(username)
+
+    # Check if the user has too many open streams, the stream subscribes once the response starts
+    if event_bus.is_full(user_id):
+        response.status_code = status.HTTP_429_TOO_MANY_REQUESTS
+        return {"message": "Too many open event streams"}
+
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    }
+
+    # Return the stream
+    return StreamingResponse(event_bus.stream(user_id), media_type="text/event-stream", headers=headers)
+
+
+@router.delete("/api/delete_user", tags=["user"], dependencies=[Depends(verify_session_id)])
+async def delete_user(response: Response, username: str = Header(None),
+                      user_management: UserManagement = Depends(get_user_management)):
     """
     Deletes the user
     :param response:
     :param username:
+    :param user_management:
     :return:
     """
     # raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="Not implemented")
@@ -337,7 +599,7 @@ async def delete_user(response: Response, username: str = Header(None)):
         return {"message": "No username provided"}
 
     # Delete the user
-    success = user_management.delete_user(username)
+    success = await user_management.delete_user(username)
 
     # Check if to delete was successful
     if not success:
@@ -349,13 +611,16 @@ async def delete_user(response: Response, username: str = Header(None)):
     return {"message": "User deleted"}
 
 
-@app.put("/api/like_user/{liked_username}", tags=["likes"], dependencies=[Depends(verify_session_id)])
-async def like_user(response: Response, liked_username: str, username: str = Header(None)):
+@router.put("/api/like_user/{liked_username}", tags=["likes"],
+            dependencies=[Depends(verify_session_id), Depends(check_rate_limit)])
+async def like_user(response: Response, liked_username: str, username: str = Header(None),
+                    user_management: UserManagement = Depends(get_user_management)):
     """
     Likes a user
     :param response:
     :param liked_username:
     :param username:
+    :param user_management:
     :return:
     """
     # Check if the liked_username is None
@@ -369,7 +634,7 @@ async def like_user(response: Response, liked_username: str, username: str = Hea
         return {"message": "No username provided"}
 
     # Like the user
-    success = user_management.like(username, liked_username)
+    success = await user_management.like(username, liked_username)
 
     # Check if the like was successful
     if not success:
@@ -381,13 +646,16 @@ async def like_user(response: Response, liked_username: str, username: str = Hea
     return {"message": "User liked"}
 
 
-@app.put("/api/dislike_user/{disliked_username}", tags=["likes"], dependencies=[Depends(verify_session_id)])
-async def dislike_user(response: Response, disliked_username: str, username: str = Header(None)):
+@router.put("/api/dislike_user/{disliked_username}", tags=["likes"],
+            dependencies=[Depends(verify_session_id), Depends(check_rate_limit)])
+async def dislike_user(response: Response, disliked_username: str, username: str = Header(None),
+                       user_management: UserManagement = Depends(get_user_management)):
     """
     Unlikes a user
     :param response:
     :param disliked_username:
     :param username:
+    :param user_management:
     :return:
     """
     # Check if the liked_username is None
@@ -401,7 +669,7 @@ async def dislike_user(response: Response, disliked_username: str, username: str
         return {"message": "No username provided"}
 
     # Unlike the user
-    success = user_management.dislike(username, disliked_username)
+    success = await user_management.dislike(username, disliked_username)
 
     # Check if the unlike was successful
     if not success:
@@ -413,13 +681,15 @@ async def dislike_user(response: Response, disliked_username: str, username: str
     return {"message": "User unliked"}
 
 
-@app.delete("/api/unmatch", tags=["matches"], dependencies=[Depends(verify_session_id)])
-async def unmatch(response: Response, matched_username: str, username: str = Header(None)):
+@router.delete("/api/unmatch", tags=["matches"], dependencies=[Depends(verify_session_id)])
+async def unmatch(response: Response, matched_username: str, username: str = Header(None),
+                  user_management: UserManagement = Depends(get_user_management)):
     """
     Unmatches a user
     :param response:
     :param matched_username:
     :param username:
+    :param user_management:
     :return:
     """
     # Check if the matched_username is None
@@ -433,7 +703,7 @@ async def unmatch(response: Response, matched_username: str, username: str = Hea
         return {"message": "No username provided"}
 
     # Unmatch the user
-    success = user_management.unmatched(username, matched_username)
+    success = await user_management.unmatched(username, matched_username)
 
     # Check if the unmatch was successful
     if not success:
@@ -445,12 +715,14 @@ async def unmatch(response: Response, matched_username: str, username: str = Hea
     return {"message": "User unmatched"}
 
 
-@app.get("/api/logout", tags=["user"], dependencies=[Depends(verify_session_id)])
-async def logout(response: Response, username: str = Header(None)):
+@router.get("/api/logout", tags=["user"], dependencies=[Depends(verify_session_id)])
+async def logout(response: Response, username: str = Header(None),
+                 user_management: UserManagement = Depends(get_user_management)):
     """
     Logs the user out
     :param response:
     :param username:
+    :param user_management:
     :return:
     """
     raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="Not implemented")
@@ -473,9 +745,140 @@ async def logout(response: Response, username: str = Header(None)):
     return {"message": "Logged out"}
 
 
+def create_app(db=None) -> FastAPI:
+    """
+    Builds the api. Resources are opened in the lifespan, so every worker process gets its own
+    database client, caches, http client and executors
+    :param db: database to use instead of connecting to MONGO_URI
+    :return:
+    """
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Latency, database and cache metrics of the worker
+        app.state.metrics = Metrics()
+
+        # Queries per request, off unless QUERY_BUDGET_MODE is warn or enforce
+        app.state.query_budget = QueryBudget()
+
+        # On demand request profiles, off unless PROFILE_DIRECTORY is set
+        app.state.profiler = RequestProfiler()
+
+        # Database client is made inside the event loop of the worker
+        client = None
+
+        if db is None:
+            client = database.create_async_client(
+                event_listeners=[CommandMetrics(app.state.metrics), PoolMetrics(app.state.metrics), QueryListener()])
+            app.state.db = client["codespark"]
+        else:
+            app.state.db = db
+
+        # Indexes of the hot queries, only missing ones are created. The api still starts without them
+        try:
+            await ensure_indexes(app.state.db)
+        except pymongo.errors.PyMongoError as e:
+            print(f"Could not create indexes: {e}")
+
+        # Likes and matches of deleted users are deactivated in the background, also the ones a restart cut off
+        app.state.cascade = DeactivationCascade(app.state.db)
+
+        try:
+            await app.state.cascade.resume()
+        except pymongo.errors.PyMongoError as e:
+            print(f"Could not resume cascades: {e}")
+
+        # Sessions, profiles and cards, only cached when CACHE_URL gives the workers a shared cache
+        app.state.caches = Caches()
+        await app.state.caches.start()
+
+        # Swipe limits per user and route, shared with RATE_LIMIT_BACKEND=kv (CACHE_URL) or mongo
+        app.state.rate_limiter = RateLimiter(app.state.db, client=app.state.caches.client)
+
+        # Live likes and matches for the event streams
+        app.state.event_bus = EventBus()
+
+        # Content addressed profile pictures and their resized variants
+        app.state.image_storage = ImageStorage()
+        app.state.image_pipeline = ImagePipeline(storage=app.state.image_storage)
+        app.state.image_pipeline.start()
+
+        # Hot avatars served from memory
+        app.state.image_cache = ImageCache()
+
+        # Connections to github are kept open between logins
+        app.state.http_client = httpx.AsyncClient(timeout=10)
+
+        app.state.user_management = UserManagement(app.state.db, app.state.event_bus,
+                                                   image_pipeline=app.state.image_pipeline,
+                                                   image_storage=app.state.image_storage,
+                                                   image_cache=app.state.image_cache,
+                                                   cascade=app.state.cascade,
+                                                   caches=app.state.caches)
+        app.state.basic_utils = BasicUtils(app.state.db)
+
+        # Cache and stream gauges are read on every scrape
+        for name, cache in app.state.caches.caches.items():
+            app.state.metrics.add_collector(stats_collector("cache", "cache", name, cache.stats))
+
+        app.state.metrics.add_collector(stats_collector("cache", "cache", "images", app.state.image_cache.stats))
+        app.state.metrics.add_collector(stats_collector("event_bus", "bus", "events", app.state.event_bus.stats))
+
+        # Workers share their metrics through files
+        flush_task = None
+
+        if app.state.metrics.directory is not None:
+            os.makedirs(app.state.metrics.directory, exist_ok=True)
+            flush_task = asyncio.create_task(app.state.metrics.flush_periodically())
+
+        yield
+
+        # Close everything the worker opened
+        if flush_task is not None:
+            flush_task.cancel()
+            await run_in_threadpool(app.state.metrics.flush)
+
+        await app.state.cascade.drain()
+        await app.state.caches.close()
+        await app.state.http_client.aclose()
+        app.state.image_pipeline.shutdown()
+
+        if client is not None:
+            client.close()
+
+    app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+    # Innermost, the endpoint has to run in the task the profiler samples
+    app.add_middleware(ProfilingMiddleware)
+
+    # gzip or brotli for JSON bodies above COMPRESSION_MINIMUM_SIZE bytes
+    app.add_middleware(CompressionMiddleware)
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Upload bodies are counted while they arrive, chunked ones included, before the form is parsed
+    app.add_middleware(UploadSizeLimitMiddleware)
+
+    # Query count, DB time and budget of every request in dev and tests
+    app.middleware("http")(query_budget_middleware)
+
+    # Outermost, times every request including rejected ones
+    app.middleware("http")(metrics_middleware)
+
+    app.include_router(router)
+
+    return app
+
+
+# Import target of the servers, e.g. uvicorn main:app
+app = create_app()
+
+
 if __name__ == '__main__':
-    client = pymongo.MongoClient(database.get_database_uri())
-    db = client["codespark"]
-    user_management = UserManagement(db)
-    basic_utils = BasicUtils(db)
     uvicorn.run(app, host="84.250.88.117", port=8000)
@@ -0,0 +1,64 @@
+"""
+Production launcher, runs the api in several worker processes
+    python serve.py --workers 4 --port 8000
+Every worker builds its own app with create_app, so nothing is shared between the processes
+"""
+import argparse
+import importlib.util
+import os
+import shutil
+
+import uvicorn
+
+
+def default_workers() -> int:
+    # The api is mostly waiting on MongoDB, one worker per core
+    return os.cpu_count() or 1
+
+
+def pick(preferred: str, module: str) -> str:
+    # Faster implementation when it is installed, the standard one otherwise
+    return preferred if importlib.util.find_spec(module) is not None else "auto"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the codespark api")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", default_workers())))
+    parser.add_argument("--loop", default=None, help="auto, asyncio or uvloop, uvloop when installed")
+    parser.add_argument("--http", default=None, help="auto, h11 or httptools, httptools when installed")
+    parser.add_argument("--keep-alive", type=int, default=30, help="seconds an idle connection is kept open")
+    parser.add_argument("--backlog", type=int, default=2048, help="pending connections the socket queues")
+    parser.add_argument("--limit-concurrency", type=int, default=None,
+                        help="connections per worker before new ones get 503")
+    parser.add_argument("--metrics-directory", default=os.getenv("METRICS_DIRECTORY"),
+                        help="where the workers share their metrics, emptied on start")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    # Metrics of the workers of an earlier run would add up with the new ones
+    if args.metrics_directory is not None:
+        shutil.rmtree(args.metrics_directory, ignore_errors=True)
+        os.makedirs(args.metrics_directory)
+        os.environ["METRICS_DIRECTORY"] = args.metrics_directory
+
+    uvicorn.run(
+        "main:create_app",
+        factory=True,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=args.loop or pick("uvloop", "uvloop"),
+        http=args.http or pick("httptools", "httptools"),
+        timeout_keep_alive=args.keep_alive,
+        backlog=args.backlog,
+        limit_concurrency=args.limit_concurrency,
+        proxy_headers=True,
+        access_log=False,
+        log_level=args.log_level
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import asyncio
+import os
+from uuid import uuid4
+
+import bcrypt
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+from utils.kv_server import KeyValueServer
+
+
+@pytest.fixture
+def anyio_backend():
+    # The app runs on asyncio only
+    return "asyncio"
+
+
+@pytest.fixture
+async def server():
+    # In-memory key value server on a free port, its url is redis://127.0.0.1:<port>/0
+    kv_server = KeyValueServer()
+    tcp_server = await asyncio.start_server(kv_server.handle, "127.0.0.1", 0)
+    kv_server.url = f"redis://127.0.0.1:{tcp_server.sockets[0].getsockname()[1]}/0"
+
+    yield kv_server
+
+    tcp_server.close()
+
+
+@pytest.fixture
+async def mongo_db():
+    # Real MongoDB for what mongomock can not run, a fresh database per test
+    uri = os.getenv("MONGO_TEST_URI")
+
+    if not uri:
+        pytest.skip("MONGO_TEST_URI is not set")
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(uri)
+    name = f"codespark_test_{uuid4().hex[:8]}"
+
+    yield client[name]
+
+    await client.drop_database(name)
+    client.close()
+
+
+def github(request: httpx.Request) -> httpx.Response:
+    # The code is the access token and the access token the login, so any username can log in
+    if request.url.path == "/login/oauth/access_token":
+        return httpx.Response(200, json={"access_token": dict(httpx.QueryParams(request.content.decode()))["code"]})
+
+    return httpx.Response(200, json={"login": request.headers["authorization"].removeprefix("Bearer ")})
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient()["codespark"]
+
+
+@pytest.fixture
+def api(db, tmp_path, monkeypatch):
+    """
+    The app on a mongomock database, images are stored in a temporary directory and github is faked
+    """
+    import main
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("CACHE_URL", raising=False)
+
+    # Sessions are hashed with the cheapest bcrypt cost
+    gensalt = bcrypt.gensalt
+    monkeypatch.setattr(bcrypt, "gensalt", lambda rounds=4, prefix=b"2b": gensalt(4, prefix))
+
+    with TestClient(main.create_app(db)) as client:
+        client.portal.call(client.app.state.http_client.aclose)
+        client.app.state.http_client = httpx.AsyncClient(transport=httpx.MockTransport(github))
+
+        yield client
+
+
+@pytest.fixture
+def login(api):
+    """
+    Logs a user in through the github workflow, the user is created on the first login
+    :return: function of the username returning the headers of the session
+    """
+    def log_in(username: str, **profile) -> dict:
+        package = api.get("/api/oauth/github/session_id", params={"code": username}).json()
+        headers = {"username": package["username"], "session_id": package["session_id"]}
+
+        if profile:
+            assert api.post("/api/update_profile", headers=headers, json=profile).status_code == 200
+
+        return headers
+
+    return log_in
+
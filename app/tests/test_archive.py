@@ -0,0 +1,104 @@
+"""
+Archiving of old inactive likes and matches. The history reads need $unionWith and run against a real MongoDB
+when MONGO_TEST_URI is set:
+    MONGO_TEST_URI=mongodb://localhost:27017 python -m pytest tests/test_archive.py
+"""
+import datetime as dt
+
+import pytest
+
+from functions.archive import InteractionArchiver, find_history
+
+NOW = dt.datetime.now()
+OLD = NOW - dt.timedelta(days=100)
+RECENT = NOW - dt.timedelta(days=10)
+
+
+async def seed(db):
+    # Likes of user 1: old inactive, recent inactive, active, plus an old inactive match
+    await db.likes.insert_many([
+        {"_id": "old", "user_id": 1, "liked_user_id": 2, "active": False, "deleted_at": OLD, "created_at": OLD},
+        {"_id": "recent", "user_id": 1, "liked_user_id": 3, "active": False, "deleted_at": RECENT, "created_at": OLD},
+        {"_id": "active", "user_id": 1, "liked_user_id": 4, "active": True, "created_at": OLD},
+        {"_id": "dislike", "user_id": 1, "liked_user_id": 5, "active": True, "is_like": False, "created_at": OLD}
+    ])
+    await db.matches.insert_one({"_id": "match", "user_id": 1, "matched_user_id": 2, "active": False,
+                                 "deleted_at": OLD, "created_at": OLD})
+    await db.users.insert_many([
+        {"_id": 1, "username": "alice", "active": True, "likes": ["old", "recent", "active", "dislike"],
+         "matches": ["match"]},
+        {"_id": 2, "username": "bob", "active": True, "likes": ["old"], "matches": ["match"]}
+    ])
+
+
+@pytest.fixture
+async def db(db):
+    await seed(db)
+    return db
+
+
+async def ids(collection) -> set:
+    return {document["_id"] async for document in collection.find({}, {"_id": 1})}
+
+
+@pytest.mark.anyio
+async def test_only_old_inactive_documents_are_archived(db):
+    report = await InteractionArchiver(db, max_per_second=0).run()
+
+    assert report == {"likes": {"found": 1, "archived": 1}, "matches": {"found": 1, "archived": 1}}
+
+    assert await ids(db.likes) == {"recent", "active", "dislike"}
+    assert await ids(db.likes_archive) == {"old"}
+    assert await ids(db.matches) == set()
+    assert await ids(db.matches_archive) == {"match"}
+    assert "archived_at" in await db.likes_archive.find_one({"_id": "old"})
+
+    # Unlinked from both users
+    alice, bob = await db.users.find_one({"_id": 1}), await db.users.find_one({"_id": 2})
+    assert (alice["likes"], alice["matches"]) == (["recent", "active", "dislike"], [])
+    assert (bob["likes"], bob["matches"]) == ([], [])
+
+
+@pytest.mark.anyio
+async def test_age_selects_what_is_archived(db):
+    report = await InteractionArchiver(db, older_than=dt.timedelta(days=5), batch_size=1, max_per_second=0).run()
+
+    assert report["likes"] == {"found": 2, "archived": 2}
+    assert await ids(db.likes) == {"active", "dislike"}
+
+
+@pytest.mark.anyio
+async def test_dry_run_only_counts(db):
+    report = await InteractionArchiver(db, older_than=dt.timedelta(days=5), dry_run=True).run()
+
+    assert report == {"likes": {"found": 2, "archived": 0}, "matches": {"found": 1, "archived": 0}}
+    assert await ids(db.likes_archive) == set()
+    assert len(await ids(db.likes)) == 4
+
+
+@pytest.mark.anyio
+async def test_stopped_run_is_finished(db):
+    # A run that copied the batch but stopped before deleting it
+    await db.likes_archive.insert_one({**await db.likes.find_one({"_id": "old"}), "archived_at": OLD})
+
+    await InteractionArchiver(db, max_per_second=0).run()
+
+    assert await ids(db.likes_archive) == {"old"}
+    assert "old" not in await ids(db.likes)
+
+
+@pytest.mark.anyio
+async def test_history_includes_the_archive(mongo_db):
+    await seed(mongo_db)
+
+    # Copied and not deleted yet, the hot document wins
+    await mongo_db.likes_archive.insert_one({"_id": "recent", "user_id": 1, "liked_user_id": 3, "active": False,
+                                             "deleted_at": RECENT, "created_at": OLD, "archived_at": NOW})
+
+    await InteractionArchiver(mongo_db, max_per_second=0).run()
+
+    history = await find_history(mongo_db, "likes", {"_id": {"$in": ["recent", "active", "dislike"]}},
+                                 {"user_id": 1}, [("_id", 1)])
+
+    assert [document["_id"] for document in history] == ["active", "dislike", "old", "recent"]
+    assert "archived_at" in history[2] and "archived_at" not in history[3]
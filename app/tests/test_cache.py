@@ -0,0 +1,133 @@
+"""
+Shared caches against the in-memory key value server on a free port
+"""
+import asyncio
+import socket
+
+import pytest
+
+from utils.cache import INVALIDATION_CHANNEL, Caches
+from utils.kv import KeyValueClient
+
+
+@pytest.fixture
+async def caches(server):
+    opened = []
+
+    async def open_caches():
+        worker_caches = Caches(url=server.url)
+        await worker_caches.start()
+        opened.append(worker_caches)
+
+        return worker_caches
+
+    yield open_caches
+
+    for worker_caches in opened:
+        await worker_caches.close()
+
+
+async def wait_for(condition, timeout: float = 3.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def subscribers(server) -> int:
+    return len(server.channels[INVALIDATION_CHANNEL.encode()])
+
+
+@pytest.mark.anyio
+async def test_client_round_trip(server):
+    client = KeyValueClient(server.url)
+
+    assert await client.set("a", b"1", ttl=60)
+    assert await client.set("b", b"2", ttl=0.05)
+    assert await client.get_many(["a", "b", "c"]) == [b"1", b"2", None]
+
+    # PX expiry
+    await asyncio.sleep(0.1)
+    assert await client.get_many(["b"]) == [None]
+
+    # NX only fills a missing key
+    assert not await client.set("a", b"3", ttl=60, only_new=True)
+    assert await client.set("c", b"3", ttl=60, only_new=True)
+    assert await client.get_many(["a", "c"]) == [b"1", b"3"]
+
+    assert await client.delete(["a", "c", "missing"]) == 2
+    assert await client.get_many(["a", "c"]) == [None, None]
+
+    await client.close()
+
+
+@pytest.mark.anyio
+async def test_delete_drops_near_copies_of_other_workers(server, caches):
+    first, second = await caches(), await caches()
+    await wait_for(lambda: subscribers(server) == 2)
+
+    await first.profiles.set("alice", {"background": "python"})
+    assert await second.profiles.get("alice") == {"background": "python"}
+    assert second.profiles.near.get("alice") is not None
+
+    await first.profiles.delete("alice")
+
+    await wait_for(lambda: "alice" not in second.profiles.near.entries)
+    assert await second.profiles.get("alice") is None
+
+
+@pytest.mark.anyio
+async def test_set_after_delete_is_refused(server, caches):
+    worker_caches = await caches()
+
+    # A session read before a logout and set after it
+    await worker_caches.sessions.delete("alice")
+    await worker_caches.sessions.set("alice", {"active": True})
+
+    assert await worker_caches.sessions.get("alice") is None
+    assert "alice" not in worker_caches.sessions.near.entries
+
+
+@pytest.mark.anyio
+async def test_set_does_not_overwrite(server, caches):
+    worker_caches = await caches()
+
+    await worker_caches.profiles.set("alice", {"background": "python"})
+    await worker_caches.profiles.set("alice", {"background": "rust"})
+    worker_caches.profiles.clear_near()
+
+    assert await worker_caches.profiles.get("alice") == {"background": "python"}
+
+
+@pytest.mark.anyio
+async def test_reconnect_clears_near_caches(server, caches):
+    worker_caches = await caches()
+    await wait_for(lambda: subscribers(server) == 1)
+
+    await worker_caches.profiles.set("alice", {"background": "python"})
+    assert "alice" in worker_caches.profiles.near.entries
+
+    # Messages sent while the subscription is down are lost
+    for writer in list(server.channels[INVALIDATION_CHANNEL.encode()]):
+        writer.close()
+
+    await wait_for(lambda: subscribers(server) == 0)
+    await wait_for(lambda: subscribers(server) == 1)
+
+    assert "alice" not in worker_caches.profiles.near.entries
+
+
+@pytest.mark.anyio
+async def test_dead_server_is_a_miss():
+    # A port nothing listens on
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    worker_caches = Caches(url=f"redis://127.0.0.1:{port}/0")
+
+    assert await worker_caches.profiles.get("alice") is None
+    assert worker_caches.profiles.stats()["errors"] == 1
+
+    await worker_caches.close()
@@ -0,0 +1,89 @@
+"""
+Edges and sessions of deleted users are deactivated in batches and pending cascades are resumed
+"""
+import pymongo
+import pytest
+
+from functions.cascade import DeactivationCascade
+
+
+@pytest.fixture
+async def deleted(db):
+    # User 1 deleted with 5 likes each way, a match and a session, user 2's own edges stay
+    await db.users.insert_many([{"_id": 1, "active": False, "cascade_pending": True}, {"_id": 2, "active": True}])
+    await db.likes.insert_many([{"user_id": 1, "liked_user_id": 10 + i, "active": True} for i in range(5)] +
+                               [{"user_id": 10 + i, "liked_user_id": 1, "active": True} for i in range(5)] +
+                               [{"user_id": 2, "liked_user_id": 3, "active": True}])
+    await db.matches.insert_many([{"user_id": 1, "matched_user_id": 2, "active": True},
+                                  {"user_id": 2, "matched_user_id": 1, "active": True}])
+    await db.sessions.insert_one({"user_id": 1, "active": True})
+
+    return 1
+
+
+async def active(db, collection: str) -> int:
+    return await db[collection].count_documents({"active": True})
+
+
+@pytest.mark.anyio
+async def test_run_deactivates_in_batches(db, deleted):
+    cascade = DeactivationCascade(db, batch_size=2, background=False)
+
+    assert await cascade.run(deleted) == {"likes": 10, "matches": 2, "sessions": 1}
+
+    assert await active(db, "likes") == 1
+    assert await active(db, "matches") == 0
+    assert await db.likes.count_documents({"deleted_at": {"$exists": True}}) == 10
+    assert await db.sessions.count_documents({"last_used": {"$exists": True}}) == 1
+    assert "cascade_pending" not in await db.users.find_one({"_id": deleted})
+
+    # Running it again changes nothing
+    assert await cascade.run(deleted) == {"likes": 0, "matches": 0, "sessions": 0}
+
+
+@pytest.mark.anyio
+async def test_crashed_cascade_is_resumed(db, deleted, monkeypatch):
+    cascade = DeactivationCascade(db, batch_size=2)
+    update_many = cascade.col_matches.update_many
+
+    async def failing_update_many(*args, **kwargs):
+        raise pymongo.errors.AutoReconnect("connection lost")
+
+    # The likes are done, the matches fail and the user stays pending
+    monkeypatch.setattr(cascade.col_matches, "update_many", failing_update_many)
+
+    await cascade.schedule(deleted)
+    await cascade.drain()
+
+    assert await active(db, "likes") == 1
+    assert await active(db, "matches") == 2
+    assert (await db.users.find_one({"_id": deleted}))["cascade_pending"]
+
+    # Next start picks it up
+    monkeypatch.setattr(cascade.col_matches, "update_many", update_many)
+
+    assert await cascade.resume() == 1
+    await cascade.drain()
+
+    assert await active(db, "matches") == 0
+    assert await active(db, "sessions") == 0
+    assert await cascade.resume() == 0
+
+
+def test_delete_user_runs_the_cascade(api, login, db):
+    alice, bob = login("alice"), login("bob")
+
+    api.put("/api/like_user/bob", headers=alice)
+    api.put("/api/like_user/alice", headers=bob)
+
+    assert api.delete("/api/delete_user", headers=alice).status_code == 200
+    api.portal.call(api.app.state.cascade.drain)
+
+    user = api.portal.call(db.users.find_one, {"username": "alice"})
+
+    assert not user["active"] and "cascade_pending" not in user
+    assert api.portal.call(db.likes.count_documents, {"active": True}) == 0
+    assert api.portal.call(db.matches.count_documents, {"active": True}) == 0
+
+    # The session of the deleted user does not work anymore
+    assert api.get("/api/get_profile", headers=alice).status_code != 200
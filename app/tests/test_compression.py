@@ -0,0 +1,123 @@
+"""
+Card fieldsets and compressed JSON responses
+"""
+import gzip
+
+import pytest
+from fastapi import FastAPI, Response
+from fastapi.testclient import TestClient
+
+import utils.compression as compression
+from utils.compression import CompressionMiddleware, choose_encoding, vary_accept_encoding
+
+BODY = b'{"cards": "' + b"python " * 300 + b'"}'
+
+
+def test_choose_encoding(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+
+    assert choose_encoding("gzip, deflate, br") == "gzip"
+    assert choose_encoding("*") == "gzip"
+    assert choose_encoding("identity") is None
+    assert choose_encoding("gzip;q=0, *;q=1") is None
+    assert choose_encoding(None) is None
+
+    # Brotli is preferred when it is installed, unless the client ranks it lower
+    monkeypatch.setattr(compression, "brotli", object())
+
+    assert choose_encoding("gzip, br") == "br"
+    assert choose_encoding("gzip, br;q=0.5") == "gzip"
+    assert choose_encoding("gzip;q=0.5, br;q=0") == "gzip"
+
+
+def test_vary_accept_encoding():
+    assert vary_accept_encoding([]) == [(b"vary", b"Accept-Encoding")]
+    assert vary_accept_encoding([(b"vary", b"Accept")]) == [(b"vary", b"Accept, Accept-Encoding")]
+    assert vary_accept_encoding([(b"Vary", b"accept-encoding")]) == [(b"Vary", b"accept-encoding")]
+    assert vary_accept_encoding([(b"vary", b"*")]) == [(b"vary", b"*")]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=100)
+
+    @app.get("/json")
+    async def json_body():
+        return Response(BODY, media_type="application/json", headers={"ETag": '"abc"'})
+
+    @app.get("/small")
+    async def small_body():
+        return Response(b'{"a": 1}', media_type="application/json")
+
+    @app.get("/image")
+    async def image_body():
+        return Response(b"\xff" * 1000, media_type="image/jpeg")
+
+    return TestClient(app)
+
+
+def test_json_is_gzipped(client):
+    response = client.get("/json", headers={"Accept-Encoding": "gzip"})
+
+    # httpx decodes the body, the length is of the compressed body
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert int(response.headers["Content-Length"]) == len(gzip.compress(BODY, compresslevel=6, mtime=0))
+    assert response.content == BODY
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == 'W/"abc"'
+
+
+def test_identity_keeps_the_body_and_varies(client):
+    response = client.get("/json", headers={"Accept-Encoding": "identity"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.content == BODY
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == '"abc"'
+
+
+def test_small_bodies_and_images_are_sent_as_they_are(client):
+    small = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+    assert small.headers["Vary"] == "Accept-Encoding"
+
+    image = client.get("/image", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in image.headers
+    assert "Vary" not in image.headers
+
+
+def test_fieldsets(api, login):
+    alice = login("alice", background="python", looking_for="a team")
+    bob = login("bob", background="rust")
+
+    api.put("/api/like_user/bob", headers=alice)
+    api.put("/api/like_user/alice", headers=bob)
+
+    matches = api.get("/api/get_matches", headers=alice, params={"fields": "background"}).json()
+    assert matches == [{"username": "bob", "background": "rust"}]
+
+    discovers = api.get("/api/get_discovers", headers=login("carol"), params={"fields": "looking_for"}).json()
+    assert {"username": "alice", "looking_for": "a team"} in discovers
+    assert all(set(card) == {"username", "looking_for"} for card in discovers)
+
+    # Email is only shown to matches
+    response = api.get("/api/get_likes", headers=alice, params={"fields": "email"})
+    assert response.status_code == 400
+    assert "email" in response.text
+
+
+def test_api_responses_are_compressed(api, login):
+    alice = login("alice", background="python " * 140, looking_for="a team " * 140)
+
+    response = api.get("/api/get_profile", headers={**alice, "Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["ETag"].startswith("W/")
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert response.json()["background"] == "python " * 140
+
+    # The weak ETag still revalidates
+    not_modified = api.get("/api/get_profile", headers={**alice, "If-None-Match": response.headers["ETag"]})
+    assert not_modified.status_code == 304
@@ -0,0 +1,72 @@
+"""
+Badge counters kept up to date by likes, matches and unmatches, and repaired by reconcile
+"""
+from functions.counters import Counters
+
+
+def counts(api, headers) -> dict:
+    response = api.get("/api/get_counts", headers=headers)
+    assert response.status_code == 200, response.text
+
+    return response.json()
+
+
+def test_likes_and_matches_are_counted(api, login):
+    alice, bob, carol = login("alice"), login("bob"), login("carol")
+
+    api.put("/api/like_user/bob", headers=alice)
+    api.put("/api/like_user/bob", headers=carol)
+
+    assert counts(api, alice) == {"likes_received": 0, "likes_sent": 1, "matches": 0}
+    assert counts(api, bob) == {"likes_received": 2, "likes_sent": 0, "matches": 0}
+
+    # Liking back makes a match, the likes between the two are not pending anymore
+    api.put("/api/like_user/alice", headers=bob)
+
+    assert counts(api, alice)["matches"] == 1
+    assert counts(api, bob)["matches"] == 1
+
+    api.delete("/api/unmatch", headers=alice, params={"matched_username": "bob"})
+
+    assert counts(api, alice)["matches"] == 0
+    assert counts(api, bob)["matches"] == 0
+
+
+def test_dislike_takes_back_a_like(api, login):
+    alice, bob = login("alice"), login("bob")
+
+    api.put("/api/like_user/bob", headers=alice)
+    api.put("/api/dislike_user/bob", headers=alice)
+
+    assert counts(api, alice)["likes_sent"] == 0
+    assert counts(api, bob)["likes_received"] == 0
+
+
+def test_reconcile_repairs_drifted_counters(api, login, db):
+    alice, bob = login("alice"), login("bob")
+    login("carol")
+
+    api.put("/api/like_user/bob", headers=alice)
+    api.put("/api/like_user/carol", headers=alice)
+    api.put("/api/like_user/alice", headers=bob)
+
+    expected = counts(api, alice)
+    alice_id = api.portal.call(db.users.find_one, {"username": "alice"})["_id"]
+    carol_id = api.portal.call(db.users.find_one, {"username": "carol"})["_id"]
+
+    # Drift, a lost counter and the counter of a deleted user
+    api.portal.call(db.counters.update_one, {"_id": alice_id}, {"$set": {"likes_sent": 7, "matches": 0}})
+    api.portal.call(db.counters.delete_one, {"_id": carol_id})
+    api.portal.call(db.users.update_one, {"username": "bob"}, {"$set": {"active": False}})
+
+    report = api.portal.call(Counters(db).reconcile)
+
+    assert report["removed"] == 1
+    assert report["repaired"] >= 2
+
+    # Edges to the deleted user do not count anymore
+    assert api.portal.call(Counters(db).get_counts, alice_id) == {**expected, "likes_sent": 1, "matches": 0}
+    assert api.portal.call(Counters(db).get_counts, carol_id)["likes_received"] == 1
+
+    # Nothing left to repair
+    assert api.portal.call(Counters(db).reconcile)["repaired"] == 0
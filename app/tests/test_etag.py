@@ -0,0 +1,57 @@
+"""
+Conditional requests, the client revalidates the profile and the lists with If-None-Match
+"""
+from utils.etag import etag_matches
+
+
+def test_etag_matches():
+    assert etag_matches('"a"', '"a"')
+    assert etag_matches('W/"a"', '"a"')
+    assert etag_matches('"b", W/"a"', '"a"')
+    assert etag_matches("*", '"a"')
+
+    assert not etag_matches('"b"', '"a"')
+    assert not etag_matches(None, '"a"')
+    assert not etag_matches("", '"a"')
+
+
+def test_profile_is_not_modified_until_it_changes(api, login):
+    alice = login("alice", background="python")
+
+    response = api.get("/api/get_profile", headers=alice)
+    etag = response.headers["ETag"]
+
+    not_modified = api.get("/api/get_profile", headers={**alice, "If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["ETag"] == etag
+    assert not_modified.content == b""
+
+    # A new revision makes the old validator stale
+    api.post("/api/update_profile", headers=alice, json={"background": "rust"})
+
+    modified = api.get("/api/get_profile", headers={**alice, "If-None-Match": etag})
+    assert modified.status_code == 200
+    assert modified.headers["ETag"] != etag
+    assert modified.json()["background"] == "rust"
+
+
+def test_update_without_changes_keeps_the_etag(api, login):
+    alice = login("alice", background="python")
+    etag = api.get("/api/get_profile", headers=alice).headers["ETag"]
+
+    api.post("/api/update_profile", headers=alice, json={"background": "python"})
+
+    assert api.get("/api/get_profile", headers={**alice, "If-None-Match": etag}).status_code == 304
+
+
+def test_lists_are_revalidated_by_their_content(api, login):
+    alice, bob = login("alice"), login("bob")
+
+    etag = api.get("/api/get_likes", headers=bob).headers["ETag"]
+    assert api.get("/api/get_likes", headers={**bob, "If-None-Match": etag}).status_code == 304
+
+    api.put("/api/like_user/bob", headers=alice)
+
+    response = api.get("/api/get_likes", headers={**bob, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
@@ -0,0 +1,121 @@
+"""
+Event bus of the live likes and matches and its server-sent event streams
+"""
+import asyncio
+import threading
+
+import pytest
+
+from functions.events import EventBus
+
+
+async def next_event(stream) -> str:
+    return await asyncio.wait_for(stream.__anext__(), 1)
+
+
+@pytest.mark.anyio
+async def test_stream_delivers_published_events():
+    bus = EventBus()
+    stream = bus.stream("user")
+
+    assert await next_event(stream) == "retry: 5000\n\n"
+
+    bus.publish("user", "like", {"username": "alice"})
+    bus.publish("other", "like", {"username": "bob"})
+
+    assert await next_event(stream) == 'event: like\ndata: {"username": "alice"}\n\n'
+    assert bus.stats()["delivered"] == 1
+
+    await stream.aclose()
+    assert bus.stats()["connections"] == 0
+
+
+@pytest.mark.anyio
+async def test_subscription_opens_when_the_stream_starts():
+    bus = EventBus()
+    stream = bus.stream("user")
+
+    # A response that is never sent holds nothing
+    assert not bus.is_subscribed("user")
+
+    await next_event(stream)
+    assert bus.is_subscribed("user")
+
+    await stream.aclose()
+    assert not bus.is_subscribed("user")
+
+
+@pytest.mark.anyio
+async def test_full_buffer_asks_for_a_resync():
+    bus = EventBus(max_buffer=2)
+    subscription = bus.subscribe("user")
+
+    for i in range(5):
+        bus.publish("user", "like", {"i": i})
+
+    assert subscription.drain() == [("like", {"i": 3}), ("like", {"i": 4}), ("resync", {"dropped": 3})]
+    assert subscription.drain() == []
+
+
+@pytest.mark.anyio
+async def test_streams_per_user_are_limited():
+    bus = EventBus(max_connections_per_user=1)
+    first = bus.stream("user")
+    await next_event(first)
+
+    assert bus.is_full("user")
+
+    # A second stream opened after the endpoint checked ends with an error event
+    second = bus.stream("user")
+    assert (await next_event(second)).startswith("event: error\n")
+
+    with pytest.raises(StopAsyncIteration):
+        await next_event(second)
+
+    await first.aclose()
+    assert not bus.is_full("user")
+
+
+@pytest.mark.anyio
+async def test_heartbeat_while_idle():
+    bus = EventBus(heartbeat=0.01)
+    stream = bus.stream("user")
+    await next_event(stream)
+
+    assert await next_event(stream) == ": heartbeat\n\n"
+
+    await stream.aclose()
+
+
+@pytest.mark.anyio
+async def test_publish_from_a_worker_thread():
+    bus = EventBus()
+    subscription = bus.subscribe("user")
+
+    thread = threading.Thread(target=bus.publish, args=("user", "match", {"username": "alice"}))
+    thread.start()
+    thread.join()
+
+    await asyncio.wait_for(subscription.waiter.wait(), 1)
+    assert subscription.drain() == [("match", {"username": "alice"})]
+
+
+def test_likes_and_matches_are_published(api, login, db):
+    alice, bob = login("alice"), login("bob")
+    bus = api.app.state.event_bus
+    user_ids = {user["username"]: user["_id"] for user in api.portal.call(db.users.find({}).to_list, None)}
+
+    async def subscribe(username):
+        return bus.subscribe(user_ids[username])
+
+    alice_events, bob_events = api.portal.call(subscribe, "alice"), api.portal.call(subscribe, "bob")
+
+    api.put("/api/like_user/bob", headers=alice)
+    assert bob_events.drain() == [("like", {"username": "alice"})]
+
+    api.put("/api/like_user/alice", headers=bob)
+    assert alice_events.drain() == [("match", {"username": "bob"})]
+    assert bob_events.drain() == [("match", {"username": "alice"})]
+
+    bus.unsubscribe(alice_events)
+    bus.unsubscribe(bob_events)
@@ -0,0 +1,112 @@
+"""
+Images are served with validators and single byte ranges, from the disk or the image cache
+"""
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from functions.image_cache import ImageCache
+from utils.file_responses import image_response, parse_range
+
+DATA = bytes(range(256)) * 4
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-99", 1024) == (0, 99)
+    assert parse_range("bytes=1000-", 1024) == (1000, 1023)
+    assert parse_range("bytes=1000-5000", 1024) == (1000, 1023)
+    assert parse_range("bytes=-24", 1024) == (1000, 1023)
+    assert parse_range("bytes=-5000", 1024) == (0, 1023)
+
+    # Not satisfiable
+    assert parse_range("bytes=1024-", 1024) is False
+    assert parse_range("bytes=10-5", 1024) is False
+    assert parse_range("bytes=-0", 1024) is False
+
+    # Full file
+    assert parse_range(None, 1024) is None
+    assert parse_range("items=0-1", 1024) is None
+    assert parse_range("bytes=0-1,5-6", 1024) is None
+    assert parse_range("bytes=a-b", 1024) is None
+
+
+@pytest.fixture(params=[False, True], ids=["disk", "image cache"])
+def client(request, tmp_path):
+    # Serves a file with or without the image cache
+    path = tmp_path / "picture.png"
+    path.write_bytes(DATA)
+
+    image_cache = ImageCache() if request.param else None
+    app = FastAPI()
+
+    @app.get("/picture")
+    async def picture(request: Request):
+        return await image_response(str(path), request.headers, image_cache=image_cache)
+
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def test_full_file(client):
+    response = client.get("/picture")
+
+    assert response.status_code == 200
+    assert response.content == DATA
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["Content-Type"] == "image/png"
+
+
+def test_byte_range(client):
+    response = client.get("/picture", headers={"Range": "bytes=100-199"})
+
+    assert response.status_code == 206
+    assert response.content == DATA[100:200]
+    assert response.headers["Content-Range"] == f"bytes 100-199/{len(DATA)}"
+    assert response.headers["Content-Length"] == "100"
+
+    response = client.get("/picture", headers={"Range": "bytes=-10"})
+
+    assert response.status_code == 206
+    assert response.content == DATA[-10:]
+
+
+def test_range_not_satisfiable(client):
+    response = client.get("/picture", headers={"Range": f"bytes={len(DATA)}-"})
+
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(DATA)}"
+    assert response.content == b""
+
+
+def test_if_range(client):
+    etag = client.get("/picture").headers["ETag"]
+
+    # Same file, the range applies
+    assert client.get("/picture", headers={"Range": "bytes=0-9", "If-Range": etag}).status_code == 206
+
+    # Client has another version, it gets the whole file
+    response = client.get("/picture", headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+    assert response.status_code == 200
+    assert response.content == DATA
+
+
+def test_conditional_requests(client):
+    response = client.get("/picture")
+    etag, last_modified = response.headers["ETag"], response.headers["Last-Modified"]
+
+    assert client.get("/picture", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/picture", headers={"If-Modified-Since": last_modified}).status_code == 304
+
+    # If-None-Match wins over If-Modified-Since
+    response = client.get("/picture", headers={"If-None-Match": '"other"', "If-Modified-Since": last_modified})
+    assert response.status_code == 200
+
+
+def test_missing_file(tmp_path):
+    app = FastAPI()
+
+    @app.get("/picture")
+    async def picture(request: Request):
+        return await image_response(str(tmp_path / "missing.png"), request.headers)
+
+    assert TestClient(app).get("/picture").status_code == 404
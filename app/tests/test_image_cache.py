@@ -0,0 +1,119 @@
+"""
+Hot image files are kept in a byte budgeted LRU
+"""
+import os
+
+import pytest
+
+from functions.image_cache import ImageCache
+
+
+@pytest.fixture
+def files(tmp_path):
+    # Files of 100 bytes each, named by their index
+    def write(name: str, size: int = 100) -> str:
+        path = tmp_path / name
+        path.write_bytes(name.encode().ljust(size, b"\0"))
+        return str(path)
+
+    return write
+
+
+def load(cache: ImageCache, path: str):
+    return cache.load(path, os.stat(path))
+
+
+def test_get_counts_hits_and_misses(files):
+    cache = ImageCache()
+    path = files("a.jpg")
+
+    assert cache.get(path) is None
+    assert load(cache, path)[:5] == b"a.jpg"
+
+    data, stat_result = cache.get(path)
+    assert data[:5] == b"a.jpg" and stat_result.st_size == 100
+
+    assert cache.stats() == {"entries": 1, "bytes": 100, "hits": 1, "misses": 1, "evictions": 0, "hit_ratio": 0.5}
+
+
+def test_least_recently_used_is_evicted(files):
+    cache = ImageCache(max_bytes=250)
+    a, b, c = files("a.jpg"), files("b.jpg"), files("c.jpg")
+
+    load(cache, a)
+    load(cache, b)
+
+    # Reading a makes b the least recently used
+    cache.get(a)
+    load(cache, c)
+
+    assert cache.contains(a) and cache.contains(c)
+    assert not cache.contains(b)
+    assert cache.stats()["bytes"] == 200
+    assert cache.stats()["evictions"] == 1
+
+
+def test_reload_replaces_the_entry(files):
+    cache = ImageCache()
+    path = files("a.jpg")
+
+    load(cache, path)
+    load(cache, path)
+
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] == 100
+
+
+def test_big_files_are_not_accepted():
+    cache = ImageCache(max_entry_bytes=1000)
+
+    assert cache.accepts(1000)
+    assert not cache.accepts(1001)
+
+
+def test_invalidate_drops_a_blob_and_its_variants(files):
+    cache = ImageCache()
+    digest = "ab" * 32
+
+    paths = [files(f"{digest}.jpg"), files(f"{digest}_64.webp"), files(f"{digest}_256.jpg"), files("cd.jpg")]
+
+    for path in paths:
+        load(cache, path)
+
+    cache.invalidate(digest)
+
+    assert [cache.contains(path) for path in paths] == [False, False, False, True]
+    assert cache.stats()["bytes"] == 100
+
+    cache.clear()
+    assert cache.stats()["entries"] == 0 and cache.stats()["bytes"] == 0
+
+
+def test_memory_mapped_entries(files):
+    cache = ImageCache(use_mmap=True)
+    path = files("a.jpg")
+
+    data = load(cache, path)
+
+    assert data[:5] == b"a.jpg"
+    assert cache.get(path)[0][:5] == b"a.jpg"
+
+
+def test_new_picture_invalidates_the_old_one(api, login):
+    alice = login("alice")
+    image_cache = api.app.state.image_cache
+
+    def upload(data: bytes) -> str:
+        response = api.post("/api/upload_profile_picture_file", headers=alice,
+                            files={"file": ("picture.jpg", data, "image/jpeg")})
+        assert response.status_code == 200, response.text
+
+        return api.get("/api/get_profile", headers=alice).json()["profile_picture"].rsplit("/", 1)[1]
+
+    old_file_name = upload(b"\xff\xd8\xff\xe0old")
+    assert api.get(f"/api/get_profile_picture/{old_file_name}").status_code == 200
+    assert any(path.endswith(old_file_name) for path in image_cache.entries)
+
+    upload(b"\xff\xd8\xff\xe0new")
+
+    assert not any(path.endswith(old_file_name) for path in image_cache.entries)
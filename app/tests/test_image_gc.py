@@ -0,0 +1,107 @@
+"""
+Garbage collection of pictures no active profile points to
+"""
+import datetime as dt
+import os
+import time
+
+import mongomock
+import pytest
+
+from functions.image_gc import ImageGarbageCollector
+from functions.image_storage import ImageStorage
+
+KEPT = "a" * 64
+ORPHAN = "b" * 64
+INACTIVE = "c" * 64
+PREFIX = "http://localhost:8000/api/get_profile_picture/"
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = ImageStorage(str(tmp_path / "image_storage"))
+
+    # Pictures with their variants and an unfinished upload, all two days old
+    for file_name in [f"{KEPT}.jpg", f"{KEPT}_64.webp", f"{ORPHAN}.jpg", f"{ORPHAN}_64.jpg", f"{INACTIVE}.png",
+                      "alice.jpg", "upload.part"]:
+        path = storage.path(file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "wb") as file:
+            file.write(b"0123456789")
+
+        os.utime(path, (time.time() - 2 * 86400,) * 2)
+
+    return storage
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient()["codespark"]
+    db.users.insert_many([
+        {"username": "kept", "active": True, "profile_picture": PREFIX + f"{KEPT}.jpg"},
+        {"username": "alice", "active": True, "profile_picture": PREFIX + "alice.jpg"},
+        {"username": "gone", "active": False, "profile_picture": PREFIX + f"{INACTIVE}.png"},
+        {"username": "new", "active": True, "profile_picture": ""}
+    ])
+
+    return db
+
+
+def stored(storage: ImageStorage) -> set:
+    return {file_name for file_name, _ in storage.iter_files()}
+
+
+def test_orphans_are_removed(db, storage):
+    report = ImageGarbageCollector(db, storage, max_per_second=0).run()
+
+    assert report == {"scanned": 7, "removed": 4, "reclaimed_bytes": 40, "archived": False, "dry_run": False}
+    assert stored(storage) == {f"{KEPT}.jpg", f"{KEPT}_64.webp", "alice.jpg"}
+
+
+def test_dry_run_only_reports(db, storage):
+    before = stored(storage)
+
+    report = ImageGarbageCollector(db, storage, dry_run=True).run()
+
+    assert (report["removed"], report["reclaimed_bytes"], report["dry_run"]) == (4, 40, True)
+    assert stored(storage) == before
+
+
+def test_recent_files_are_kept(db, storage):
+    # Written or deduplicated within the grace period
+    os.utime(storage.path(f"{ORPHAN}.jpg"))
+
+    report = ImageGarbageCollector(db, storage, max_per_second=0).run()
+
+    assert report["scanned"] == 6
+    assert f"{ORPHAN}.jpg" in stored(storage)
+    assert f"{ORPHAN}_64.jpg" not in stored(storage)
+
+    # A longer grace period keeps everything
+    report = ImageGarbageCollector(db, storage, grace_period=dt.timedelta(days=3)).run()
+    assert report["scanned"] == 0
+
+
+def test_references_are_read_per_batch(db, storage):
+    collector = ImageGarbageCollector(db, storage, batch_size=1, max_per_second=0)
+    candidates = list(collector.find_candidates())
+
+    # A user picks the orphan while the collector runs
+    db.users.update_one({"username": "new"}, {"$set": {"profile_picture": PREFIX + f"{ORPHAN}.jpg"}})
+
+    for candidate in candidates:
+        collector.collect([candidate])
+
+    assert {f"{ORPHAN}.jpg", f"{ORPHAN}_64.jpg"} <= stored(storage)
+
+
+def test_orphans_are_archived(db, storage, tmp_path):
+    archive = tmp_path / "archive"
+
+    report = ImageGarbageCollector(db, storage, archive_directory=str(archive), max_per_second=0).run()
+
+    assert report["archived"]
+    assert os.path.exists(archive / ORPHAN[:2] / ORPHAN[2:4] / f"{ORPHAN}.jpg")
+    assert os.path.exists(archive / "upload.part")
+    assert stored(ImageStorage(str(archive))) == {f"{ORPHAN}.jpg", f"{ORPHAN}_64.jpg", f"{INACTIVE}.png", "upload.part"}
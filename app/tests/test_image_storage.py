@@ -0,0 +1,71 @@
+"""
+Images are stored once by their content hash, in sharded directories
+"""
+import hashlib
+import os
+
+import pytest
+
+from functions.image_storage import ImageStorage
+
+DATA = b"\xff\xd8\xff\xe0" + b"picture"
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return ImageStorage(str(tmp_path / "image_storage"))
+
+
+def test_blobs_are_sharded(storage):
+    assert storage.path(f"{DIGEST}.jpg") == os.path.join(storage.root, DIGEST[:2], DIGEST[2:4], f"{DIGEST}.jpg")
+    assert storage.path(f"{DIGEST}_64.webp") == os.path.join(storage.root, DIGEST[:2], DIGEST[2:4], f"{DIGEST}_64.webp")
+
+    # Files from before the content addressing stay in the root
+    assert storage.path("alice.jpg") == os.path.join(storage.root, "alice.jpg")
+
+
+def test_put_bytes_stores_once(storage):
+    assert storage.put_bytes(DATA, "jpg") == (f"{DIGEST}.jpg", True)
+
+    # Same content is not written again but touched for the garbage collector
+    path = storage.path(f"{DIGEST}.jpg")
+    os.utime(path, (0, 0))
+
+    assert storage.put_bytes(DATA, "jpg") == (f"{DIGEST}.jpg", False)
+    assert os.path.getmtime(path) > 0
+    assert [name for name, _ in storage.iter_files()] == [f"{DIGEST}.jpg"]
+
+
+def test_put_file_drops_duplicates(storage, tmp_path):
+    def temp_file(name):
+        path = tmp_path / name
+        path.write_bytes(DATA)
+        return str(path)
+
+    first, second = temp_file("first.part"), temp_file("second.part")
+
+    assert storage.put_file(first, DIGEST, "jpg") == (f"{DIGEST}.jpg", True)
+    assert storage.put_file(second, DIGEST, "jpg") == (f"{DIGEST}.jpg", False)
+
+    # Both temporary files are gone, one blob is left
+    assert not os.path.exists(first) and not os.path.exists(second)
+    assert [name for name, _ in storage.iter_files()] == [f"{DIGEST}.jpg"]
+
+    with open(storage.path(f"{DIGEST}.jpg"), "rb") as file:
+        assert file.read() == DATA
+
+
+def test_users_share_the_same_picture(api, login, db):
+    alice, bob = login("alice"), login("bob")
+
+    for headers in (alice, bob):
+        response = api.post("/api/upload_profile_picture_file", headers=headers,
+                            files={"file": ("picture.jpg", DATA, "image/jpeg")})
+        assert response.status_code == 200, response.text
+
+    users = api.portal.call(db.users.find({}, {"profile_picture": 1, "profile_picture_hash": 1}).to_list, None)
+
+    assert {user["profile_picture_hash"] for user in users} == {DIGEST}
+    assert {user["profile_picture"].rsplit("/", 1)[1] for user in users} == {f"{DIGEST}.jpg"}
+    assert [name for name, _ in ImageStorage().iter_files()].count(f"{DIGEST}.jpg") == 1
@@ -0,0 +1,91 @@
+"""
+Prometheus metrics of one worker or every worker through the metrics directory
+"""
+import json
+import os
+
+from utils.metrics import Metrics, stats_collector
+
+
+def test_counters_and_gauges_are_rendered():
+    metrics = Metrics(directory=None)
+
+    metrics.inc("requests_total", {"route": "/a", "status": "200"})
+    metrics.inc("requests_total", {"status": "200", "route": "/a"}, 2)
+    metrics.add_gauge("connections", None, 3)
+    metrics.add_gauge("connections", None, -1)
+    metrics.set_gauge("label", {"name": 'say "hi"\n'}, 1)
+
+    assert metrics.render().splitlines() == [
+        "# TYPE connections gauge",
+        "connections 2",
+        "# TYPE label gauge",
+        'label{name="say \\"hi\\"\\n"} 1',
+        "# TYPE requests_total counter",
+        'requests_total{route="/a",status="200"} 3',
+    ]
+
+
+def test_histograms_are_cumulative():
+    metrics = Metrics(directory=None)
+
+    for value in (0.5, 2, 20):
+        metrics.observe("duration_seconds", value, {"route": "/a"}, buckets=(1, 10))
+
+    assert metrics.render().splitlines() == [
+        "# TYPE duration_seconds histogram",
+        'duration_seconds_bucket{route="/a",le="1"} 1',
+        'duration_seconds_bucket{route="/a",le="10"} 2',
+        'duration_seconds_bucket{route="/a",le="+Inf"} 3',
+        'duration_seconds_sum{route="/a"} 22.5',
+        'duration_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_collectors_leave_out_the_hit_ratio():
+    metrics = Metrics(directory=None)
+    metrics.add_collector(stats_collector("cache", "cache", "profiles",
+                                          lambda: {"entries": 2, "hit_ratio": 0.5, "name": "profiles"}))
+
+    assert metrics.render().splitlines() == ["# TYPE cache_entries gauge", 'cache_entries{cache="profiles"} 2']
+
+
+def test_workers_are_added_up(tmp_path):
+    metrics = Metrics(directory=str(tmp_path))
+    metrics.inc("requests_total", {"route": "/a"}, 2)
+    metrics.set_gauge("connections", None, 1)
+    metrics.observe("duration_seconds", 0.5, None, buckets=(1,))
+
+    # Another worker that has stopped, its counters stay and its gauges are dropped
+    stopped = metrics.snapshot()
+    stopped["pid"] = 2 ** 22 + 1
+
+    with open(os.path.join(tmp_path, "stopped.json"), "w") as file:
+        json.dump(stopped, file)
+
+    (tmp_path / "broken.json").write_text("{")
+
+    lines = metrics.render().splitlines()
+
+    assert 'requests_total{route="/a"} 4' in lines
+    assert "connections 1" in lines
+    assert 'duration_seconds_bucket{le="+Inf"} 2' in lines
+    assert os.path.exists(tmp_path / f"{os.getpid()}.json")
+
+
+def test_metrics_route(api, login):
+    alice = login("alice")
+    api.get("/api/get_profile", headers=alice)
+    api.get("/api/get_profile", headers=alice)
+
+    response = api.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+
+    lines = response.text.splitlines()
+
+    assert 'http_requests_total{method="GET",route="/api/get_profile",status="200"} 2' in lines
+    assert "# TYPE http_request_duration_seconds histogram" in lines
+    assert any(line.startswith('cache_entries{cache="images"}') for line in lines)
+    assert any(line.startswith('event_bus_') for line in lines)
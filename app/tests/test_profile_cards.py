@@ -0,0 +1,84 @@
+"""
+Profile cards come from the cache and only the misses from one $in query
+"""
+import pytest
+
+from functions.profile_cards import ProfileCards
+from utils.cache import LocalCache
+
+
+class CountingUsers:
+    """ Users collection recording the filters of its finds """
+
+    def __init__(self, col_users):
+        self.col_users = col_users
+        self.finds = []
+
+    def find(self, query, projection=None):
+        # mongomock adds _id to the projection it gets
+        self.finds.append((query, dict(projection or {})))
+        return self.col_users.find(query, projection)
+
+
+@pytest.fixture
+async def cards(db):
+    await db.users.insert_many([
+        {"_id": i, "username": f"user{i}", "email": f"user{i}@example.com", "background": "python", "active": True}
+        for i in range(5)
+    ] + [{"_id": 5, "username": "user5", "active": False}])
+
+    profile_cards = ProfileCards(db, LocalCache("profile_cards", max_entries=100, ttl=60))
+    profile_cards.col_users = CountingUsers(profile_cards.col_users)
+
+    return profile_cards
+
+
+@pytest.mark.anyio
+async def test_misses_are_read_in_one_query(cards):
+    assert set(await cards.get_many([0, 1])) == {0, 1}
+    assert cards.col_users.finds[-1][0] == {"_id": {"$in": [0, 1]}, "active": True}
+
+    # Only the cards not cached yet are read, in one query
+    result = await cards.get_many([0, 1, 2, 3, 1])
+    assert list(result) == [0, 1, 2, 3]
+    assert result[3]["username"] == "user3"
+    assert len(cards.col_users.finds) == 2
+    assert cards.col_users.finds[-1][0] == {"_id": {"$in": [2, 3]}, "active": True}
+
+    # Everything cached, no query at all
+    await cards.get_many([3, 2, 1, 0])
+    assert len(cards.col_users.finds) == 2
+
+
+@pytest.mark.anyio
+async def test_inactive_and_missing_users_are_left_out(cards):
+    assert list(await cards.get_many([4, 5, 99])) == [4]
+
+
+@pytest.mark.anyio
+async def test_fields_are_projected(cards):
+    card = await cards.get(0, ["username"])
+
+    assert card == {"username": "user0"}
+    assert cards.col_users.finds[-1][1] == {"username": 1}
+
+    # A cached card missing a field is read again and keeps what it had
+    card = await cards.get(0, ["username", "email"])
+    assert card == {"username": "user0", "email": "user0@example.com"}
+    assert len(cards.col_users.finds) == 2
+
+    assert await cards.get(0, ["email"]) == card
+    assert len(cards.col_users.finds) == 2
+
+
+@pytest.mark.anyio
+async def test_invalidate_reads_the_card_again(cards, db):
+    await cards.get(0)
+    await db.users.update_one({"_id": 0}, {"$set": {"background": "rust"}})
+
+    assert (await cards.get(0))["background"] == "python"
+
+    await cards.invalidate(0)
+
+    assert (await cards.get(0))["background"] == "rust"
+    assert len(cards.col_users.finds) == 2
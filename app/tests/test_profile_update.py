@@ -0,0 +1,59 @@
+"""
+Profile updates only write when a field differs and bump the revision of the profile
+"""
+
+
+def revision(api, db, username: str) -> int:
+    return api.portal.call(db.users.find_one, {"username": username}).get("revision", 0)
+
+
+def update(api, headers, **fields):
+    response = api.post("/api/update_profile", headers=headers, json=fields)
+    assert response.status_code == 200, response.text
+
+    return response.json()["changed"]
+
+
+def test_only_changed_fields_are_reported(api, login, db):
+    alice = login("alice", background="python", looking_for="a team")
+    before = revision(api, db, "alice")
+
+    assert update(api, alice, background="python", looking_for="a mentor") == ["looking_for"]
+    assert revision(api, db, "alice") == before + 1
+
+    user = api.portal.call(db.users.find_one, {"username": "alice"})
+    assert (user["background"], user["looking_for"]) == ("python", "a mentor")
+
+
+def test_same_values_do_not_write(api, login, db):
+    alice = login("alice", background="python")
+    before = api.portal.call(db.users.find_one, {"username": "alice"})
+
+    assert update(api, alice, background="python") == []
+
+    after = api.portal.call(db.users.find_one, {"username": "alice"})
+    assert after.get("revision") == before.get("revision")
+    assert after["updated_at"] == before["updated_at"]
+
+
+def test_other_fields_are_ignored(api, login, db):
+    alice = login("alice")
+
+    assert update(api, alice, username="mallory", revision=0, active=False) == []
+    assert api.portal.call(db.users.find_one, {"username": "alice", "active": True}) is not None
+
+
+def test_invalid_fields_are_refused(api, login):
+    alice = login("alice")
+
+    assert api.post("/api/update_profile", headers=alice, json={"background": 1}).status_code == 400
+    assert api.post("/api/update_profile", headers=alice, json={"email": "a" * 321}).status_code == 400
+
+
+def test_update_is_seen_by_get_profile(api, login):
+    alice = login("alice", background="python")
+    assert api.get("/api/get_profile", headers=alice).json()["background"] == "python"
+
+    update(api, alice, background="rust")
+
+    assert api.get("/api/get_profile", headers=alice).json()["background"] == "rust"
@@ -0,0 +1,246 @@
+"""
+Query shapes, the query log and the budget middleware fed with synthetic pymongo command events,
+and the budgets of the real routes on mongomock
+"""
+import base64
+import datetime
+import io
+import threading
+
+import mongomock.collection
+import pytest
+from bson import ObjectId
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pymongo.monitoring import CommandStartedEvent, CommandSucceededEvent
+
+from utils.query_budget import ROUTE_BUDGETS, QueryBudget, QueryListener, QueryLog, command_shape, current_log, \
+    query_budget_middleware, shape, track_queries
+
+ADDRESS = ("localhost", 27017)
+
+
+def started(command: dict) -> CommandStartedEvent:
+    return CommandStartedEvent(command, "codespark", 1, ADDRESS, 1)
+
+
+def find_user(username: str) -> dict:
+    return {"find": "users", "filter": {"username": username, "active": True}, "$db": "codespark"}
+
+
+def test_shape_replaces_values():
+    assert shape({"_id": {"$in": [ObjectId(), ObjectId()]}, "active": True}) == {"_id": {"$in": ["?"]}, "active": "?"}
+    assert shape({"$or": [{"user_id": 1}, {"liked_user_id": 2}]}) == {"$or": [{"user_id": "?"}]}
+    assert shape({"likes": []}) == {"likes": []}
+
+
+def test_command_shape():
+    assert command_shape("find", find_user("alice")) == command_shape("find", find_user("bob"))
+    assert command_shape("find", find_user("alice")) == 'find users {"active": "?", "username": "?"}'
+
+    # Writes are shaped by their first statement
+    update = {"update": "sessions", "updates": [{"q": {"_id": ObjectId()}, "u": {"$set": {"last_used": 1}}}]}
+    assert command_shape("update", update) == 'update sessions {"_id": "?"}'
+
+    aggregate = {"aggregate": "likes", "pipeline": [{"$match": {"user_id": ObjectId()}}, {"$limit": 10}]}
+    assert command_shape("aggregate", aggregate) == 'aggregate likes [{"$match": {"user_id": "?"}}]'
+
+
+def test_repeated_shapes():
+    log = QueryLog()
+
+    for username in ["a", "b", "c"]:
+        log.started("find", find_user(username))
+
+    log.started("find", {"find": "likes", "filter": {"user_id": 1}})
+    log.started("getMore", {"getMore": 1, "collection": "users"})
+
+    assert log.queries == 4
+    assert log.round_trips == 5
+    assert log.repeated(3) == [('find users {"active": "?", "username": "?"}', 3)]
+    assert log.repeated(4) == []
+
+
+def test_listener_adds_to_the_current_log():
+    listener = QueryListener()
+
+    # Outside of a request nothing is logged
+    listener.started(started(find_user("a")))
+
+    with track_queries() as log:
+        listener.started(started(find_user("a")))
+        listener.succeeded(CommandSucceededEvent(datetime.timedelta(milliseconds=2), {"ok": 1}, "find", 1, ADDRESS, 1))
+
+    assert log.queries == 1
+    assert log.seconds == pytest.approx(0.002)
+
+
+def create_app(mode: str) -> TestClient:
+    app = FastAPI()
+    app.state.query_budget = QueryBudget(mode=mode, budgets={"/users": 2}, repeat_threshold=3)
+    app.middleware("http")(query_budget_middleware)
+
+    listener = QueryListener()
+
+    @app.get("/users")
+    async def users(count: int):
+        # One find per user, what Motor reports for a query in a loop
+        for i in range(count):
+            listener.started(started(find_user(f"user{i}")))
+
+        return {"users": count}
+
+    return TestClient(app)
+
+
+def test_warn_within_budget():
+    response = create_app("warn").get("/users", params={"count": 2})
+
+    assert response.status_code == 200
+    assert response.headers["x-db-queries"] == "2"
+    assert "x-db-repeated" not in response.headers
+
+
+def test_warn_over_budget_keeps_the_response(capsys):
+    response = create_app("warn").get("/users", params={"count": 3})
+
+    assert response.status_code == 200
+    assert response.json() == {"users": 3}
+    assert response.headers["x-db-queries"] == "3"
+    assert response.headers["x-db-repeated"] == "1"
+    assert "Query budget exceeded in GET /users: 3 queries, budget 2" in capsys.readouterr().out
+
+
+def test_enforce_over_budget():
+    response = create_app("enforce").get("/users", params={"count": 3})
+
+    assert response.status_code == 500
+    assert response.json()["message"] == "Query budget exceeded"
+    assert response.json()["budget"] == 2
+    assert response.json()["shapes"] == {'find users {"active": "?", "username": "?"}': 3}
+    assert response.headers["x-db-queries"] == "3"
+
+
+def test_off_adds_nothing():
+    response = create_app("off").get("/users", params={"count": 3})
+
+    assert response.status_code == 200
+    assert "x-db-queries" not in response.headers
+
+
+# Collection methods that send one command each on a real server, mongomock sends no command events
+COMMAND_METHODS = ["find", "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+                   "find_one_and_update", "aggregate", "count_documents", "distinct", "bulk_write", "delete_one",
+                   "delete_many"]
+
+
+@pytest.fixture
+def budget_api(api, monkeypatch):
+    """
+    The app enforcing the budgets, every mongomock collection call counts as a query of the request
+    """
+    nested = threading.local()
+
+    def counted(name, method):
+        def call(self, *args, **kwargs):
+            depth = getattr(nested, "depth", 0)
+            log = current_log.get()
+
+            # mongomock calls its own methods, find_one calls find
+            if depth == 0 and log is not None:
+                log.started(name, {})
+
+            nested.depth = depth + 1
+
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                nested.depth = depth
+
+        return call
+
+    for name in COMMAND_METHODS:
+        monkeypatch.setattr(mongomock.collection.Collection, name,
+                            counted(name, getattr(mongomock.collection.Collection, name)))
+
+    api.app.state.query_budget = QueryBudget(mode="enforce")
+
+    return api
+
+
+def queries(response, route: str) -> int:
+    # Over the budget the middleware answers 500 with the shapes
+    assert response.status_code < 500, response.text
+
+    count = int(response.headers["x-db-queries"])
+    assert count <= ROUTE_BUDGETS[route], f"{route}: {count} queries, budget {ROUTE_BUDGETS[route]}"
+
+    return count
+
+
+def jpeg() -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (80, 60), (200, 10, 10)).save(buffer, "JPEG")
+
+    return buffer.getvalue()
+
+
+def test_routes_stay_within_their_budgets(budget_api):
+    api = budget_api
+    login_route = "/api/oauth/github/session_id"
+
+    # First login creates the user, the next one replaces the session
+    for username in ["alice", "bob", "carol", "dave", "alice"]:
+        response = api.get(login_route, params={"code": username})
+        assert queries(response, login_route) > 0
+
+    assert queries(api.get("/init_login", params={"code": "bob"}), "/init_login") > 0
+
+    sessions = {}
+
+    for username in ["alice", "bob", "carol", "dave"]:
+        package = api.get(login_route, params={"code": username}).json()
+        sessions[username] = {"username": username, "session_id": package["session_id"]}
+
+    alice, bob, carol, dave = sessions.values()
+
+    # Profile
+    response = api.post("/api/update_profile", headers=alice, json={"background": "python"})
+    queries(response, "/api/update_profile")
+    queries(api.get("/api/get_profile", headers=alice), "/api/get_profile")
+
+    response = api.post("/api/upload_profile_picture", headers=bob,
+                        json={"image": base64.b64encode(jpeg()).decode()})
+    queries(response, "/api/upload_profile_picture")
+
+    response = api.post("/api/upload_profile_picture_file", headers=alice,
+                        files={"file": ("avatar.jpg", jpeg(), "image/jpeg")})
+    queries(response, "/api/upload_profile_picture_file")
+
+    response = api.get("/api/profile_image/alice")
+    assert queries(response, "/api/profile_image/{username}") == 1
+
+    file_name = api.get("/api/get_profile", headers=alice).json()["profile_picture"].rsplit("/", 1)[1]
+    response = api.get(f"/api/get_profile_picture/{file_name}")
+    assert queries(response, "/api/get_profile_picture/{file_name}") == 0
+
+    # Swipes, the like that makes a match and the dislike of a match are the most expensive
+    like, dislike = "/api/like_user/{liked_username}", "/api/dislike_user/{disliked_username}"
+
+    queries(api.put("/api/like_user/bob", headers=alice), like)
+    queries(api.put("/api/like_user/alice", headers=bob), like)
+    queries(api.put("/api/like_user/carol", headers=alice), like)
+    queries(api.put("/api/dislike_user/dave", headers=alice), dislike)
+    queries(api.put("/api/like_user/alice", headers=dave), like)
+    queries(api.put("/api/dislike_user/dave", headers=alice), dislike)
+    queries(api.put("/api/like_user/alice", headers=carol), like)
+    queries(api.put("/api/dislike_user/carol", headers=alice), dislike)
+
+    # Listings
+    for route in ["/api/get_likes", "/api/get_matches", "/api/get_counts", "/api/get_discovers"]:
+        assert queries(api.get(route, headers=alice), route) > 0
+
+    queries(api.delete("/api/unmatch", headers=alice, params={"matched_username": "bob"}), "/api/unmatch")
+    queries(api.delete("/api/delete_user", headers=dave), "/api/delete_user")
@@ -0,0 +1,172 @@
+"""
+Rate limits with the worker buckets, the key value buckets against the in-memory server, and the MongoDB ones
+against a real MongoDB when MONGO_TEST_URI is set:
+    MONGO_TEST_URI=mongodb://localhost:27017 python -m pytest tests/test_rate_limit.py
+"""
+import pytest
+
+from utils.kv import KeyValueClient
+from utils.rate_limit import KeyValueBuckets, LocalBuckets, MongoBuckets, RateLimiter
+
+ROUTE = "/api/like_user/{liked_username}"
+
+
+def limits(burst: float, global_burst: float) -> dict:
+    # Nothing refills while a test runs
+    return {ROUTE: {"burst": burst, "rate": 0.001, "global_burst": global_burst, "global_rate": 0.001}}
+
+
+@pytest.fixture
+async def client(server):
+    kv_client = KeyValueClient(server.url)
+
+    yield kv_client
+
+    await kv_client.close()
+
+
+async def allowed_users(limiter: RateLimiter, requests: int) -> list:
+    # One request per user, only the global limit refuses
+    results = [await limiter.retry_after(ROUTE, f"user{i}") for i in range(requests)]
+
+    return [scope for _, scope in results]
+
+
+@pytest.mark.anyio
+async def test_local_bucket_refuses_past_burst():
+    buckets = LocalBuckets()
+
+    assert [await buckets.take("key", 2, 0.001) for _ in range(2)] == [0.0, 0.0]
+    assert await buckets.take("key", 2, 0.001) > 0
+
+
+@pytest.mark.anyio
+async def test_user_limit_is_per_user():
+    limiter = RateLimiter(backend="local", limits=limits(burst=1, global_burst=100))
+
+    assert await limiter.retry_after(ROUTE, "a") == (0.0, None)
+    assert (await limiter.retry_after(ROUTE, "a"))[1] == "user"
+    assert await limiter.retry_after(ROUTE, "b") == (0.0, None)
+
+
+@pytest.mark.anyio
+async def test_global_refusal_gives_the_user_token_back():
+    limiter = RateLimiter(backend="local", limits=limits(burst=3, global_burst=1))
+
+    assert await limiter.retry_after(ROUTE, "a") == (0.0, None)
+    assert (await limiter.retry_after(ROUTE, "b"))[1] == "global"
+
+    # b was refused by the route, the user bucket is still full
+    tokens, _ = limiter.buckets.buckets[f"user:{ROUTE}:b"]
+    assert tokens == pytest.approx(3, abs=0.01)
+
+
+@pytest.mark.anyio
+async def test_shards_allow_the_whole_global_limit():
+    limiter = RateLimiter(backend="local", limits=limits(burst=10, global_burst=40))
+    limiter.global_shards = 4
+
+    scopes = await allowed_users(limiter, 60)
+
+    # The first 40 find a shard with a token wherever they start
+    assert scopes == [None] * 40 + ["global"] * 20
+
+
+@pytest.mark.anyio
+async def test_empty_shards_are_not_asked_again():
+    limiter = RateLimiter(backend="local", limits=limits(burst=10, global_burst=8))
+    limiter.global_shards = 4
+
+    await allowed_users(limiter, 8)
+
+    taken = []
+    take = limiter.buckets.take
+
+    async def counting_take(key, burst, rate):
+        taken.append(key)
+        return await take(key, burst, rate)
+
+    limiter.buckets.take = counting_take
+
+    assert (await limiter.retry_after(ROUTE, "late"))[1] == "global"
+    asked = len([key for key in taken if key.startswith("global:")])
+
+    # Every shard is known to be empty now, only the user bucket is asked
+    assert (await limiter.retry_after(ROUTE, "later"))[1] == "global"
+    assert 1 <= asked <= 4
+    assert taken[-1] == f"user:{ROUTE}:later"
+    assert len([key for key in taken if key.startswith("global:")]) == asked
+
+
+@pytest.mark.anyio
+async def test_unlimited_route():
+    limiter = RateLimiter(backend="local", limits={ROUTE: None})
+
+    assert await limiter.retry_after(ROUTE, "a") == (0.0, None)
+
+
+@pytest.mark.anyio
+async def test_key_value_bucket_refuses_past_burst(client):
+    buckets = KeyValueBuckets(client)
+
+    assert [await buckets.take("key", 2, 0.001) for _ in range(2)] == [0.0, 0.0]
+
+    await buckets.give_back("key", 2, 0.001)
+    assert await buckets.take("key", 2, 0.001) == 0.0
+    assert await buckets.take("key", 2, 0.001) > 0
+
+
+@pytest.mark.anyio
+async def test_key_value_buckets_are_shared(client, server):
+    # Two workers on one server
+    first = RateLimiter(backend="kv", client=client, limits=limits(burst=2, global_burst=5))
+    second = RateLimiter(backend="kv", client=KeyValueClient(server.url), limits=limits(burst=2, global_burst=5))
+
+    assert [await first.retry_after(ROUTE, "a") for _ in range(2)] == [(0.0, None)] * 2
+    assert (await second.retry_after(ROUTE, "a"))[1] == "user"
+
+    scopes = [(await limiter.retry_after(ROUTE, user))[1] for limiter, user in
+              [(second, "b"), (first, "c"), (second, "d"), (first, "e")]]
+    assert scopes == [None, None, None, "global"]
+
+    # e keeps its token
+    assert (await first.retry_after(ROUTE, "e"))[1] == "global"
+    assert await client.get_many([buckets_key(first, f"user:{ROUTE}:e", 2)]) == [b"0"]
+
+    await second.buckets.client.close()
+
+
+def buckets_key(limiter: RateLimiter, key: str, burst: float) -> str:
+    server_key, _, _ = limiter.buckets.window(key, burst, 0.001)
+    return server_key
+
+
+@pytest.mark.anyio
+async def test_key_value_server_down_lets_requests_through():
+    limiter = RateLimiter(backend="kv", client=KeyValueClient("redis://127.0.0.1:1/0"), limits=limits(1, 1))
+
+    assert [await limiter.retry_after(ROUTE, "a") for _ in range(3)] == [(0.0, None)] * 3
+
+
+@pytest.mark.anyio
+async def test_mongo_bucket_refuses_past_burst(mongo_db):
+    buckets = MongoBuckets(mongo_db)
+
+    assert [await buckets.take("key", 2, 0.001) for _ in range(2)] == [0.0, 0.0]
+    assert await buckets.take("key", 2, 0.001) > 0
+
+    await buckets.give_back("key", 2, 0.001)
+    assert await buckets.take("key", 2, 0.001) == 0.0
+
+
+@pytest.mark.anyio
+async def test_mongo_global_shards_add_up_to_the_limit(mongo_db):
+    limiter = RateLimiter(db=mongo_db, backend="mongo", limits=limits(burst=10, global_burst=40))
+    limiter.global_shards = 4
+
+    assert await allowed_users(limiter, 60) == [None] * 40 + ["global"] * 20
+    assert await mongo_db["rate_limits"].count_documents({"_id": {"$regex": "^global:"}}) == 4
+
+    # Refused users were given their token back
+    user = await mongo_db["rate_limits"].find_one({"_id": f"user:{ROUTE}:user59"})
+    assert user["tokens"] == pytest.approx(10, abs=0.1)
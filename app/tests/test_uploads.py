@@ -0,0 +1,88 @@
+"""
+Uploads are streamed to disk, size and type are checked while the body comes in
+"""
+import hashlib
+import io
+import os
+
+import pytest
+from fastapi import HTTPException, UploadFile
+
+from utils.uploads import MAX_UPLOAD_BODY_BYTES, stream_upload
+
+JPEG = b"\xff\xd8\xff\xe0" + b"\0" * 1000
+
+
+def stored_files() -> list:
+    return [name for _, _, file_names in os.walk("image_storage") for name in file_names]
+
+
+def upload(data: bytes) -> UploadFile:
+    return UploadFile(io.BytesIO(data), filename="picture.jpg")
+
+
+@pytest.mark.anyio
+async def test_stream_upload_writes_the_image(tmp_path):
+    temp_path, size, content_type, extension, digest = await stream_upload(upload(JPEG), str(tmp_path))
+
+    assert os.path.dirname(temp_path) == str(tmp_path)
+    assert (size, content_type, extension) == (len(JPEG), "image/jpeg", "jpg")
+    assert digest == hashlib.sha256(JPEG).hexdigest()
+
+    with open(temp_path, "rb") as file:
+        assert file.read() == JPEG
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("data, status_code", [
+    (JPEG, 413),
+    (b"<svg xmlns='http://www.w3.org/2000/svg'/>", 415),
+    (b"", 400),
+], ids=["too large", "not an image", "empty"])
+async def test_stream_upload_refuses_and_cleans_up(tmp_path, data, status_code):
+    with pytest.raises(HTTPException) as error:
+        await stream_upload(upload(data), str(tmp_path), max_bytes=500)
+
+    assert error.value.status_code == status_code
+    assert os.listdir(tmp_path) == []
+
+
+def test_upload_route_stores_the_picture(api, login):
+    alice = login("alice")
+    image = JPEG
+
+    response = api.post("/api/upload_profile_picture_file", headers=alice,
+                        files={"file": ("picture.jpg", image, "image/jpeg")})
+    assert response.status_code == 200, response.text
+
+    stored = stored_files()
+    assert f"{hashlib.sha256(image).hexdigest()}.jpg" in stored
+    assert not [name for name in stored if name.endswith(".part")]
+
+
+def test_upload_route_refuses_other_types(api, login):
+    alice = login("alice")
+
+    response = api.post("/api/upload_profile_picture_file", headers=alice,
+                        files={"file": ("picture.jpg", b"GIF? no, text", "image/jpeg")})
+
+    assert response.status_code == 415
+    assert not [name for name in stored_files() if name.endswith(".part")]
+
+
+def test_oversized_body_is_refused_before_it_is_read(api, login):
+    alice = login("alice")
+    body = b"x" * (MAX_UPLOAD_BODY_BYTES + 1)
+
+    response = api.post("/api/upload_profile_picture_file", headers={**alice, "content-type": "application/octet-stream"},
+                        content=body)
+    assert response.status_code == 413
+
+    # Chunked bodies have no length up front, they are cut off at the limit
+    def chunks():
+        for _ in range(len(body) // 65536 + 1):
+            yield b"x" * 65536
+
+    response = api.post("/api/upload_profile_picture", headers={**alice, "content-type": "application/json"},
+                        content=chunks())
+    assert response.status_code == 413
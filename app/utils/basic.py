@@ -1,5 +1,6 @@
 import pymongo
 import bcrypt
+from starlette.concurrency import run_in_threadpool
 
 
 class BasicUtils:
@@ -10,14 +11,12 @@ class BasicUtils:
         self.col_users = self.db["users"]
         self.col_sessions = self.db["sessions"]
 
-    def find_username(self, hashed_session_id) -> str:
-        # Loop over all the sessions and find the username
-        for session in self.get_all_sessions():
-            if bcrypt.checkpw(hashed_session_id.encode(), session["session_id"]):
+    async def find_username(self, hashed_session_id) -> str:
+        # Loop over all the sessions and find the username, bcrypt runs off the event loop
+        async for session in self.get_all_sessions():
+            if await run_in_threadpool(bcrypt.checkpw, hashed_session_id.encode(), session["session_id"]):
                 return session["username"]
 
     def get_all_sessions(self):
         sessions = self.col_sessions.find({})
         return sessions
-
-
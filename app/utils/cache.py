@@ -0,0 +1,426 @@
+import asyncio
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+import bson
+
+from utils.kv import KeyValueClient, KeyValueError
+
+# Deletes of the shared caches, every worker drops its near copies of the keys
+INVALIDATION_CHANNEL = "codespark:cache:invalidate"
+
+# Errors that make a shared cache lookup a miss
+CACHE_ERRORS = (OSError, KeyValueError, asyncio.TimeoutError, asyncio.IncompleteReadError)
+
+
+def sizeof(value) -> int:
+    """
+    Rough memory footprint of a cached value in bytes
+    :param value:
+    :return:
+    """
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        size += sum(sizeof(key) + sizeof(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(sizeof(item) for item in value)
+
+    return size
+
+
+class TTLCache:
+    """
+    Bounded LRU cache with a time to live per entry
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys) -> dict:
+        """
+        Gets every key that is cached and not expired
+        :param keys:
+        :return: dict of the hits
+        """
+        now = time.monotonic()
+        found = {}
+
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+
+                if entry is None or entry[0] < now:
+                    if entry is not None:
+                        self._remove(key)
+
+                    self.misses += 1
+                    continue
+
+                self.entries.move_to_end(key)
+                found[key] = entry[1]
+                self.hits += 1
+
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, values: dict):
+        expires_at = time.monotonic() + self.ttl
+
+        with self.lock:
+            for key, value in values.items():
+                if key in self.entries:
+                    self._remove(key)
+
+                size = sizeof(value)
+                self.entries[key] = (expires_at, value, size)
+                self.bytes += size
+
+            # Evict the least recently used entries
+            while len(self.entries) > self.max_entries:
+                key = next(iter(self.entries))
+                self._remove(key)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.bytes -= entry[2]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class LocalCache:
+    """
+    Cache of this worker only, with several workers each one keeps its own copy until it expires
+    """
+
+    def __init__(self, name: str, max_entries: int = 10000, ttl: float = 60.0):
+        self.name = name
+        self.entries = TTLCache(max_entries=max_entries, ttl=ttl)
+
+    async def get_many(self, keys) -> dict:
+        return self.entries.get_many(keys)
+
+    async def get(self, key):
+        return self.entries.get(key)
+
+    async def set_many(self, values: dict):
+        self.entries.set_many(values)
+
+    async def set(self, key, value):
+        self.entries.set(key, value)
+
+    async def delete_many(self, keys):
+        for key in keys:
+            self.entries.delete(key)
+
+    async def delete(self, key):
+        await self.delete_many([key])
+
+    def drop(self, keys):
+        # Nothing else can change this cache
+        pass
+
+    def clear_near(self):
+        pass
+
+    def stats(self) -> dict:
+        return self.entries.stats()
+
+
+class NoCache:
+    """
+    Stands in for a cache that can not be kept in each worker, a change in one worker would not reach the copies of
+    the others. Every lookup is a miss
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.misses = 0
+
+    async def get_many(self, keys) -> dict:
+        self.misses += len(keys)
+        return {}
+
+    async def get(self, key):
+        self.misses += 1
+
+    async def set_many(self, values: dict):
+        pass
+
+    async def set(self, key, value):
+        pass
+
+    async def delete_many(self, keys):
+        pass
+
+    async def delete(self, key):
+        pass
+
+    def drop(self, keys):
+        pass
+
+    def clear_near(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"entries": 0, "bytes": 0, "hits": 0, "misses": self.misses, "hit_ratio": 0.0}
+
+
+class SharedCache:
+    """
+    Cache shared by every worker through a Redis compatible server, values are stored as BSON.
+    Each worker keeps a small near cache in front of it, deletes are published on INVALIDATION_CHANNEL
+    so the other workers drop their near copies right away. The near copies live near_ttl at most,
+    also when a message is lost.
+    Values are read from the database before they are set, so a set only fills a missing key and a delete
+    leaves an empty value for hold seconds: a value read before the delete and set after it is refused.
+    When the server can not be reached every lookup is a miss and the caller reads the database
+    """
+
+    def __init__(self, name: str, client: KeyValueClient, ttl: float = 60.0, near_entries: int = 1000,
+                 near_ttl: float = 5.0, hold: float = 5.0):
+        self.name = name
+        self.client = client
+        self.ttl = ttl
+        self.hold = hold
+
+        self.near = TTLCache(max_entries=near_entries, ttl=near_ttl)
+
+        # Counts the drops of near copies, a value fetched while one happened may be older than it
+        self.drops = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def server_key(self, key: str) -> str:
+        return f"codespark:{self.name}:{key}"
+
+    async def get_many(self, keys) -> dict:
+        """
+        Gets every key that is cached, from the near cache first
+        :param keys:
+        :return: dict of the hits by the keys as given
+        """
+        # Keys are strings everywhere, so the invalidation messages match the near cache
+        keys = {str(key): key for key in keys}
+
+        near = self.near.get_many(keys)
+        found = {keys[key]: value for key, value in near.items()}
+        missing = [key for key in keys if key not in near]
+
+        if not missing:
+            return found
+
+        drops = self.drops
+
+        try:
+            values = await self.client.get_many([self.server_key(key) for key in missing])
+        except CACHE_ERRORS as e:
+            self.errors += 1
+            print(f"Cache {self.name} get failed: {e}")
+            return found
+
+        # Deleted keys are empty until the hold ends
+        shared = {key: bson.decode(value)["value"] for key, value in zip(missing, values) if value}
+
+        self.hits += len(shared)
+        self.misses += len(missing) - len(shared)
+
+        self.near_fill(shared, drops)
+        found.update({keys[key]: value for key, value in shared.items()})
+
+        return found
+
+    async def get(self, key):
+        return (await self.get_many([key])).get(key)
+
+    async def set_many(self, values: dict):
+        """
+        Sets the keys that are not cached and not held by a recent delete
+        :param values:
+        :return:
+        """
+        values = {str(key): value for key, value in values.items()}
+        drops = self.drops
+
+        try:
+            stored = await asyncio.gather(*[self.client.set(self.server_key(key), bson.encode({"value": value}),
+                                                            self.ttl, only_new=True)
+                                            for key, value in values.items()])
+        except CACHE_ERRORS as e:
+            self.errors += 1
+            print(f"Cache {self.name} set failed: {e}")
+            return
+
+        self.near_fill({key: value for (key, value), ok in zip(values.items(), stored) if ok}, drops)
+
+    def near_fill(self, values: dict, drops: int):
+        # A drop while the server was asked may be of these keys, the next lookup asks again
+        if drops == self.drops:
+            self.near.set_many(values)
+
+    async def set(self, key, value):
+        await self.set_many({key: value})
+
+    async def delete_many(self, keys):
+        """
+        Deletes the keys in every worker
+        :param keys:
+        :return:
+        """
+        keys = [str(key) for key in keys]
+
+        self.drop(keys)
+
+        try:
+            # Empty values block the sets of values read before the delete
+            await asyncio.gather(*[self.client.set(self.server_key(key), b"", self.hold) for key in keys])
+            await self.client.publish(INVALIDATION_CHANNEL, "\n".join([self.name] + keys))
+        except CACHE_ERRORS as e:
+            # The shared copies expire after ttl
+            self.errors += 1
+            print(f"Cache {self.name} delete failed: {e}")
+
+    async def delete(self, key):
+        await self.delete_many([key])
+
+    def drop(self, keys):
+        # Near copies only, for the invalidation messages
+        self.drops += 1
+
+        for key in keys:
+            self.near.delete(key)
+
+    def clear_near(self):
+        self.drops += 1
+        self.near.clear()
+
+    def stats(self) -> dict:
+        near = self.near.stats()
+        hits = near["hits"] + self.hits
+        lookups = hits + self.misses
+
+        return {
+            "entries": near["entries"],
+            "bytes": near["bytes"],
+            "near_hits": near["hits"],
+            "hits": hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_ratio": hits / lookups if lookups else 0.0
+        }
+
+
+class Caches:
+    """
+    Caches of one worker, SharedCache when CACHE_URL points to a Redis compatible server, e.g.
+    redis://localhost:6379/0. python -m utils.kv_server is a stand-in for development.
+    Without CACHE_URL sessions, profiles and cards are read from the database on every request: serve.py starts
+    several workers and a copy in each would outlive the changes made in another one
+    """
+
+    def __init__(self, url: str = None, ttl: float = None):
+        self.url = url if url is not None else os.getenv("CACHE_URL")
+        self.ttl = ttl
+        self.client = KeyValueClient(self.url) if self.url else None
+
+        self.caches = {}
+        self.subscription = None
+
+        # Session of each username
+        self.sessions = self.create("sessions", ttl=60)
+
+        # Session ids bcrypt accepted, by session id and bcrypt hash. Never stale, so kept in every worker
+        self.session_digests = LocalCache("session_digests", max_entries=10000,
+                                          ttl=self.ttl if self.ttl is not None else 3600)
+        self.caches["session_digests"] = self.session_digests
+
+        # Profile of each username, for the profile and its ETag
+        self.profiles = self.create("profiles", ttl=60)
+
+        # Cards of the listings by user id
+        self.profile_cards = self.create("profile_cards", ttl=60)
+
+    def create(self, name: str, ttl: float):
+        # One ttl for every cache, 0 turns caching off for benchmarks
+        ttl = self.ttl if self.ttl is not None else ttl
+
+        if self.client is not None:
+            cache = SharedCache(name, self.client, ttl=ttl)
+        else:
+            cache = NoCache(name)
+
+        self.caches[name] = cache
+
+        return cache
+
+    async def start(self):
+        """
+        Listens to the deletes of the other workers, only the shared caches have any
+        :return:
+        """
+        if self.client is not None and self.subscription is None:
+            self.subscription = asyncio.create_task(
+                self.client.subscribe(INVALIDATION_CHANNEL, self.invalidated, self.subscribed))
+
+    def invalidated(self, message: bytes):
+        name, *keys = message.decode().split("\n")
+        cache = self.caches.get(name)
+
+        if cache is not None:
+            cache.drop(keys)
+
+    def subscribed(self):
+        # Deletes published before the subscription started were not heard
+        for cache in self.caches.values():
+            cache.clear_near()
+
+    async def close(self):
+        if self.subscription is not None:
+            self.subscription.cancel()
+            self.subscription = None
+
+        if self.client is not None:
+            await self.client.close()
+
+    def stats(self) -> dict:
+        return {name: cache.stats() for name, cache in self.caches.items()}
@@ -0,0 +1,159 @@
+"""
+Compression of JSON and text responses, brotli when the client accepts it and the brotli package is installed,
+gzip otherwise. Small bodies, streams (event streams and files) and images are sent as they are
+"""
+import gzip
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing, images are compressed already
+COMPRESSIBLE_TYPES = ("application/json", "text/html", "text/plain", "text/css", "application/javascript")
+
+# Encoding names and q-values of Accept-Encoding
+ACCEPT_ENCODING = re.compile(r"\s*([a-z*]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?", re.IGNORECASE)
+
+
+def accepted_encodings(accept_encoding: str) -> dict:
+    """
+    Parses Accept-Encoding
+    :param accept_encoding: e.g. "gzip, br;q=0.9"
+    :return: {encoding: q-value}
+    """
+    accepted = {}
+
+    for part in accept_encoding.split(","):
+        match = ACCEPT_ENCODING.match(part)
+
+        if match is None or not match.group(1):
+            continue
+
+        try:
+            accepted[match.group(1).lower()] = float(match.group(2)) if match.group(2) else 1.0
+        except ValueError:
+            continue
+
+    return accepted
+
+
+def choose_encoding(accept_encoding: str) -> str:
+    """
+    Best encoding this server can produce for the client
+    :param accept_encoding:
+    :return: "br", "gzip" or None for no compression
+    """
+    accepted = accepted_encodings(accept_encoding or "")
+    wildcard = accepted.get("*", 0)
+
+    # Brotli first, it is smaller at the same CPU cost on JSON
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    scored = [(accepted.get(encoding, wildcard), encoding) for encoding in candidates]
+    quality, encoding = max(scored, key=lambda item: item[0])
+
+    return encoding if quality > 0 else None
+
+
+def vary_accept_encoding(headers: list) -> list:
+    """
+    Adds Accept-Encoding to the Vary header, kept in one header with what the response varies on already
+    :param headers: raw headers of the response
+    :return:
+    """
+    vary = [value for name, value in headers if name.lower() == b"vary"]
+    values = [value.strip() for header in vary for value in header.split(b",") if value.strip()]
+
+    if b"accept-encoding" in (value.lower() for value in values) or b"*" in values:
+        return headers
+
+    headers = [(name, value) for name, value in headers if name.lower() != b"vary"]
+    return headers + [(b"vary", b", ".join(values + [b"Accept-Encoding"]))]
+
+
+class CompressionMiddleware:
+    """
+    Plain ASGI middleware, compresses whole bodies. Original and sent bytes are counted per route
+    in http_response_bytes_total and http_response_uncompressed_bytes_total
+    """
+
+    def __init__(self, app, minimum_size: int = None, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size if minimum_size is not None else \
+            int(os.getenv("COMPRESSION_MINIMUM_SIZE", 1000))
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        encoding = choose_encoding(dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1"))
+        start_message = None
+
+        def count(original: int, sent: int, used: str):
+            metrics = getattr(scope["app"].state, "metrics", None) if "app" in scope else None
+            route = scope.get("route")
+
+            if metrics is None:
+                return
+
+            labels = {"route": route.path if route is not None else "unmatched", "encoding": used or "identity"}
+            metrics.inc("http_response_uncompressed_bytes_total", labels, original)
+            metrics.inc("http_response_bytes_total", labels, sent)
+
+        async def send_compressed(message):
+            nonlocal start_message
+
+            # Headers wait for the first body part, the length changes when the body is compressed
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+
+            if start_message is None:
+                return await send(message)
+
+            start, start_message = start_message, None
+            headers = [(name, value) for name, value in start.get("headers", [])]
+            header_values = {name.lower(): value for name, value in headers}
+            body = message.get("body", b"")
+
+            content_type = header_values.get(b"content-type", b"").decode("latin-1")
+            compressible_type = content_type.startswith(COMPRESSIBLE_TYPES)
+            compressible = encoding is not None and not message.get("more_body", False) and \
+                len(body) >= self.minimum_size and b"content-encoding" not in header_values and compressible_type
+
+            # Any of these could have been compressed for another client, shared caches must keep them apart
+            if compressible_type:
+                headers = vary_accept_encoding(headers)
+
+            if not compressible:
+                # Streams are counted by their first part only
+                count(len(body), len(body), None)
+                await send({**start, "headers": headers})
+                return await send(message)
+
+            compressed = self.compress(body, encoding)
+            count(len(body), len(compressed), encoding)
+
+            headers = [(name, value) for name, value in headers if name.lower() not in (b"content-length", b"etag")]
+            headers += [(b"content-encoding", encoding.encode()), (b"content-length", str(len(compressed)).encode())]
+
+            # The ETag is of the uncompressed body, weak so caches do not mix up the encodings
+            etag = header_values.get(b"etag")
+
+            if etag is not None:
+                headers.append((b"etag", etag if etag.startswith(b"W/") else b"W/" + etag))
+
+            await send({**start, "headers": headers})
+            await send({**message, "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
@@ -6,3 +6,14 @@ import datetime as dt
 def get_database_uri():
     load_dotenv()
     return os.getenv("MONGO_URI")
+
+
+def create_async_client(**kwargs):
+    """
+    Creates a Motor client, each worker process makes its own inside its event loop
+    :param kwargs: passed to the client, e.g. maxPoolSize
+    :return:
+    """
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    return AsyncIOMotorClient(get_database_uri(), **kwargs)
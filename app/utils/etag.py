@@ -0,0 +1,48 @@
+import hashlib
+
+
+def compute_etag(body: bytes) -> str:
+    """
+    Strong ETag of a rendered response body
+    :param body:
+    :return:
+    """
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def version_etag(user_id, revision, updated_at) -> str:
+    """
+    ETag of a profile from its revision counter, cheap to compute from a projected read
+    :param user_id:
+    :param revision:
+    :param updated_at:
+    :return:
+    """
+    timestamp = int(updated_at.timestamp() * 1000) if updated_at is not None else 0
+    return f'"{user_id}-{revision or 0}-{timestamp}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Checks the If-None-Match header against the current ETag, weak validators compare equal
+    :param if_none_match:
+    :param etag:
+    :return:
+    """
+    if not if_none_match or not etag:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    # Header can hold a list of validators
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+
+        if candidate == etag:
+            return True
+
+    return False
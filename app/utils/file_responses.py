@@ -0,0 +1,168 @@
+import os
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+
+import anyio
+from fastapi import Response, status
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from utils.etag import etag_matches
+
+# Versioned file names never change content, caches can keep them for a year
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+# Files that can still be replaced, like an original served until its variant is ready
+SHORT_CACHE = "public, max-age=60"
+
+CHUNK_SIZE = 64 * 1024
+
+
+async def stat_file(path: str):
+    """
+    Stats the file in the threadpool, None when it does not exist
+    :param path:
+    :return:
+    """
+    try:
+        return await run_in_threadpool(os.stat, path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def file_etag(stat_result: os.stat_result) -> str:
+    # Files are written once under a new name, size and mtime identify the content
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def not_modified_since(if_modified_since: str, stat_result: os.stat_result) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+    return int(stat_result.st_mtime) <= since
+
+
+def parse_range(range_header: str, size: int):
+    """
+    Parses a single byte range, multiple ranges are served as the full file
+    :param range_header:
+    :param size:
+    :return: (start, end) inclusive, None for the full file, False when not satisfiable
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+
+    start, _, end = range_header[6:].strip().partition("-")
+
+    try:
+        # Suffix range, last n bytes
+        if start == "":
+            length = int(end)
+
+            if length == 0:
+                return False
+
+            return max(size - length, 0), size - 1
+
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+
+    if start >= size or start > end:
+        return False
+
+    return start, min(end, size - 1)
+
+
+async def read_range(path: str, start: int, end: int):
+    async with await anyio.open_file(path, "rb") as file:
+        await file.seek(start)
+        remaining = end - start + 1
+
+        while remaining > 0:
+            chunk = await file.read(min(CHUNK_SIZE, remaining))
+
+            if not chunk:
+                break
+
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def image_response(path: str, request_headers, cache_control: str = IMMUTABLE_CACHE,
+                         image_cache=None) -> Response:
+    """
+    Serves an image with validators, conditional requests and byte ranges
+    Hot files are served from the image cache without touching the file system
+    :param path:
+    :param request_headers:
+    :param cache_control:
+    :param image_cache: optional ImageCache
+    :return:
+    """
+    cached = image_cache.get(path) if image_cache is not None else None
+
+    if cached is not None:
+        data, stat_result = cached
+    else:
+        data = None
+        stat_result = await stat_file(path)
+
+        if stat_result is None:
+            return Response(status_code=status.HTTP_404_NOT_FOUND)
+
+    etag = file_etag(stat_result)
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes"
+    }
+
+    # Conditional requests, If-None-Match wins over If-Modified-Since
+    if_none_match = request_headers.get("if-none-match")
+
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    elif not_modified_since(request_headers.get("if-modified-since"), stat_result):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Range only applies while the client's copy is still the same file
+    byte_range = parse_range(request_headers.get("range"), stat_result.st_size)
+    if_range = request_headers.get("if-range")
+
+    if byte_range is not None and if_range is not None and if_range != etag:
+        byte_range = None
+
+    if byte_range is False:
+        headers["Content-Range"] = f"bytes */{stat_result.st_size}"
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    # Read small files into the cache on a miss
+    if data is None and image_cache is not None and image_cache.accepts(stat_result.st_size):
+        data = await run_in_threadpool(image_cache.load, path, stat_result)
+
+    if byte_range is None:
+        if data is not None:
+            return Response(content=data[:], media_type=media_type, headers=headers)
+
+        return FileResponse(path, stat_result=stat_result, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+
+    if data is not None:
+        return Response(content=data[start:end + 1], status_code=status.HTTP_206_PARTIAL_CONTENT,
+                        media_type=media_type, headers=headers)
+
+    headers["Content-Length"] = str(end - start + 1)
+
+    return StreamingResponse(read_range(path, start, end), status_code=status.HTTP_206_PARTIAL_CONTENT,
+                             media_type=media_type, headers=headers)
@@ -0,0 +1,185 @@
+"""
+Small client for a Redis compatible key value server, enough for the shared caches:
+GET, MGET, SET with an expiry and NX, DEL, INCRBY, PEXPIRE, PUBLISH and SUBSCRIBE over the RESP protocol
+"""
+import asyncio
+from urllib.parse import urlparse
+
+
+class KeyValueError(Exception):
+    """ Error reply of the server """
+
+
+def encode_command(*args) -> bytes:
+    # Commands are arrays of bulk strings
+    parts = [f"*{len(args)}\r\n".encode()]
+
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, (int, float)):
+            arg = str(arg).encode()
+
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    """
+    Reads one reply
+    :param reader:
+    :return: bytes, int, list or None, error replies are returned as KeyValueError
+    """
+    line = await reader.readline()
+
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by the server")
+
+    kind, value = line[:1], line[1:-2]
+
+    if kind == b"+":
+        return value
+    if kind == b"-":
+        return KeyValueError(value.decode(errors="replace"))
+    if kind == b":":
+        return int(value)
+    if kind == b"$":
+        if int(value) < 0:
+            return None
+
+        data = await reader.readexactly(int(value) + 2)
+        return data[:-2]
+    if kind == b"*":
+        if int(value) < 0:
+            return None
+
+        return [await read_reply(reader) for _ in range(int(value))]
+
+    raise ConnectionError(f"Unknown reply {line[:20]!r}")
+
+
+class KeyValueClient:
+    """
+    Pool of connections to redis://[:password@]host:port/db, opened when first needed.
+    A connection that fails is closed and not returned to the pool
+    """
+
+    def __init__(self, url: str, pool_size: int = 10, timeout: float = 1.0):
+        parsed = urlparse(url)
+
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.database = int(parsed.path.strip("/") or 0)
+        self.timeout = timeout
+
+        self.idle = []
+        self.slots = asyncio.Semaphore(pool_size)
+
+    async def connect(self) -> tuple:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+
+        # Log in and pick the database before the connection is used
+        for command in ([("AUTH", self.password)] if self.password else []) + \
+                ([("SELECT", self.database)] if self.database else []):
+            writer.write(encode_command(*command))
+            reply = await asyncio.wait_for(read_reply(reader), self.timeout)
+
+            if isinstance(reply, KeyValueError):
+                writer.close()
+                raise reply
+
+        return reader, writer
+
+    async def execute(self, *args):
+        """
+        Runs one command
+        :param args: command name and arguments
+        :return: reply of the server
+        """
+        async with self.slots:
+            connection = self.idle.pop() if self.idle else await self.connect()
+            reader, writer = connection
+
+            try:
+                writer.write(encode_command(*args))
+                reply = await asyncio.wait_for(read_reply(reader), self.timeout)
+            except BaseException:
+                # The reply may still arrive, the connection can not be reused
+                writer.close()
+                raise
+
+            self.idle.append(connection)
+
+        if isinstance(reply, KeyValueError):
+            raise reply
+
+        return reply
+
+    async def get_many(self, keys: list) -> list:
+        return await self.execute("MGET", *keys) if keys else []
+
+    async def set(self, key: str, value: bytes, ttl: float, only_new: bool = False) -> bool:
+        """
+        Sets the key with an expiry
+        :param key:
+        :param value:
+        :param ttl: seconds
+        :param only_new: only when the key does not exist, NX
+        :return: False when only_new and the key exists
+        """
+        args = ["SET", key, value, "PX", max(1, int(ttl * 1000))] + (["NX"] if only_new else [])
+
+        return await self.execute(*args) is not None
+
+    async def delete(self, keys: list) -> int:
+        return await self.execute("DEL", *keys) if keys else 0
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        # A missing key counts from 0
+        return await self.execute("INCRBY", key, amount)
+
+    async def expire(self, key: str, ttl: float) -> bool:
+        return await self.execute("PEXPIRE", key, max(1, int(ttl * 1000))) == 1
+
+    async def publish(self, channel: str, message: str) -> int:
+        return await self.execute("PUBLISH", channel, message)
+
+    async def subscribe(self, channel: str, callback, on_subscribe=None):
+        """
+        Calls callback with every message of the channel until cancelled, reconnects when the connection drops.
+        Messages sent while disconnected are lost, on_subscribe is called every time the subscription starts
+        so the caller can drop what they may have missed
+        :param channel:
+        :param callback: function of the message bytes
+        :param on_subscribe:
+        :return:
+        """
+        while True:
+            writer = None
+
+            try:
+                reader, writer = await self.connect()
+                writer.write(encode_command("SUBSCRIBE", channel))
+                await writer.drain()
+
+                while True:
+                    reply = await read_reply(reader)
+
+                    if isinstance(reply, list) and reply[0] == b"subscribe" and on_subscribe is not None:
+                        on_subscribe()
+                    elif isinstance(reply, list) and reply[0] == b"message":
+                        callback(reply[2])
+            except (OSError, KeyValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                print(f"Cache invalidation channel lost: {e}")
+                await asyncio.sleep(1)
+            finally:
+                if writer is not None:
+                    writer.close()
+
+    async def close(self):
+        for _, writer in self.idle:
+            writer.close()
+
+        self.idle = []
@@ -0,0 +1,210 @@
+"""
+In-memory stand-in for Redis with the commands the shared caches use, for development and for trying
+several workers on one machine without a Redis server:
+    python -m utils.kv_server --port 6390
+    CACHE_URL=redis://localhost:6390 uvicorn main:app --workers 4
+Nothing is persisted, keys live until they expire or the server stops
+"""
+import argparse
+import asyncio
+import time
+from collections import defaultdict
+
+from utils.kv import KeyValueError
+
+
+def encode_reply(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, KeyValueError):
+        return f"-{value}\r\n".encode()
+    if isinstance(value, bool):
+        return b"+OK\r\n"
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, list):
+        return f"*{len(value)}\r\n".encode() + b"".join(encode_reply(item) for item in value)
+
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+async def read_command(reader: asyncio.StreamReader) -> list:
+    """
+    Reads one command, an array of bulk strings
+    :param reader:
+    :return: arguments, None when the client is gone
+    """
+    line = await reader.readline()
+
+    if not line:
+        return None
+
+    if not line.startswith(b"*"):
+        # Inline command, e.g. PING from telnet
+        return line.split()
+
+    args = []
+
+    for _ in range(int(line[1:-2])):
+        size = int((await reader.readline())[1:-2])
+        args.append((await reader.readexactly(size + 2))[:-2])
+
+    return args
+
+
+class KeyValueServer:
+
+    def __init__(self):
+        # key: (value, expires at in monotonic seconds or None)
+        self.values = {}
+        self.channels = defaultdict(set)
+
+        # Expired keys are swept every so many writes, until then they only go when read
+        self.writes = 0
+
+    def get(self, key: bytes):
+        entry = self.values.get(key)
+
+        if entry is None:
+            return None
+
+        if entry[1] is not None and entry[1] < time.monotonic():
+            del self.values[key]
+            return None
+
+        return entry[0]
+
+    def sweep(self):
+        now = time.monotonic()
+
+        for key in [key for key, (_, expires_at) in self.values.items() if expires_at is not None and expires_at < now]:
+            del self.values[key]
+
+    def execute(self, args: list):
+        command, args = args[0].upper(), args[1:]
+
+        if command == b"PING":
+            return args[0] if args else b"PONG"
+        if command in (b"AUTH", b"SELECT"):
+            return True
+        if command == b"GET":
+            return self.get(args[0])
+        if command == b"MGET":
+            return [self.get(key) for key in args]
+        if command == b"SET":
+            expires_at = None
+            options = [arg.upper() for arg in args[2:]]
+
+            if b"NX" in options and self.get(args[0]) is not None:
+                return None
+
+            if b"PX" in options:
+                expires_at = time.monotonic() + int(options[options.index(b"PX") + 1]) / 1000
+            elif b"EX" in options:
+                expires_at = time.monotonic() + int(options[options.index(b"EX") + 1])
+
+            self.values[args[0]] = (args[1], expires_at)
+            self.writes += 1
+
+            if self.writes % 10000 == 0:
+                self.sweep()
+
+            return True
+        if command == b"DEL":
+            return sum(self.values.pop(key, None) is not None for key in args)
+        if command in (b"INCR", b"INCRBY"):
+            value = self.get(args[0])
+            expires_at = self.values[args[0]][1] if value is not None else None
+
+            try:
+                count = int(value or 0) + (int(args[1]) if command == b"INCRBY" else 1)
+            except ValueError:
+                return KeyValueError("ERR value is not an integer or out of range")
+
+            # The expiry of the key is kept
+            self.values[args[0]] = (str(count).encode(), expires_at)
+            return count
+        if command == b"PEXPIRE":
+            value = self.get(args[0])
+
+            if value is None:
+                return 0
+
+            self.values[args[0]] = (value, time.monotonic() + int(args[1]) / 1000)
+            return 1
+        if command == b"PUBLISH":
+            # Subscribers get the message in the order it was published
+            subscribers = self.channels.get(args[0], set())
+            message = encode_reply([b"message", args[0], args[1]])
+
+            for writer in subscribers:
+                writer.write(message)
+
+            return len(subscribers)
+        if command == b"FLUSHDB":
+            self.values.clear()
+            return True
+
+        return KeyValueError(f"ERR unknown command '{command.decode(errors='replace')}'")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscribed = []
+
+        try:
+            while True:
+                args = await read_command(reader)
+
+                if args is None:
+                    break
+
+                if not args:
+                    continue
+
+                # The connection only receives messages from here on
+                if args[0].upper() == b"SUBSCRIBE":
+                    for count, channel in enumerate(args[1:], start=1):
+                        self.channels[channel].add(writer)
+                        subscribed.append(channel)
+                        writer.write(encode_reply([b"subscribe", channel, count]))
+                else:
+                    writer.write(encode_reply(self.execute(args)))
+
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            for channel in subscribed:
+                self.channels[channel].discard(writer)
+
+            writer.close()
+
+
+async def start_server(host: str = "127.0.0.1", port: int = 0) -> asyncio.Server:
+    """
+    Starts a server on the running event loop
+    :param host:
+    :param port: 0 for any free port
+    :return: the server, its port is server.sockets[0].getsockname()[1]
+    """
+    return await asyncio.start_server(KeyValueServer().handle, host, port)
+
+
+async def serve(host: str, port: int):
+    server = await start_server(host, port)
+    print(f"Key value server on {host}:{port}")
+
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-memory stand-in for Redis")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+""" Prometheus metrics of the requests, MongoDB commands and connection pools and the in-process caches """
+import asyncio
+import json
+import os
+import threading
+import time
+
+from fastapi import Request
+from pymongo import monitoring
+
+from utils.uploads import write_atomic
+
+# Latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted((labels or {}).items()))
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of one worker process.
+    With a metrics directory every worker writes its values to {pid}.json and /metrics adds up all of the files
+    """
+
+    def __init__(self, directory: str = None):
+        self.directory = directory if directory is not None else os.getenv("METRICS_DIRECTORY")
+        self.lock = threading.Lock()
+
+        self.types = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.buckets = {}
+
+        self.collectors = []
+
+    def inc(self, name: str, labels: dict = None, value: float = 1):
+        key = label_key(labels)
+
+        with self.lock:
+            self.types[name] = "counter"
+            self.counters[(name, key)] = self.counters.get((name, key), 0) + value
+
+    def add_gauge(self, name: str, labels: dict = None, value: float = 1):
+        key = label_key(labels)
+
+        with self.lock:
+            self.types[name] = "gauge"
+            self.gauges[(name, key)] = self.gauges.get((name, key), 0) + value
+
+    def set_gauge(self, name: str, labels: dict = None, value: float = 0):
+        with self.lock:
+            self.types[name] = "gauge"
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name: str, value: float, labels: dict = None, buckets: tuple = LATENCY_BUCKETS):
+        key = label_key(labels)
+
+        with self.lock:
+            self.types[name] = "histogram"
+            self.buckets[name] = buckets
+
+            histogram = self.histograms.get((name, key))
+
+            if histogram is None:
+                # Count per bucket, the last one is +Inf, then the sum
+                histogram = self.histograms[(name, key)] = [0] * (len(buckets) + 1) + [0.0]
+
+            index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def add_collector(self, collector):
+        """
+        Adds a function that is called on every scrape and returns gauges
+        :param collector: function returning a list of (name, labels, value)
+        :return:
+        """
+        self.collectors.append(collector)
+
+    def collect(self):
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                self.set_gauge(name, labels, value)
+
+    def snapshot(self) -> dict:
+        self.collect()
+
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "types": dict(self.types),
+                "buckets": {name: list(buckets) for name, buckets in self.buckets.items()},
+                "counters": [[name, key, value] for (name, key), value in self.counters.items()],
+                "gauges": [[name, key, value] for (name, key), value in self.gauges.items()],
+                "histograms": [[name, key, list(values)] for (name, key), values in self.histograms.items()]
+            }
+
+    def flush(self):
+        """
+        Writes the values of this worker to the metrics directory. Blocking, run it in the threadpool
+        :return:
+        """
+        if self.directory is None:
+            return
+
+        write_atomic(json.dumps(self.snapshot()).encode(), os.path.join(self.directory, f"{os.getpid()}.json"))
+
+    async def flush_periodically(self, interval: float = 5):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, self.flush)
+
+    def snapshots(self) -> list:
+        # Only this worker without a directory
+        if self.directory is None:
+            return [self.snapshot()]
+
+        self.flush()
+
+        snapshots = []
+
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json"):
+                continue
+
+            try:
+                with open(os.path.join(self.directory, file_name)) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                continue
+
+        return snapshots
+
+    def render(self) -> str:
+        """
+        Sum of every worker in the Prometheus text format.
+        Counters of stopped workers are kept so totals never go down, their gauges are dropped
+        :return:
+        """
+        types = {}
+        buckets = {}
+        values = {}
+        histograms = {}
+
+        for snapshot in self.snapshots():
+            types.update(snapshot["types"])
+            buckets.update(snapshot["buckets"])
+            alive = snapshot["pid"] == os.getpid() or pid_alive(snapshot["pid"])
+
+            for kind in ("counters", "gauges"):
+                if kind == "gauges" and not alive:
+                    continue
+
+                for name, key, value in snapshot[kind]:
+                    key = (name, tuple(map(tuple, key)))
+                    values[key] = values.get(key, 0) + value
+
+            for name, key, counts in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, key)))
+                total = histograms.setdefault(key, [0] * len(counts))
+
+                for i, count in enumerate(counts):
+                    total[i] += count
+
+        lines = []
+
+        for name in sorted(types):
+            lines.append(f"# TYPE {name} {types[name]}")
+
+            if types[name] != "histogram":
+                for (metric, key), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                continue
+
+            for (metric, key), counts in sorted(histograms.items()):
+                if metric != name:
+                    continue
+
+                cumulative = 0
+
+                for bound, count in zip(list(buckets[name]) + ["+Inf"], counts[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+
+                lines.append(f"{name}_sum{format_labels(key)} {counts[-1]}")
+                lines.append(f"{name}_count{format_labels(key)} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+def stats_collector(metric: str, label: str, name: str, stats):
+    """
+    Collector for the stats() of a cache or the event bus, the hit ratio is left out because it does not add up
+    :param metric: prefix of the gauges
+    :param label: label name
+    :param name: label value
+    :param stats: function returning a dict
+    :return:
+    """
+    def collect():
+        return [(f"{metric}_{key}", {label: name}, value) for key, value in stats().items()
+                if isinstance(value, (int, float)) and key != "hit_ratio"]
+
+    return collect
+
+
+async def metrics_middleware(request: Request, call_next):
+    # Latency and status per route template, not per url
+    start = time.perf_counter()
+    status_code = 500
+
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        labels = {"method": request.method, "route": route.path if route is not None else "unmatched"}
+        metrics = request.app.state.metrics
+
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - start, labels)
+        metrics.inc("http_requests_total", {**labels, "status": str(status_code)})
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Count and duration of every MongoDB command per collection
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.collections = {}
+
+    def started(self, event):
+        # Collection is the value of the command name, getMore has it separately
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        self.collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        self.record(event, "ok")
+
+    def failed(self, event):
+        self.record(event, "error")
+
+    def record(self, event, outcome: str):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        labels = {"command": event.command_name, "collection": collection}
+
+        self.metrics.inc("mongodb_commands_total", {**labels, "outcome": outcome})
+        self.metrics.observe("mongodb_command_duration_seconds", event.duration_micros / 1000000, labels)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Open and checked out connections of the MongoDB pools
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    def labels(self, event) -> dict:
+        return {"address": "%s:%s" % event.address}
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.metrics.inc("mongodb_pool_cleared_total", self.labels(event))
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.metrics.add_gauge("mongodb_pool_connections", self.labels(event), 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.metrics.add_gauge("mongodb_pool_connections", self.labels(event), -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.metrics.inc("mongodb_pool_checkout_failures_total", {**self.labels(event), "reason": str(event.reason)})
+
+    def connection_checked_out(self, event):
+        self.metrics.add_gauge("mongodb_pool_checked_out", self.labels(event), 1)
+
+        # Time spent waiting for a free connection
+        duration = getattr(event, "duration", None)
+
+        if duration is not None:
+            self.metrics.observe("mongodb_pool_checkout_wait_seconds", duration, self.labels(event))
+
+    def connection_checked_in(self, event):
+        self.metrics.add_gauge("mongodb_pool_checked_out", self.labels(event), -1)
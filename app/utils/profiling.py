@@ -0,0 +1,260 @@
+"""
+Profiles single requests in production on demand, off unless PROFILE_DIRECTORY is set.
+A request is profiled when it sends X-Profile-Token matching PROFILE_TOKEN, or at random with PROFILE_SAMPLE_RATE.
+Every profile is two files in the directory, the newest PROFILE_MAX_FILES profiles are kept:
+    {time}-{id}.folded     collapsed stacks of the request, for flamegraph.pl or speedscope
+    {time}-{id}.alloc.txt  top allocation sites while the request ran
+The response of a profiled request has an X-Profile-Id header with the id
+"""
+import asyncio
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from uuid import uuid4
+
+from starlette.concurrency import run_in_threadpool
+
+from utils.uploads import write_atomic
+
+# Header that asks for a profile
+TOKEN_HEADER = b"x-profile-token"
+
+# Allocation files skipped in the top sites, they are the profiler itself
+IGNORED_ALLOCATIONS = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__),
+                       tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+
+
+def allocation_snapshot() -> tracemalloc.Snapshot:
+    # Copies every traced block, blocking for a large heap, run it in the threadpool
+    return tracemalloc.take_snapshot().filter_traces(IGNORED_ALLOCATIONS)
+
+
+def frame_name(frame) -> str:
+    # Same form as py-spy, function (file:line)
+    code = frame.f_code
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+class TaskSampler:
+    """
+    Samples the stack of one request from a background thread.
+    When the event loop runs the request its real stack is taken, otherwise the chain of coroutines the
+    request is awaiting, ending in what it waits for, e.g. [await Future] for a database call or the threadpool
+    """
+
+    def __init__(self, task: asyncio.Task, root_frame, interval: float):
+        self.task = task
+        self.root_frame = root_frame
+        self.interval = interval
+
+        # The event loop thread, where the request runs
+        self.thread_id = threading.get_ident()
+
+        self.stacks = Counter()
+        self.samples = 0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            # The request keeps running while it is read, a broken sample is skipped
+            try:
+                stack = self.running() or self.awaiting()
+            except (AttributeError, RuntimeError, ValueError):
+                continue
+
+            if stack:
+                self.samples += 1
+                self.stacks[";".join(stack)] += 1
+
+    def running(self) -> list:
+        # Frames above the root when the event loop is inside the request
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+
+        while frame is not None:
+            if frame is self.root_frame:
+                return stack[::-1]
+
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+
+        return []
+
+    def awaiting(self) -> list:
+        # Coroutines of the task from the root down to the awaited future
+        awaitable = self.task.get_coro()
+        stack = []
+        below_root = False
+
+        while awaitable is not None:
+            frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None) or \
+                getattr(awaitable, "ag_frame", None)
+
+            if frame is None:
+                stack.append(f"[await {type(awaitable).__name__}]")
+                break
+
+            if below_root:
+                stack.append(frame_name(frame))
+
+            below_root = below_root or frame is self.root_frame
+            awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None) or \
+                getattr(awaitable, "ag_await", None)
+
+        return stack if below_root else []
+
+
+class RequestProfiler:
+    """
+    Settings and output of the request profiles. Only one request is profiled at a time,
+    tracemalloc sees the whole process so concurrent requests show up in the allocations
+    """
+
+    def __init__(self, directory: str = None, token: str = None, sample_rate: float = None, interval: float = None,
+                 max_profiles: int = None, top_allocations: int = 25):
+        self.directory = directory if directory is not None else os.getenv("PROFILE_DIRECTORY")
+        self.token = token if token is not None else os.getenv("PROFILE_TOKEN")
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+        self.interval = interval if interval is not None else float(os.getenv("PROFILE_INTERVAL", 0.005))
+        self.max_profiles = max_profiles if max_profiles is not None else int(os.getenv("PROFILE_MAX_FILES", 50))
+        self.top_allocations = top_allocations
+
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None and (bool(self.token) or self.sample_rate > 0)
+
+    def wanted(self, scope: dict) -> bool:
+        """
+        The request sent the right token or was picked by the sample rate
+        :param scope:
+        :return:
+        """
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == TOKEN_HEADER:
+                    return hmac.compare_digest(value, self.token.encode())
+
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def save(self, profile_id: str, scope: dict, sampler: TaskSampler, allocations: list, peak: int, seconds: float):
+        """
+        Writes the files of a profile and removes the oldest ones. Blocking, run it in the threadpool
+        :param profile_id:
+        :param scope:
+        :param sampler:
+        :param allocations: tracemalloc statistics, largest first
+        :param peak: most traced memory during the request in bytes
+        :param seconds: duration of the request
+        :return:
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        base = os.path.join(self.directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{profile_id}")
+
+        # One line per stack with its sample count, the request is the bottom frame
+        root = f"{scope['method']} {scope['path']}"
+        folded = "".join(f"{root};{stack} {count}\n" for stack, count in sampler.stacks.most_common())
+
+        lines = [f"{root} {seconds * 1000:.1f} ms, {sampler.samples} samples every {self.interval * 1000:g} ms",
+                 f"Peak traced memory {peak / 1024:.1f} KiB",
+                 "Allocated and still alive at the end, by line:"]
+
+        for statistic in allocations[:self.top_allocations]:
+            frame = statistic.traceback[0]
+            lines.append(f"{statistic.size_diff / 1024:>10.1f} KiB {statistic.count_diff:>8} blocks  "
+                         f"{frame.filename}:{frame.lineno}")
+
+        write_atomic(folded.encode(), base + ".folded")
+        write_atomic(("\n".join(lines) + "\n").encode(), base + ".alloc.txt")
+
+        self.prune()
+
+    def prune(self):
+        # File names start with the time, so the oldest profiles sort first
+        profiles = sorted({file_name.split(".", 1)[0] for file_name in os.listdir(self.directory)
+                           if file_name.endswith((".folded", ".alloc.txt"))})
+
+        for profile in profiles[:max(0, len(profiles) - self.max_profiles)]:
+            for extension in (".folded", ".alloc.txt"):
+                try:
+                    os.remove(os.path.join(self.directory, profile + extension))
+                except FileNotFoundError:
+                    pass
+
+
+class ProfilingMiddleware:
+    """
+    Plain ASGI middleware, added first so it is the innermost one and the endpoint runs in the task it samples.
+    Without a profile it only checks the settings
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        profiler = getattr(scope["app"].state, "profiler", None) if "app" in scope else None
+
+        if scope["type"] != "http" or profiler is None or not profiler.enabled or not profiler.wanted(scope):
+            return await self.app(scope, receive, send)
+
+        # Another request is being profiled
+        if not profiler.lock.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        try:
+            await self.profile(profiler, scope, receive, send)
+        finally:
+            profiler.lock.release()
+
+    async def profile(self, profiler: RequestProfiler, scope, receive, send):
+        profile_id = uuid4().hex[:12]
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+
+            await send(message)
+
+        # Allocations from here on, tracemalloc is stopped again unless something else started it
+        started_tracing = not tracemalloc.is_tracing()
+
+        if started_tracing:
+            tracemalloc.start()
+
+        tracemalloc.reset_peak()
+        before = await run_in_threadpool(allocation_snapshot)
+
+        sampler = TaskSampler(asyncio.current_task(), sys._getframe(), profiler.interval)
+        sampler.start()
+        start = time.perf_counter()
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            seconds = time.perf_counter() - start
+            sampler.stop()
+
+            after = await run_in_threadpool(allocation_snapshot)
+            peak = tracemalloc.get_traced_memory()[1]
+
+            if started_tracing:
+                tracemalloc.stop()
+
+            allocations = await run_in_threadpool(after.compare_to, before, "lineno")
+            await run_in_threadpool(profiler.save, profile_id, scope, sampler, allocations, peak, seconds)
@@ -0,0 +1,226 @@
+"""
+Counts the MongoDB queries of every request, flags repeated queries of the same shape (N+1)
+and enforces round-trip budgets per route in tests and dev mode
+"""
+import json
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi import Request, status
+from pymongo import monitoring
+
+from utils.responses import ORJSONResponse
+
+# Queries of the request being served, Motor copies the context to its executor threads
+current_log = ContextVar("query_log", default=None)
+
+# Most queries a route may send, the session check is included. getMore of long cursors is not counted
+ROUTE_BUDGETS = {
+    "/api/update_profile": 5,
+    "/api/upload_profile_picture": 4,
+    "/api/upload_profile_picture_file": 4,
+    "/api/profile_image/{username}": 1,
+    "/api/get_profile_picture/{file_name}": 0,
+    "/api/get_profile": 5,
+    "/api/get_likes": 6,
+    "/api/get_matches": 6,
+    "/api/get_counts": 5,
+    "/api/get_discovers": 8,
+    "/api/events": 4,
+    "/api/delete_user": 12,
+    # Measured 21 for a like that makes a match and 17 for a dislike of a match, two more for the buckets of
+    # RATE_LIMIT_BACKEND=mongo
+    "/api/like_user/{liked_username}": 23,
+    "/api/dislike_user/{disliked_username}": 19,
+    "/api/unmatch": 12,
+    "/api/oauth/github/session_id": 7,
+    "/init_login": 7
+}
+
+# Where the filter of each command is
+FILTER_FIELDS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+    "aggregate": "pipeline",
+    "update": "updates",
+    "delete": "deletes"
+}
+
+# Cursor continuations, round trips but not queries of their own
+CURSOR_COMMANDS = {"getMore", "killCursors"}
+
+
+def shape(value):
+    # Structure of the filter with every value replaced, lists keep the shape of their first item
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [shape(value[0])] if value else []
+
+    return "?"
+
+
+def command_shape(command_name: str, command: dict) -> str:
+    collection = command.get("collection" if command_name == "getMore" else command_name)
+    query_filter = command.get(FILTER_FIELDS.get(command_name), {})
+
+    # Writes are lists of statements, the first one stands for all
+    if command_name in ("update", "delete") and query_filter:
+        query_filter = query_filter[0].get("q", {})
+
+    return f"{command_name} {collection if isinstance(collection, str) else ''} " \
+           f"{json.dumps(shape(query_filter), sort_keys=True)}"
+
+
+class QueryLog:
+    """
+    Queries sent while serving one request
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.queries = 0
+        self.round_trips = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    def started(self, command_name: str, command: dict):
+        with self.lock:
+            self.round_trips += 1
+
+            if command_name in CURSOR_COMMANDS:
+                return
+
+            self.queries += 1
+            self.shapes[command_shape(command_name, command)] += 1
+
+    def finished(self, seconds: float):
+        with self.lock:
+            self.seconds += seconds
+
+    def repeated(self, threshold: int) -> list:
+        """
+        Shapes sent at least threshold times, likely a query in a loop
+        :param threshold:
+        :return: list of (shape, count)
+        """
+        return [(query_shape, count) for query_shape, count in self.shapes.most_common() if count >= threshold]
+
+
+@contextmanager
+def track_queries():
+    """
+    Counts the queries of a block outside of a request, for tests and scripts
+    :return: QueryLog
+    """
+    log = QueryLog()
+    token = current_log.set(log)
+
+    try:
+        yield log
+    finally:
+        current_log.reset(token)
+
+
+class QueryListener(monitoring.CommandListener):
+    """
+    Adds every command to the log of the current request
+    """
+
+    def started(self, event):
+        log = current_log.get()
+
+        if log is not None:
+            log.started(event.command_name, event.command)
+
+    def succeeded(self, event):
+        self.finished(event)
+
+    def failed(self, event):
+        self.finished(event)
+
+    @staticmethod
+    def finished(event):
+        log = current_log.get()
+
+        if log is not None:
+            log.finished(event.duration_micros / 1000000)
+
+
+class QueryBudget:
+    """
+    Settings of the query tracking, QUERY_BUDGET_MODE is off in production, warn or enforce in dev and tests
+    """
+
+    def __init__(self, mode: str = None, budgets: dict = None, repeat_threshold: int = None):
+        self.mode = mode or os.getenv("QUERY_BUDGET_MODE", "off")
+        self.repeat_threshold = repeat_threshold or int(os.getenv("QUERY_REPEAT_THRESHOLD", 5))
+
+        # Budgets can be changed with a JSON object in QUERY_BUDGETS
+        self.budgets = dict(ROUTE_BUDGETS)
+        self.budgets.update(json.loads(os.getenv("QUERY_BUDGETS", "{}")))
+        self.budgets.update(budgets or {})
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("warn", "enforce")
+
+
+async def query_budget_middleware(request: Request, call_next):
+    budget = request.app.state.query_budget
+
+    if not budget.enabled:
+        return await call_next(request)
+
+    # Log of this request, the listener adds to it
+    log = QueryLog()
+    token = current_log.set(log)
+
+    try:
+        response = await call_next(request)
+    finally:
+        current_log.reset(token)
+
+    route = request.scope.get("route")
+    path = route.path if route is not None else request.url.path
+
+    # Debug headers
+    response.headers["X-DB-Queries"] = str(log.queries)
+    response.headers["X-DB-Round-Trips"] = str(log.round_trips)
+    response.headers["X-DB-Time-Ms"] = f"{log.seconds * 1000:.1f}"
+
+    # Same query in a loop
+    repeated = log.repeated(budget.repeat_threshold)
+
+    if repeated:
+        response.headers["X-DB-Repeated"] = str(len(repeated))
+
+        for query_shape, count in repeated:
+            print(f"Repeated query in {request.method} {path}: {count}x {query_shape}")
+
+    # Round-trip budget of the route
+    limit = budget.budgets.get(path)
+
+    if limit is None or log.queries <= limit:
+        return response
+
+    print(f"Query budget exceeded in {request.method} {path}: {log.queries} queries, budget {limit}")
+
+    if budget.mode != "enforce":
+        return response
+
+    return ORJSONResponse({
+        "message": "Query budget exceeded",
+        "route": path,
+        "queries": log.queries,
+        "budget": limit,
+        "shapes": dict(log.shapes)
+    }, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        headers={name: value for name, value in response.headers.items() if name.startswith("x-db-")})
@@ -0,0 +1,292 @@
+"""
+Token bucket rate limits of the swipe endpoints, per user and route and for the route as a whole.
+Buckets are kept in the worker by default. RATE_LIMIT_BACKEND=kv shares them between the workers through the
+key value server of CACHE_URL. RATE_LIMIT_BACKEND=mongo shares them through the rate_limits collection, it is
+experimental: it needs MongoDB 4.2 or later for $$NOW in updates and adds a write per bucket to every swipe
+"""
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import pymongo
+from fastapi import HTTPException, Request, status
+from pymongo import ReturnDocument
+
+from utils.cache import CACHE_ERRORS
+from utils.kv import KeyValueClient
+
+# Burst is the bucket size, rate the tokens added per second. Routes without limits are not limited
+ROUTE_LIMITS = {
+    "/api/like_user/{liked_username}": {"burst": 30, "rate": 1.0, "global_burst": 2000, "global_rate": 500.0},
+    "/api/dislike_user/{disliked_username}": {"burst": 30, "rate": 1.0, "global_burst": 2000, "global_rate": 500.0}
+}
+
+# The global bucket of a route in the shared backend is split in this many documents with a share of the limit
+# each, so swipes do not all wait for the lock of one document
+GLOBAL_SHARDS = int(os.getenv("RATE_LIMIT_GLOBAL_SHARDS", 16))
+
+
+class LocalBuckets:
+    """
+    Buckets of this worker, the least recently used ones are dropped past max_keys.
+    A dropped bucket had time to refill, so it comes back full
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    async def take(self, key: str, burst: float, rate: float) -> float:
+        """
+        Takes one token
+        :param key:
+        :param burst:
+        :param rate:
+        :return: 0 when a token was taken, otherwise seconds until the next one
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+
+            if allowed:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now)
+
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+
+        return 0.0 if allowed else (1 - tokens) / rate
+
+    async def give_back(self, key: str, burst: float, rate: float):
+        """
+        Returns a token taken for a request that was refused anyway
+        :param key:
+        :param burst:
+        :param rate:
+        :return:
+        """
+        with self.lock:
+            if key in self.buckets:
+                tokens, updated = self.buckets[key]
+                self.buckets[key] = (min(burst, tokens + 1), updated)
+
+
+class MongoBuckets:
+    """
+    Buckets shared by every worker, refilled and taken in one atomic update with the server clock.
+    Idle buckets are removed by the TTL index of the rate_limits collection. Experimental
+    """
+
+    def __init__(self, db, global_shards: int = GLOBAL_SHARDS):
+        self.db = db
+        self.global_shards = max(1, global_shards)
+
+        self.col_rate_limits = self.db["rate_limits"]
+
+    async def take(self, key: str, burst: float, rate: float) -> float:
+        """
+        Takes one token
+        :param key:
+        :param burst:
+        :param rate:
+        :return: 0 when a token was taken, otherwise seconds until the next one
+        """
+        # Tokens refilled since the last update, capped at the burst
+        elapsed = {"$divide": [{"$subtract": ["$$NOW", {"$ifNull": ["$updated_at", "$$NOW"]}]}, 1000]}
+        refilled = {"$min": [burst, {"$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [elapsed, rate]}]}]}
+
+        bucket = await self.col_rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated_at": "$$NOW"}},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+        return 0.0 if bucket["allowed"] else (1 - bucket["tokens"]) / rate
+
+    async def give_back(self, key: str, burst: float, rate: float):
+        """
+        Returns a token taken for a request that was refused anyway
+        :param key:
+        :param burst:
+        :param rate:
+        :return:
+        """
+        await self.col_rate_limits.update_one({"_id": key},
+                                              [{"$set": {"tokens": {"$min": [burst, {"$add": ["$tokens", 1]}]}}}])
+
+
+class KeyValueBuckets:
+    """
+    Buckets shared by every worker through a Redis compatible server, one atomic INCRBY per bucket.
+    A bucket is a counter per window of burst / rate seconds that allows burst requests, the average is the
+    rate of the bucket but up to two bursts can pass around the end of a window
+    """
+
+    def __init__(self, client: KeyValueClient):
+        self.client = client
+
+    def window(self, key: str, burst: float, rate: float) -> tuple:
+        # Windows are aligned on the clock so every worker counts in the same key
+        seconds = burst / rate
+        index = int(time.time() // seconds)
+
+        return f"codespark:rate:{key}:{index}", (index + 1) * seconds, seconds
+
+    async def take(self, key: str, burst: float, rate: float) -> float:
+        """
+        Takes one token
+        :param key:
+        :param burst:
+        :param rate:
+        :return: 0 when a token was taken, otherwise seconds until the next window
+        """
+        server_key, ends_at, seconds = self.window(key, burst, rate)
+        count = await self.client.incr(server_key)
+
+        # The first request of the window sets the expiry, past windows are never read again
+        if count == 1:
+            await self.client.expire(server_key, 2 * seconds)
+
+        return 0.0 if count <= burst else max(ends_at - time.time(), 0.001)
+
+    async def give_back(self, key: str, burst: float, rate: float):
+        """
+        Returns a token taken for a request that was refused anyway
+        :param key:
+        :param burst:
+        :param rate:
+        :return:
+        """
+        server_key, _, _ = self.window(key, burst, rate)
+        await self.client.incr(server_key, -1)
+
+
+class RateLimiter:
+    """
+    Limits of every route and the buckets they are counted in
+    """
+
+    def __init__(self, db=None, backend: str = None, limits: dict = None, client: KeyValueClient = None):
+        backend = backend or os.getenv("RATE_LIMIT_BACKEND", "local")
+
+        # Shared buckets need the database or the key value server, the worker ones are the fallback
+        if backend == "mongo" and db is not None:
+            self.buckets = MongoBuckets(db)
+        elif backend == "kv" and client is not None:
+            self.buckets = KeyValueBuckets(client)
+        else:
+            self.buckets = LocalBuckets()
+
+        self.global_shards = getattr(self.buckets, "global_shards", 1)
+
+        # Shards found empty by this worker and when they have a token again, they are not asked until then
+        self.empty_shards = {}
+
+        # Limits can be changed with a JSON object in RATE_LIMITS, a route set to null is not limited
+        self.limits = dict(ROUTE_LIMITS)
+        self.limits.update(json.loads(os.getenv("RATE_LIMITS", "{}")))
+        self.limits.update(limits or {})
+
+    async def retry_after(self, route: str, username: str) -> tuple:
+        """
+        Takes a token of the user and of the route
+        :param route: route template
+        :param username:
+        :return: (seconds until the request is allowed, "user" or "global"), (0, None) when it is allowed
+        """
+        limit = self.limits.get(route)
+
+        if not limit:
+            return 0.0, None
+
+        # The user first, so a limited user does not use up the tokens of everyone else
+        try:
+            user_key = f"user:{route}:{username}"
+            wait = await self.buckets.take(user_key, limit["burst"], limit["rate"])
+
+            if wait > 0:
+                return wait, "user"
+
+            if limit.get("global_burst"):
+                wait = await self.take_global(route, limit)
+
+                if wait > 0:
+                    # The request is refused, the user keeps the token for when the route has room again
+                    await self.buckets.give_back(user_key, limit["burst"], limit["rate"])
+                    return wait, "global"
+        except (pymongo.errors.PyMongoError,) + CACHE_ERRORS as e:
+            # Swipes keep working when the shared buckets can not be reached
+            print(f"Rate limit check failed: {e}")
+
+        return 0.0, None
+
+    async def take_global(self, route: str, limit: dict) -> float:
+        """
+        Takes a token of the route from its shards, starting at a random one so the workers spread over them.
+        The route is only full when every shard is empty
+        :param route:
+        :param limit:
+        :return: 0 when a token was taken, otherwise seconds until the next one
+        """
+        # Every shard holds at least one token, together they add up to the limit of the route
+        shards = max(1, min(self.global_shards, int(limit["global_burst"])))
+
+        if shards == 1:
+            return await self.buckets.take(f"global:{route}", limit["global_burst"], limit["global_rate"])
+
+        now = time.monotonic()
+        start = random.randrange(shards)
+        waits = []
+
+        for shard in [(start + offset) % shards for offset in range(shards)]:
+            key = f"global:{route}:{shard}"
+
+            # Known to be empty, no round trip until it has a token again
+            if self.empty_shards.get(key, 0) > now:
+                waits.append(self.empty_shards[key] - now)
+                continue
+
+            wait = await self.buckets.take(key, limit["global_burst"] / shards, limit["global_rate"] / shards)
+
+            if wait == 0:
+                self.empty_shards.pop(key, None)
+                return 0.0
+
+            self.empty_shards[key] = now + wait
+            waits.append(wait)
+
+        return min(waits)
+
+
+async def check_rate_limit(request: Request):
+    """
+    Rejects the request with 429 and Retry-After when the user or the route is out of tokens.
+    Used after verify_session_id, so the username is authenticated
+    :param request:
+    :return:
+    """
+    route = request.scope.get("route")
+    wait, scope = await request.app.state.rate_limiter.retry_after(route.path, request.headers.get("username"))
+
+    if scope is None:
+        return
+
+    request.app.state.metrics.inc("rate_limited_total", {"route": route.path, "scope": scope})
+
+    raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many requests",
+                        headers={"Retry-After": str(max(1, math.ceil(wait)))})
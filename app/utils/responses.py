@@ -0,0 +1,21 @@
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+
+
+def orjson_default(value):
+    # Types orjson does not know natively
+    if isinstance(value, ObjectId):
+        return str(value)
+
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+class ORJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson, datetimes are encoded natively and ObjectIds as strings
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
@@ -0,0 +1,36 @@
+"""
+Response models of the profile, likes, matches and discover endpoints, for the OpenAPI docs only.
+They are given as responses= and not response_model=, so responses are not validated again before orjson
+"""
+from typing import List
+
+from pydantic import BaseModel
+
+
+class LikeCard(BaseModel):
+    username: str
+    profile_picture: str = ""
+    natural_languages: str = ""
+    background: str = ""
+    looking_for: str = ""
+    how_contribute: str = ""
+
+
+class MatchCard(LikeCard):
+    email: str = ""
+    discord_username: str = ""
+
+
+class Profile(MatchCard):
+    pass
+
+
+class Likes(BaseModel):
+    user_liked: List[LikeCard]
+    liked_user: List[LikeCard]
+
+
+class Counts(BaseModel):
+    likes_received: int
+    likes_sent: int
+    matches: int
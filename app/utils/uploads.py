@@ -0,0 +1,206 @@
+import os
+import hashlib
+import tempfile
+
+from fastapi import HTTPException, UploadFile, status
+from starlette.concurrency import run_in_threadpool
+
+# Where the profile pictures are stored
+IMAGE_DIRECTORY = "image_storage"
+
+# Largest accepted profile picture
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+# Size of the chunks streamed to disk
+CHUNK_SIZE = 64 * 1024
+
+# Routes that take an image in the body
+UPLOAD_PATH_PREFIX = "/api/upload_profile_picture"
+
+# Largest upload body, base64 makes the body a third larger than the image, the rest is form or JSON overhead
+MAX_UPLOAD_BODY_BYTES = MAX_IMAGE_BYTES * 4 // 3 + 4096
+
+
+class UploadTooLarge(HTTPException):
+
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Image is too large")
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Plain ASGI middleware, limits the body of the upload routes while it is received.
+    Content-Length is checked up front, chunked bodies are counted and cut off at the limit,
+    so the form parser never spools more than max_bytes to disk. Runs before the session check
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BODY_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def reject(self, send):
+        body = b'{"message":"Image is too large"}'
+
+        await send({"type": "http.response.start", "status": status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(UPLOAD_PATH_PREFIX):
+            return await self.app(scope, receive, send)
+
+        # Reject oversized uploads from their Content-Length before the body is read
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            return await self.reject(send)
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+
+            message = await receive()
+
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+
+                # Raised inside the body parsing, FastAPI passes HTTPExceptions on as they are
+                if received > self.max_bytes:
+                    raise UploadTooLarge()
+
+            return message
+
+        async def tracked_send(message):
+            nonlocal response_started
+
+            if message["type"] == "http.response.start":
+                response_started = True
+
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except UploadTooLarge:
+            # Read outside the endpoint, e.g. by a dependency
+            if response_started:
+                raise
+
+            await self.reject(send)
+
+
+def sniff_image_type(head: bytes):
+    """
+    Detects the image type from its first bytes, the client's content type is not trusted
+    :param head:
+    :return: (content type, file extension) or None
+    """
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg", "jpg"
+
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png", "png"
+
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp", "webp"
+
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif", "gif"
+
+    return None
+
+
+def check_image(image: bytes, max_bytes: int = MAX_IMAGE_BYTES):
+    """
+    Validates size and type of an image that is already in memory
+    :param image:
+    :param max_bytes:
+    :return: (content type, file extension)
+    """
+    if len(image) > max_bytes:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Image is too large")
+
+    image_type = sniff_image_type(image[:16])
+
+    if image_type is None:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Unsupported image type")
+
+    return image_type
+
+
+def write_atomic(data: bytes, path: str):
+    """
+    Writes the file next to its destination and renames it in place, readers never see a partial file
+    :param data:
+    :param path:
+    :return:
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(data)
+
+        os.replace(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+async def stream_upload(upload: UploadFile, directory: str = IMAGE_DIRECTORY, max_bytes: int = MAX_IMAGE_BYTES):
+    """
+    Streams an uploaded image to a temporary file in chunks off the event loop.
+    The size limit and the image type are checked and the sha256 computed while streaming,
+    the caller renames the file in place
+    :param upload:
+    :param directory:
+    :param max_bytes:
+    :return: (temporary path, size, content type, file extension, sha256 hex digest)
+    """
+    await run_in_threadpool(os.makedirs, directory, exist_ok=True)
+
+    file_descriptor, temp_path = await run_in_threadpool(tempfile.mkstemp, dir=directory, suffix=".part")
+    file = os.fdopen(file_descriptor, "wb")
+
+    size = 0
+    image_type = None
+    digest = hashlib.sha256()
+
+    try:
+        while True:
+            chunk = await upload.read(CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            # Sniff the type from the first chunk
+            if image_type is None:
+                image_type = sniff_image_type(chunk[:16])
+
+                if image_type is None:
+                    raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                                        detail="Unsupported image type")
+
+            size += len(chunk)
+
+            if size > max_bytes:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Image is too large")
+
+            digest.update(chunk)
+            await run_in_threadpool(file.write, chunk)
+
+        if image_type is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No image provided")
+
+        await run_in_threadpool(file.close)
+    except BaseException:
+        await run_in_threadpool(file.close)
+        await run_in_threadpool(os.unlink, temp_path)
+        raise
+
+    return temp_path, size, image_type[0], image_type[1], digest.hexdigest()